@@ -0,0 +1,343 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+بنچمارک بار ربات جنگ
+Load benchmark for war simulation bot
+
+هزاران گروه و بازیکن جعلی ترکیبی از /buy، /attack، /collect، /leaderboard و پیام‌های
+عادی می‌فرستند و تاخیر p50/p95/p99، پیام در ثانیه و رشد حافظه گزارش می‌شود. بار با
+seed ثابت ساخته می‌شود تا نتایج اجراهای مختلف (و نسخه‌های مختلف) قابل مقایسه باشند.
+
+    python benchmark.py --repeat 3 --save benchmark_baseline.json
+    python benchmark.py --repeat 3 --compare benchmark_baseline.json
+
+benchmark_baseline.json با پارامترهای پیش‌فرض در مخزن ثبت شده است؛ اعداد به سخت‌افزار
+وابسته‌اند، پس پس از تغییر ماشین اجرا (یا CI) آن را با make bench-baseline دوباره بسازید.
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+import fake_bale
+
+# سهم هر نوع پیام در بار پیش‌فرض
+DEFAULT_MIX = {
+    "chatter": 40,
+    "buy": 20,
+    "collect": 15,
+    "attack": 15,
+    "leaderboard": 10,
+}
+
+CHATTER = ["سلام", "کی حمله کنیم؟", "😂", "ارتش من آماده است", "خوبی؟", "👍"]
+
+# معیارهایی که بزرگ‌تر شدن آن‌ها پسرفت است و برعکس
+LOWER_IS_BETTER = ("p50_ms", "p95_ms", "p99_ms", "memory_growth_kb")
+HIGHER_IS_BETTER = ("messages_per_sec",)
+
+def parse_mix(text):
+    """تبدیل 'chatter=40,buy=20' به دیکشنری وزن‌ها"""
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        if kind.strip() not in DEFAULT_MIX:
+            raise argparse.ArgumentTypeError(f"نوع پیام نامعتبر: {kind}")
+        mix[kind.strip()] = float(weight)
+    return mix
+
+def enter_scratch_directory():
+    """رفتن به یک پوشه موقت تا فایل‌های داده و لاگ ربات واقعی دست نخورند (فقط در CLI)"""
+    directory = tempfile.mkdtemp(prefix="war_bench_")
+    os.chdir(directory)
+    return directory
+
+def load_bot(seed, latency=0.0):
+    """
+    وارد کردن ربات با کلاینت جعلی بله
+
+    سرور مانیتورینگ و محدودیت نرخ ارسال غیرفعال می‌شوند تا اعداد کارایی خود ربات
+    را نشان دهند نه انتظار برای سطل توکن. فایل‌های ربات در پوشه فعلی ساخته می‌شوند؛
+    CLI پیش از صدا زدن این تابع enter_scratch_directory را اجرا می‌کند.
+    """
+    fake_bale.install(force=True)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    random.seed(seed)
+    import war_simulation_bot as wsb
+
+    wsb.bot.latency = latency
+    wsb.monitoring.enabled = False
+    wsb.outbox = wsb.OutboundQueue(global_rate=10 ** 9, chat_rate=10 ** 9, chat_burst=10 ** 9)
+    return wsb
+
+def run_with_bot(wsb, scenario):
+    """اجرای سناریو بین on_ready و توقف کامل ربات (صف‌ها و ذخیره‌سازی)"""
+    async def run():
+        wsb.load_data()
+        await wsb.bot.handlers["on_ready"]()
+        try:
+            return await scenario
+        finally:
+            wsb.dispatcher.close()
+            wsb.outbox.close()
+
+    try:
+        return asyncio.run(run())
+    finally:
+        wsb.shutdown_storage()
+
+def build_workload(bale, bot, chats, players, count, mix, seed):
+    """ساخت لیست قطعی پیام‌ها با seed ثابت"""
+    rng = random.Random(seed)
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    chat_objects = [bale.Chat(-(1000 + i)) for i in range(chats)]
+    users = [[bale.User(c * players + p + 1, f"بازیکن {c * players + p + 1}") for p in range(players)]
+             for c in range(chats)]
+    for row in users:
+        for user in row:
+            bot.names[user.user_id] = user.first_name
+
+    messages = []
+    for _ in range(count):
+        c = rng.randrange(chats)
+        chat = chat_objects[c]
+        author = rng.choice(users[c])
+        kind = rng.choices(kinds, weights)[0]
+        reply_to = None
+        if kind == "buy":
+            text = f"/buy soldier {rng.randint(1, 20)}"
+        elif kind == "collect":
+            text = "/collect"
+        elif kind == "leaderboard":
+            text = "/leaderboard"
+        elif kind == "attack":
+            text = "/attack"
+            target = rng.choice([user for user in users[c] if user is not author] or users[c])
+            reply_to = bale.Message(rng.choice(CHATTER), chat, target, bot=bot)
+        else:
+            text = rng.choice(CHATTER)
+        messages.append((kind, bale.Message(text, chat, author, reply_to_message=reply_to, bot=bot)))
+    return messages
+
+def percentile(values, fraction):
+    """صدک با درون‌یابی خطی روی لیست مرتب"""
+    if not values:
+        return 0.0
+    position = (len(values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+def summarize(values):
+    """تعداد و صدک‌های تاخیر (میلی‌ثانیه) یک لیست مرتب"""
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(values, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+    }
+
+class LatencyRecorder:
+    """اندازه‌گیری زمان از تحویل پیام به on_message تا پایان پردازش آن توسط هندلر"""
+
+    def __init__(self, wsb):
+        self.submitted = {}
+        self.samples = {}  # برچسب -> لیست تاخیرها (ثانیه)
+        self.measuring = True
+        process = wsb.dispatcher.handler
+
+        async def timed(message):
+            await process(message)
+            started = self.submitted.pop(id(message), None)
+            if self.measuring and started is not None:
+                self.samples.setdefault(message.label, []).append(time.perf_counter() - started)
+
+        wsb.dispatcher.handler = timed
+
+    def submit(self, message, label):
+        message.label = label
+        self.submitted[id(message)] = time.perf_counter()
+
+    def reset(self):
+        self.samples = {}
+
+    def latencies(self):
+        return sorted(value for values in self.samples.values() for value in values)
+
+    def by_label(self):
+        return {label: summarize(sorted(values)) for label, values in sorted(self.samples.items())}
+
+async def run_benchmark(wsb, bot, workload, warmup, batch):
+    """ارسال بار به صورت دسته‌ای و اندازه‌گیری تاخیر هندلرها"""
+    recorder = LatencyRecorder(wsb)
+
+    async def send(messages):
+        for start in range(0, len(messages), batch):
+            for kind, message in messages[start:start + batch]:
+                recorder.submit(message, kind)
+                await bot.emit(message)
+            await wsb.dispatcher.drain()
+
+    await send(workload[:warmup])
+    await wsb.outbox.drain()
+    recorder.reset()
+
+    gc.collect()
+    tracemalloc.start()
+    memory_before = tracemalloc.get_traced_memory()[0]
+    sent_before = bot.sent_count
+    started = time.perf_counter()
+    await send(workload[warmup:])
+    await wsb.outbox.drain()
+    elapsed = time.perf_counter() - started
+    recorder.measuring = False
+    gc.collect()
+    memory_after, memory_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies = recorder.latencies()
+    measured = len(workload) - warmup
+    overall = summarize(latencies)
+    return {
+        "messages": measured,
+        "handled": len(latencies),
+        "replies": bot.sent_count - sent_before,
+        "elapsed_sec": round(elapsed, 3),
+        "messages_per_sec": round(measured / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": overall["p50_ms"],
+        "p95_ms": overall["p95_ms"],
+        "p99_ms": overall["p99_ms"],
+        "memory_growth_kb": round((memory_after - memory_before) / 1024, 1),
+        "memory_peak_kb": round((memory_peak - memory_before) / 1024, 1),
+        "by_kind": recorder.by_label(),
+    }
+
+def compare(result, baseline, tolerance):
+    """مقایسه با baseline؛ لیست پسرفت‌ها برگردانده می‌شود"""
+    regressions = []
+    current, previous = result["metrics"], baseline["metrics"]
+    for key in LOWER_IS_BETTER + HIGHER_IS_BETTER:
+        old, new = previous.get(key), current.get(key)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        marker = ""
+        if (key in LOWER_IS_BETTER and change > tolerance) or (key in HIGHER_IS_BETTER and change < -tolerance):
+            regressions.append(key)
+            marker = "  ❌"
+        print(f"  {key:<18} {old:>12} → {new:<12} ({change:+.1%}){marker}")
+    return regressions
+
+def median_metrics(runs):
+    """میانه هر معیار در چند اجرا (معیارهای by_kind برای هر نوع پیام جداگانه)"""
+    merged = {}
+    for key, value in runs[0].items():
+        if isinstance(value, dict):
+            merged[key] = median_metrics([run[key] for run in runs if key in run])
+        else:
+            merged[key] = statistics.median(run[key] for run in runs if key in run)
+    return merged
+
+def run_repeated(params, repeat):
+    """
+    اجرای بنچمارک در repeat فرآیند جداگانه و ترکیب نتایج با میانه
+
+    تاخیرهای p95/p99 به دلیل مکث‌های GC بین اجراها تا حدود 30٪ نوسان دارند؛ میانه
+    چند اجرا baseline و مقایسه را پایدار می‌کند. هر اجرا ربات را از ابتدا وارد می‌کند.
+    """
+    mix = ",".join(f"{kind}={weight}" for kind, weight in params["mix"].items())
+    args = [sys.executable, os.path.abspath(__file__), "--mix", mix]
+    for key in ("chats", "players", "messages", "warmup", "batch", "seed", "latency"):
+        args += [f"--{key}", str(params[key])]
+    runs = []
+    with tempfile.TemporaryDirectory(prefix="war_bench_runs_") as directory:
+        for index in range(repeat):
+            print(f"⏱️ اجرای {index + 1} از {repeat}...")
+            path = os.path.join(directory, f"run{index}.json")
+            subprocess.run(args + ["--save", path], check=True, stdout=subprocess.DEVNULL)
+            with open(path, "r", encoding="utf-8") as f:
+                runs.append(json.load(f)["metrics"])
+    return median_metrics(runs)
+
+def print_report(result):
+    metrics = result["metrics"]
+    print("📊 نتیجه بنچمارک")
+    print(f"  پیام‌ها: {metrics['messages']} (پردازش شده: {metrics['handled']}، پاسخ: {metrics['replies']})")
+    print(f"  زمان: {metrics['elapsed_sec']} ثانیه — {metrics['messages_per_sec']} پیام در ثانیه")
+    print(f"  تاخیر: p50={metrics['p50_ms']}ms p95={metrics['p95_ms']}ms p99={metrics['p99_ms']}ms")
+    print(f"  حافظه: رشد {metrics['memory_growth_kb']}KB، اوج {metrics['memory_peak_kb']}KB")
+    for kind, stats in metrics["by_kind"].items():
+        print(f"    {kind:<12} {stats['count']:>6}  p50={stats['p50_ms']}ms p99={stats['p99_ms']}ms")
+
+def main():
+    parser = argparse.ArgumentParser(description="بنچمارک بار ربات جنگ با کلاینت جعلی بله")
+    parser.add_argument("--chats", type=int, default=1000)
+    parser.add_argument("--players", type=int, default=10, help="بازیکن در هر گروه")
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--warmup", type=int, default=2000, help="پیام‌های اولیه که اندازه‌گیری نمی‌شوند")
+    parser.add_argument("--batch", type=int, default=500, help="تعداد پیام هر موج ورودی")
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX, help="مثلاً chatter=40,buy=20,attack=15")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.0, help="تاخیر شبیه‌سازی شده هر درخواست API (ثانیه)")
+    parser.add_argument("--save", metavar="FILE", help="ذخیره نتیجه به عنوان baseline")
+    parser.add_argument("--compare", metavar="FILE", help="مقایسه با baseline ذخیره شده")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="حداکثر پسرفت مجاز (نسبی)")
+    parser.add_argument("--repeat", type=int, default=1, help="تعداد اجرا در فرآیندهای جداگانه؛ میانه معیارها گزارش می‌شود")
+    args = parser.parse_args()
+
+    # کلاینت جعلی باید پیش از وارد کردن ربات ثبت شود؛ ذخیره‌سازی در پوشه موقت انجام می‌شود
+    save_path = os.path.abspath(args.save) if args.save else None
+    compare_path = os.path.abspath(args.compare) if args.compare else None
+    params = {key: getattr(args, key) for key in ("chats", "players", "messages", "warmup", "batch", "mix", "seed", "latency")}
+
+    if args.repeat > 1:
+        metrics = run_repeated(params, args.repeat)
+    else:
+        enter_scratch_directory()
+        wsb = load_bot(args.seed, args.latency)
+        bot = wsb.bot
+        workload = build_workload(fake_bale, bot, args.chats, args.players, args.messages, args.mix, args.seed)
+        metrics = run_with_bot(wsb, run_benchmark(wsb, bot, workload, min(args.warmup, len(workload)), args.batch))
+
+    result = {
+        "version": 1,
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "params": params,
+        "metrics": metrics,
+    }
+    print_report(result)
+
+    status = 0
+    if compare_path:
+        with open(compare_path, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"\n📈 مقایسه با {args.compare} ({baseline.get('created_at')})")
+        if baseline.get("params") != params:
+            print("⚠️ پارامترهای بار با baseline یکسان نیست؛ مقایسه معتبر نیست")
+            status = 2
+        elif compare(result, baseline, args.tolerance):
+            print(f"❌ پسرفت بیش از {args.tolerance:.0%}")
+            status = 1
+        else:
+            print("✅ بدون پسرفت")
+
+    if save_path:
+        with open(save_path, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"💾 baseline در {args.save} ذخیره شد")
+    return status
+
+if __name__ == "__main__":
+    sys.exit(main())
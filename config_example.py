@@ -12,7 +12,7 @@ GAME_CONFIG = {
     # حداکثر سطح کشور
     "MAX_COUNTRY_LEVEL": 50,
     
-    # حداکثر تعداد لاگ‌ها
+    # حداکثر تعداد لاگ‌های نگهداری شده (فایل لاگ فعلی و فایل‌های چرخیده روی هم)
     "MAX_LOGS": 10000,
     
     # حداقل قدرت برای حمله
@@ -26,18 +26,96 @@ GAME_CONFIG = {
     
     # شانس موفقیت جاسوسی (درصد)
     "SPY_SUCCESS_BASE": 30,
+    
+    # بررسی سازگاری کش قدرت نظامی با محاسبه مستقیم (فقط برای دیباگ)
+    "DEBUG_POWER_CHECK": False,
+    
+    # tick دوره‌ای تولید تمام بازیکنان با numpy (pip install numpy)
+    "ECONOMY_TICK": False,
+    
+    # تعداد نبردهای شبیه‌سازی شده در /attack preview (بدون numpy: FALLBACK)
+    "BATTLE_PREVIEW_SAMPLES": 20000,
+    "BATTLE_PREVIEW_FALLBACK_SAMPLES": 2000,
+    "BATTLE_PREVIEW_CELLS": 40000,  # سقف نمونه × دسته‌های حاضر؛ ارتش‌های متنوع‌تر نمونه کمتری می‌گیرند
+    "BATTLE_PREVIEW_TIME_LIMIT": 0.005,  # حداکثر زمان شبیه‌سازی هر پیش‌بینی (ثانیه)
+    
+    # نبرد چند مرحله‌ای بین دسته‌های واحدها (ضدهوایی در برابر هوایی، دریایی، دفاعی و ...)
+    "COMBAT_ROUNDS": 3,
+    "COMBAT_LETHALITY": 0.05,  # نسبت قدرت حریف که هر مرحله از بین می‌رود
+    
+    # تعداد نبردهای نگه داشته شده برای هر گروه (/battles)
+    "BATTLE_HISTORY_PER_CHAT": 500,
+    
+    # کش نام اعضای گروه برای رتبه‌بندی و اتحادها
+    "NAME_CACHE_TTL": 600,  # ثانیه
+    "NAME_CACHE_SIZE": 10000,
+    "NAME_FETCH_CONCURRENCY": 8,  # حداکثر درخواست همزمان get_chat_member
 }
 
 # تنظیمات لاگ
 LOG_CONFIG = {
     "ENABLE_FILE_LOGGING": True,
     "LOG_FILE": "war_logs.txt",
-    "LOG_LEVEL": "INFO"
+    "LOG_LEVEL": "INFO",
+    "MAX_BYTES": 10 * 1024 * 1024,  # چرخش فایل لاگ پس از این حجم
+    "ROTATE_INTERVAL": 24 * 3600,  # چرخش فایل لاگ در هر بازه (ثانیه)
+    "BACKUP_COUNT": 5,  # تعداد فایل‌های چرخیده نگهداری شده
+    "BATCH_SIZE": 1000,  # بیدار کردن نویسنده لاگ پس از این تعداد لاگ در صف
+    "MAX_PENDING": 20000  # توقف پردازش پیام‌ها تا نوشتن لاگ‌های عقب‌افتاده
 }
 
 # تنظیمات پایگاه داده
 DATABASE_CONFIG = {
+    "BACKEND": "json",  # json (اسنپ‌شات + WAL) یا sqlite
     "DATA_FILE": "war_data.txt",
+    "SQLITE_FILE": "war_data.db",  # مسیر پایگاه داده در حالت sqlite
+    "BATTLES_FILE": "war_battles.dat",  # تاریخچه نبردها جدا از داده‌های اصلی
     "BACKUP_INTERVAL": 3600,  # ثانیه
-    "MAX_BACKUPS": 5
-}
\ No newline at end of file
+    "MAX_BACKUPS": 5,
+    "FLUSH_INTERVAL": 5,  # ثانیه بین ذخیره‌سازی‌های دسته‌ای
+    "FLUSH_THRESHOLD": 500,  # ذخیره فوری پس از این تعداد رکورد تغییر یافته
+    "WAL_FILE": None,  # پیش‌فرض: DATA_FILE + ".wal"
+    "WAL_MAX_BYTES": 8 * 1024 * 1024,  # حجم WAL پیش از ادغام در اسنپ‌شات
+    "WAL_FSYNC": True,  # fsync پس از هر دسته رکورد
+    "MAX_PENDING_RECORDS": 5000,  # توقف پردازش پیام‌ها تا ذخیره رکوردهای عقب‌افتاده
+    "IO_QUEUE_SIZE": 256  # حداکثر کارهای در صف نخ I/O
+}
+
+# تنظیمات مانیتورینگ (سرور HTTP برای /metrics و /health)
+MONITORING_CONFIG = {
+    "ENABLED": True,
+    "HOST": "0.0.0.0",
+    "METRICS_PORT": 8080,
+    "LOOP_LAG_INTERVAL": 1.0,  # ثانیه بین اندازه‌گیری‌های تاخیر event loop
+    "MAX_LOOP_LAG": 5.0,  # تاخیر بیش از این مقدار (ثانیه) در /health ناسالم گزارش می‌شود
+    "SLOW_COMMAND_THRESHOLD": 0.5  # دستورات کندتر از این مقدار (ثانیه) در لاگ slow_command ثبت می‌شوند
+}
+
+# تنظیمات توزیع پیام‌ها (صف جداگانه برای هر بازیکن در هر گروه)
+DISPATCH_CONFIG = {
+    "MAX_CONCURRENCY": 32,  # حداکثر هندلر همزمان در کل ربات
+    "CHAT_CONCURRENCY": 4,  # حداکثر هندلر همزمان بازیکنان مختلف یک گروه
+    "CHAT_QUEUE_SIZE": 100,  # حداکثر پیام در صف هر گروه
+    "CHATTER_POLICY": "coalesce"  # coalesce: ادغام پیام‌های عادی هر کاربر، drop: حذف در صورت پر بودن صف
+}
+
+# حالت چندفرآیندی: هر گروه با هش سازگار به یکی از فرآیندهای شارد سپرده می‌شود
+SHARD_CONFIG = {
+    "SHARDS": 1,  # بیش از 1 برای فعال شدن (مثلاً تعداد هسته‌های پردازنده)
+    "QUEUE_SIZE": 1000,  # حداکثر پیام در صف هر فرآیند شارد
+    "REPLICAS": 64,  # گره‌های مجازی هر شارد در حلقه هش
+    "CALL_TIMEOUT": 10,  # ثانیه؛ انتظار شارد برای ارسال پاسخ توسط فرآیند اصلی
+    "ALLIANCE_FILE": "war_alliances.json"  # شارد مالک هر نام اتحاد
+}
+
+# صف ارسال پاسخ‌ها با محدودیت نرخ
+OUTBOUND_CONFIG = {
+    "ENABLED": True,
+    "GLOBAL_RATE": 30,  # پیام در ثانیه برای کل ربات (در حالت شارد بین شاردها تقسیم می‌شود)
+    "CHAT_RATE": 1,  # پیام در ثانیه برای هر گروه
+    "CHAT_BURST": 5,  # حداکثر پیام پشت سر هم در یک گروه
+    "MAX_MESSAGE_LENGTH": 4000,  # پاسخ‌های طولانی‌تر در مرز خطوط تقسیم می‌شوند
+    "MAX_RETRIES": 5,
+    "RETRY_BASE": 0.5,  # ثانیه؛ تاخیر تلاش مجدد به صورت نمایی با نوسان تصادفی
+    "CONCURRENCY": 8  # حداکثر درخواست ارسال همزمان
+}
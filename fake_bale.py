@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+کلاینت جعلی بله برای تست و بنچمارک
+Fake Bale client for tests and benchmarks
+
+همان نام‌هایی را که ربات از کتابخانه bale وارد می‌کند (Bot، Message، User، Chat،
+ChatMember و کیبوردها) فراهم می‌کند؛ پاسخ‌ها به جای ارسال به سرور ثبت می‌شوند.
+پیش از وارد کردن war_simulation_bot تابع install را صدا بزنید.
+"""
+
+import asyncio
+import itertools
+import random
+import sys
+from collections import deque
+
+class ChatMember:
+    """عضو گروه"""
+
+    def __init__(self, user, status="member"):
+        self.user = user
+        self.status = status
+
+class User:
+    """کاربر بله"""
+
+    def __init__(self, user_id, first_name="", username=None, is_bot=False):
+        self.user_id = user_id
+        self.first_name = first_name
+        self.username = username
+        self.is_bot = is_bot
+
+class Chat:
+    """گروه یا گفتگوی خصوصی"""
+
+    def __init__(self, id, type="group", title=None):
+        self.id = id
+        self.type = type
+        self.title = title
+
+class InlineKeyboardButton:
+    def __init__(self, text, callback_data=None, url=None):
+        self.text = text
+        self.callback_data = callback_data
+        self.url = url
+
+class InlineKeyboard:
+    def __init__(self, *rows):
+        self.rows = [list(row) for row in rows]
+
+    def add(self, button, row=None):
+        if row is None or row >= len(self.rows):
+            self.rows.append([button])
+        else:
+            self.rows[row].append(button)
+
+class MenuKeyboardButton:
+    def __init__(self, text):
+        self.text = text
+
+class MenuKeyboardMarkup(InlineKeyboard):
+    pass
+
+class SentMessage:
+    """پیام ارسال شده توسط ربات که در تاریخچه Bot ثبت می‌شود"""
+
+    __slots__ = ("chat_id", "message_id", "text", "components", "reply_to_message_id", "deleted")
+
+    def __init__(self, chat_id, message_id, text, components=None, reply_to_message_id=None):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = text
+        self.components = components
+        self.reply_to_message_id = reply_to_message_id
+        self.deleted = False
+
+    async def delete(self):
+        self.deleted = True
+        return True
+
+class Bot:
+    """
+    ربات جعلی: هندلرهای @bot.event را نگه می‌دارد و درخواست‌های API را ثبت می‌کند
+
+    latency تاخیر هر درخواست (ثانیه) و fail_rate احتمال خطای موقت ارسال است تا
+    رفتار شبکه واقعی (محدودیت نرخ، تلاش مجدد) قابل شبیه‌سازی باشد. تنها آخرین
+    history پیام ارسال شده نگه داشته می‌شود تا حافظه در بارهای طولانی ثابت بماند.
+    """
+
+    def __init__(self, token=None, latency=0.0, fail_rate=0.0, history=1000, seed=None):
+        self.token = token
+        self.user = User(0, "War Bot", username="war_bot", is_bot=True)
+        self.handlers = {}
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.sent = deque(maxlen=history)
+        self.sent_count = 0
+        self.failed_count = 0
+        self.deleted_count = 0
+        self.admins = set()  # (chat_id, user_id)
+        self.names = {}  # user_id -> first_name
+        self._ids = itertools.count(1)
+        self._random = random.Random(seed)
+
+    def event(self, handler):
+        self.handlers[handler.__name__] = handler
+        return handler
+
+    def run(self):
+        """اجرای on_ready؛ پیام‌ها توسط بنچمارک یا تست به emit داده می‌شوند"""
+        if "on_ready" in self.handlers:
+            asyncio.run(self.handlers["on_ready"]())
+
+    def next_message_id(self):
+        return next(self._ids)
+
+    async def _request(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.fail_rate and self._random.random() < self.fail_rate:
+            self.failed_count += 1
+            raise ConnectionError("Too Many Requests")
+
+    async def emit(self, message):
+        """تحویل یک پیام ورودی به هندلر on_message"""
+        await self.handlers["on_message"](message)
+
+    async def send_message(self, chat_id, text, components=None, reply_to_message_id=None):
+        await self._request()
+        sent = SentMessage(chat_id, self.next_message_id(), text, components, reply_to_message_id)
+        self.sent.append(sent)
+        self.sent_count += 1
+        return sent
+
+    async def delete_message(self, chat_id, message_id):
+        await self._request()
+        self.deleted_count += 1
+        return True
+
+    async def get_chat_member(self, chat_id, user_id):
+        await self._request()
+        status = "administrator" if (chat_id, user_id) in self.admins else "member"
+        return ChatMember(User(user_id, self.names.get(user_id, f"بازیکن {user_id}")), status)
+
+class Message:
+    """پیام ورودی؛ پاسخ‌ها در replies ثبت و در صورت وجود bot از طریق آن ارسال می‌شوند"""
+
+    def __init__(self, content="", chat=None, author=None, reply_to_message=None, bot=None, message_id=None):
+        self.content = content
+        self.chat = chat
+        self.author = author
+        self.reply_to_message = reply_to_message
+        self.bot = bot
+        self.message_id = message_id if message_id is not None else (bot.next_message_id() if bot else 0)
+        self.replies = []
+        self.deleted = False
+
+    async def reply(self, text, components=None):
+        self.replies.append(text)
+        if self.bot is None:
+            return SentMessage(self.chat.id, 0, text, components, self.message_id)
+        return await self.bot.send_message(self.chat.id, text, components=components,
+                                           reply_to_message_id=self.message_id)
+
+    async def delete(self):
+        self.deleted = True
+        if self.bot is not None:
+            await self.bot.delete_message(self.chat.id, self.message_id)
+        return True
+
+def install(force=False):
+    """ثبت این ماژول به جای bale؛ اگر کتابخانه واقعی نصب باشد فقط با force جایگزین می‌شود"""
+    module = sys.modules[__name__]
+    if not force:
+        try:
+            import bale  # noqa: F401
+            return sys.modules["bale"]
+        except ImportError:
+            pass
+    sys.modules["bale"] = module
+    return module
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+بازپخش ترافیک واقعی از لاگ‌های ربات
+Replay recorded traffic from war_logs.txt
+
+خطوط message (و reply_to) فایل لاگ با کلاینت جعلی بله دوباره به on_message داده
+می‌شوند؛ با سرعت ثبت شده (--speed 1)، سریع‌تر (--speed 10) یا بدون انتظار
+(--speed 0). تاخیر هر دستور و خلاصه (digest) وضعیت نهایی بازی گزارش می‌شود تا
+پسرفت‌های کارایی با شکل ترافیک پرمشغله‌ترین گروه‌ها بیرون از سرور بازتولید شوند.
+
+    python replay.py war_logs.txt --top 5 --speed 20
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import time
+from collections import Counter
+from datetime import datetime
+
+import benchmark
+
+# فیلدهای وابسته به زمان اجرا که در digest وضعیت نادیده گرفته می‌شوند
+VOLATILE_FIELDS = frozenset({"accrued_at", "last_active", "last_collection", "created_at", "conquest_time", "rate_cache"})
+
+class LogEntry:
+    """یک پیام ورودی ثبت شده در لاگ"""
+
+    __slots__ = ("timestamp", "chat_id", "user_id", "text", "reply_to")
+
+    def __init__(self, timestamp, chat_id, user_id, text):
+        self.timestamp = timestamp
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.text = text
+        self.reply_to = None
+
+def unescape(content):
+    """عکس escape در LogSink.format_line"""
+    if "\\" not in content:
+        return content
+    chars = []
+    index = 0
+    while index < len(content):
+        char = content[index]
+        if char == "\\" and index + 1 < len(content):
+            following = content[index + 1]
+            chars.append("\n" if following == "n" else following)
+            index += 2
+        else:
+            chars.append(char)
+            index += 1
+    return "".join(chars)
+
+def parse_line(line):
+    """تبدیل خط لاگ به (timestamp، chat_id، user_id، نوع، محتوا)؛ خطوط نامعتبر None"""
+    parts = line.rstrip("\n").split(" | ", 4)
+    if len(parts) != 5:
+        return None
+    timestamp, chat_id, user_id, message_type, content = parts
+    try:
+        return datetime.fromisoformat(timestamp).timestamp(), chat_id, user_id, message_type, unescape(content)
+    except ValueError:
+        return None
+
+def log_files(path):
+    """فایل لاگ و نسخه‌های چرخانده شده آن از قدیمی به جدید"""
+    backups = []
+    index = 1
+    while os.path.exists(f"{path}.{index}"):
+        backups.append(f"{path}.{index}")
+        index += 1
+    files = list(reversed(backups))
+    if os.path.exists(path):
+        files.append(path)
+    return files
+
+def read_entries(paths):
+    """خواندن پیام‌های ورودی؛ خط reply_to به آخرین پیام همان کاربر در همان گروه متصل می‌شود"""
+    entries = []
+    last = {}
+    for path in paths:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            for line in f:
+                parsed = parse_line(line)
+                if parsed is None:
+                    continue
+                timestamp, chat_id, user_id, message_type, content = parsed
+                if message_type not in ("message", "reply_to"):
+                    continue
+                try:
+                    key = (int(chat_id), int(user_id))
+                except ValueError:
+                    continue
+                if message_type == "message":
+                    entry = last[key] = LogEntry(timestamp, key[0], key[1], content)
+                    entries.append(entry)
+                elif key in last:
+                    try:
+                        last[key].reply_to = int(content)
+                    except ValueError:
+                        pass
+    entries.sort(key=lambda entry: entry.timestamp)
+    return entries
+
+def select_chats(entries, top=None, chats=None):
+    """محدود کردن به گروه‌های مشخص یا top پرپیام‌ترین گروه‌ها"""
+    wanted = set(chats or [])
+    if top:
+        wanted.update(chat_id for chat_id, _ in Counter(entry.chat_id for entry in entries).most_common(top))
+    if not wanted:
+        return entries
+    return [entry for entry in entries if entry.chat_id in wanted]
+
+def strip_volatile(value):
+    if isinstance(value, dict):
+        return {key: strip_volatile(item) for key, item in value.items() if key not in VOLATILE_FIELDS}
+    if isinstance(value, list):
+        return [strip_volatile(item) for item in value]
+    return value
+
+def state_digest(data):
+    """sha256 وضعیت بازی بدون فیلدهای وابسته به زمان"""
+    canonical = json.dumps(strip_volatile(data), sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+def label_for(wsb, text):
+    """برچسب دستور همانند متریک‌های ربات"""
+    if text.startswith("/"):
+        return wsb.command_label(text)
+    if text in wsb.router.buttons:
+        return wsb.menu_label(text)
+    return "chatter"
+
+async def replay(wsb, entries, speed, batch):
+    """ارسال پیام‌ها با فاصله زمانی ثبت شده تقسیم بر speed (0: بدون انتظار)"""
+    bale = sys.modules["bale"]
+    bot = wsb.bot
+    recorder = benchmark.LatencyRecorder(wsb)
+    chats = {}
+    users = {}
+
+    def user(user_id):
+        if user_id not in users:
+            users[user_id] = bale.User(user_id, bot.names.setdefault(user_id, f"بازیکن {user_id}"))
+        return users[user_id]
+
+    behind = 0.0  # بیشترین عقب‌ماندگی از زمان‌بندی ثبت شده
+    origin = entries[0].timestamp if entries else 0.0
+    started = time.perf_counter()
+    for index, entry in enumerate(entries):
+        if speed:
+            delay = (entry.timestamp - origin) / speed - (time.perf_counter() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                behind = max(behind, -delay)
+        elif index and index % batch == 0:
+            await wsb.dispatcher.drain()
+        chat = chats.get(entry.chat_id)
+        if chat is None:
+            chat = chats[entry.chat_id] = bale.Chat(entry.chat_id)
+        reply_to = None
+        if entry.reply_to is not None:
+            reply_to = bale.Message("", chat, user(entry.reply_to), bot=bot)
+        message = bale.Message(entry.text, chat, user(entry.user_id), reply_to_message=reply_to, bot=bot)
+        recorder.submit(message, label_for(wsb, entry.text))
+        await bot.emit(message)
+    await wsb.dispatcher.drain()
+    await wsb.outbox.drain()
+    elapsed = time.perf_counter() - started
+
+    latencies = recorder.latencies()
+    overall = benchmark.summarize(latencies)
+    return {
+        "messages": len(entries),
+        "handled": len(latencies),
+        "chats": len(chats),
+        "players": len(users),
+        "replies": bot.sent_count,
+        "recorded_sec": round(entries[-1].timestamp - origin, 3) if entries else 0.0,
+        "elapsed_sec": round(elapsed, 3),
+        "messages_per_sec": round(len(entries) / elapsed, 1) if elapsed else 0.0,
+        "max_behind_sec": round(behind, 3),
+        "p50_ms": overall["p50_ms"],
+        "p95_ms": overall["p95_ms"],
+        "p99_ms": overall["p99_ms"],
+        "commands": recorder.by_label(),
+        "digest": state_digest(wsb.game_data),
+    }
+
+def print_report(result):
+    print("📼 نتیجه بازپخش")
+    print(f"  پیام‌ها: {result['messages']} از {result['chats']} گروه و {result['players']} بازیکن "
+          f"(پردازش شده: {result['handled']}، پاسخ: {result['replies']})")
+    print(f"  زمان: {result['elapsed_sec']} ثانیه (ثبت شده: {result['recorded_sec']}) — "
+          f"{result['messages_per_sec']} پیام در ثانیه، بیشترین عقب‌ماندگی {result['max_behind_sec']} ثانیه")
+    print(f"  تاخیر: p50={result['p50_ms']}ms p95={result['p95_ms']}ms p99={result['p99_ms']}ms")
+    for label, stats in sorted(result["commands"].items(), key=lambda item: -item[1]["p99_ms"]):
+        print(f"    {label:<16} {stats['count']:>7}  p50={stats['p50_ms']}ms p95={stats['p95_ms']}ms p99={stats['p99_ms']}ms")
+    print(f"  digest وضعیت نهایی: {result['digest']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="بازپخش ترافیک ثبت شده در لاگ ربات جنگ با کلاینت جعلی بله")
+    parser.add_argument("logs", nargs="*", default=["war_logs.txt"], help="فایل‌های لاگ (نسخه‌های چرخانده شده خودکار اضافه می‌شوند)")
+    parser.add_argument("--speed", type=float, default=0.0, help="ضریب سرعت نسبت به زمان ثبت شده؛ 0 بدون انتظار")
+    parser.add_argument("--top", type=int, help="فقط پرپیام‌ترین گروه‌ها")
+    parser.add_argument("--chat", type=int, action="append", help="فقط این گروه (قابل تکرار)")
+    parser.add_argument("--limit", type=int, help="حداکثر تعداد پیام")
+    parser.add_argument("--batch", type=int, default=500, help="در حالت بدون انتظار، تخلیه صف‌ها پس از هر batch پیام")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.0, help="تاخیر شبیه‌سازی شده هر درخواست API (ثانیه)")
+    parser.add_argument("--json", metavar="FILE", help="ذخیره نتیجه به صورت JSON")
+    args = parser.parse_args()
+
+    paths = []
+    for path in args.logs:
+        found = log_files(os.path.abspath(path))
+        if not found:
+            print(f"❌ فایل لاگ {path} یافت نشد!")
+            return 1
+        paths.extend(found)
+    entries = select_chats(read_entries(paths), args.top, args.chat)[:args.limit]
+    if not entries:
+        print("❌ پیامی برای بازپخش یافت نشد!")
+        return 1
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    # بازپخش روی داده خالی در پوشه موقت انجام می‌شود
+    benchmark.enter_scratch_directory()
+    wsb = benchmark.load_bot(args.seed, args.latency)
+    result = benchmark.run_with_bot(wsb, replay(wsb, entries, args.speed, args.batch))
+    result["params"] = {"logs": args.logs, "speed": args.speed, "top": args.top, "chat": args.chat,
+                        "limit": args.limit, "seed": args.seed, "latency": args.latency}
+    print_report(result)
+
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"💾 نتیجه در {json_path} ذخیره شد")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -126,6 +126,1499 @@ def test_user_data_structure():
     
     print("✅ تست ساختار داده کاربر موفق!")
 
+def test_persistence_flush():
+    """تست ذخیره‌سازی دسته‌ای"""
+    print("🧪 تست ذخیره‌سازی دسته‌ای...")
+    
+    import asyncio
+    import war_simulation_bot as wsb
+    
+    original_file = wsb.DATA_FILE
+    wsb.DATA_FILE = "test_data.txt"
+    try:
+        wsb.load_data()
+        assert wsb.persistence.pending() == 0
+        
+        # علامت‌گذاری بدون نوشتن در فایل
+        user_data = wsb.get_user_data("test_chat", "test_user")
+        user_data["resources"]["money"] += 1
+        wsb.mark_user_dirty("test_chat", "test_user")
+        assert wsb.persistence.pending() == 1, "رکوردهای تکراری باید یکی شوند"
+        assert not os.path.exists("test_data.txt")
+        
+        # ذخیره دسته‌ای
+        assert wsb.persistence.flush()
+        assert wsb.persistence.pending() == 0
+        assert not wsb.persistence.flush(), "بدون تغییر نباید فایل نوشته شود"
+        
+        # لغو ذخیره در حال اجرا (خاموش شدن) رکوردها را از دست نمی‌دهد
+        async def hanging_write(*args):
+            await asyncio.sleep(10)
+        
+        async def cancel_flush():
+            task = asyncio.ensure_future(wsb.persistence.flush_async())
+            await asyncio.sleep(0)
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        
+        user_data["resources"]["money"] += 1
+        wsb.mark_user_dirty("test_chat", "test_user")
+        original_run = wsb.io_executor.run
+        wsb.io_executor.run = hanging_write
+        try:
+            asyncio.run(cancel_flush())
+        finally:
+            wsb.io_executor.run = original_run
+        assert wsb.persistence.pending() == 1
+        assert wsb.persistence.flush()
+        
+        wsb.load_data()
+        assert wsb.game_data["users"]["test_chat:test_user"]["resources"]["money"] == 1002
+    finally:
+        wsb.DATA_FILE = original_file
+        for path in ("test_data.txt", "test_data.txt.wal"):
+            if os.path.exists(path):
+                os.remove(path)
+    
+    print("✅ تست ذخیره‌سازی دسته‌ای موفق!")
+
+def test_wal_recovery():
+    """تست بازیابی از اسنپ‌شات و WAL"""
+    print("🧪 تست بازیابی WAL...")
+    
+    import war_simulation_bot as wsb
+    
+    original_file = wsb.DATA_FILE
+    wsb.DATA_FILE = "test_data.txt"
+    try:
+        wsb.load_data()
+        wsb.get_user_data("test_chat", "u1")["level"] = 5
+        wsb.persistence.flush()
+        
+        # ادغام WAL در اسنپ‌شات
+        assert wsb.wal.compact()
+        assert wsb.wal.size() == 0
+        
+        wsb.get_user_data("test_chat", "u1")["level"] = 7
+        wsb.mark_user_dirty("test_chat", "u1")
+        wsb.game_data["alliances"]["test_alliance"] = {"leader": "u1", "members": ["u1"]}
+        wsb.mark_alliance_dirty("test_alliance")
+        wsb.persistence.flush()
+        del wsb.game_data["alliances"]["test_alliance"]
+        wsb.mark_alliance_dirty("test_alliance")
+        wsb.persistence.flush()
+        
+        # شبیه‌سازی قطع ناگهانی در میانه نوشتن
+        with open(wsb.wal.path, 'a', encoding='utf-8') as f:
+            f.write('{"t":"u","k":"test_chat:u1","v":{"lev')
+        
+        wsb.load_data()
+        assert wsb.game_data["users"]["test_chat:u1"]["level"] == 7
+        assert "test_alliance" not in wsb.game_data["alliances"]
+        
+        # رکوردهای بعد از خط ناقص نباید از بین بروند
+        wsb.get_user_data("test_chat", "u1")["level"] = 8
+        wsb.mark_user_dirty("test_chat", "u1")
+        wsb.persistence.flush()
+        wsb.load_data()
+        assert wsb.game_data["users"]["test_chat:u1"]["level"] == 8
+    finally:
+        wsb.DATA_FILE = original_file
+        for path in ("test_data.txt", "test_data.txt.wal"):
+            if os.path.exists(path):
+                os.remove(path)
+    
+    print("✅ تست بازیابی WAL موفق!")
+
+def test_sqlite_repository():
+    """تست مخزن SQLite"""
+    print("🧪 تست مخزن SQLite...")
+    
+    import war_simulation_bot as wsb
+    
+    original_repository = wsb.repository
+    wsb.repository = wsb.SQLiteRepository("test_data.db")
+    try:
+        wsb.load_data()
+        user_data = wsb.get_user_data("test_chat", "u1")
+        user_data["military"]["soldier"] = 10
+        wsb.get_country_data("test_chat", "u1")
+        wsb.create_alliance("test_alliance", {"leader": "u1", "members": ["u1"], "total_power": 50})
+        wsb.persistence.flush()
+        
+        # به‌روزرسانی سطری و حذف
+        user_data["level"] = 4
+        wsb.mark_user_dirty("test_chat", "u1")
+        wsb.delete_alliance("test_alliance")
+        wsb.persistence.flush()
+        
+        conn = wsb.repository.conn
+        assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        assert conn.execute("SELECT level, power FROM users WHERE chat_id = 'test_chat'").fetchall() == [(4, 50)]
+        assert conn.execute("SELECT COUNT(*) FROM alliance_members").fetchone()[0] == 0
+        
+        wsb.repository.close()
+        wsb.load_data()
+        assert wsb.game_data["users"]["test_chat:u1"]["level"] == 4
+        assert "test_chat:u1" in wsb.game_data["countries"]
+        assert wsb.get_alliance("test_alliance") is None
+    finally:
+        wsb.repository.close()
+        wsb.repository = original_repository
+        for path in ("test_data.db", "test_data.db-wal", "test_data.db-shm"):
+            if os.path.exists(path):
+                os.remove(path)
+    
+    print("✅ تست مخزن SQLite موفق!")
+
+def test_leaderboard_index():
+    """تست ایندکس رتبه‌بندی"""
+    print("🧪 تست ایندکس رتبه‌بندی...")
+    
+    import war_simulation_bot as wsb
+    
+    wsb.install_state(wsb.empty_game_data())
+    for user_id, soldiers in (("u1", 10), ("u2", 30), ("u3", 20)):
+        user_data = wsb.get_user_data("chat_a", user_id)
+        user_data["military"]["soldier"] = soldiers
+        wsb.invalidate_power(user_data)
+        wsb.mark_user_dirty("chat_a", user_id)
+    user_data = wsb.get_user_data("chat_b", "u9")
+    user_data["military"]["soldier"] = 100
+    wsb.invalidate_power(user_data)
+    wsb.mark_user_dirty("chat_b", "u9")
+    
+    board = wsb.leaderboard_index.chat("chat_a")
+    assert [user_id for user_id, _ in board.top("power", 10)] == ["u2", "u3", "u1"]
+    assert board.rank("u1", "power") == 3
+    
+    # به‌روزرسانی پس از خرید
+    user_data = wsb.get_user_data("chat_a", "u1")
+    user_data["military"]["soldier"] = 50
+    wsb.invalidate_power(user_data)
+    wsb.mark_user_dirty("chat_a", "u1")
+    assert board.rank("u1", "power") == 1
+    
+    # رتبه‌بندی بر اساس برد
+    wsb.get_user_data("chat_a", "u3")["battles_won"] = 4
+    wsb.mark_user_dirty("chat_a", "u3")
+    assert board.top("battles_won", 1)[0][0] == "u3"
+    assert len(wsb.leaderboard_index.chat("chat_b")) == 1
+    
+    # لیست مرتب بلوکی با بلوک‌های کوچک (تقسیم و ادغام مکرر) با لیست عادی مقایسه می‌شود
+    import bisect
+    import random
+    rng = random.Random(7)
+    ranked = wsb.RankedList(load=4)
+    reference = []
+    for step in range(3000):
+        if reference and rng.random() < 0.45:
+            item = rng.choice(reference)
+            reference.remove(item)
+            ranked.remove(item)
+        else:
+            item = (rng.randint(0, 200), str(step))
+            bisect.insort(reference, item)
+            ranked.add(item)
+        if step % 50 == 0:
+            assert list(ranked) == reference and len(ranked) == len(reference)
+            for item in reference[::7]:
+                assert ranked.index(item) == bisect.bisect_left(reference, item)
+            assert ranked.head(3) == reference[:3]
+    assert ranked.index((999, "")) == len(reference)
+    
+    wsb.install_state(wsb.empty_game_data())
+    print("✅ تست ایندکس رتبه‌بندی موفق!")
+
+def test_power_cache():
+    """تست کش قدرت نظامی"""
+    print("🧪 تست کش قدرت نظامی...")
+    
+    import war_simulation_bot as wsb
+    
+    wsb.install_state(wsb.empty_game_data())
+    user_data = wsb.get_user_data("chat_a", "u1")
+    user_data["military"]["soldier"] = 10
+    power = wsb.calculate_total_power(user_data)
+    assert power == wsb.compute_total_power(user_data)
+    assert user_data["power_cache"] == power
+    
+    # بدون invalidate مقدار کش شده برگردانده می‌شود
+    user_data["military"]["soldier"] = 20
+    assert wsb.calculate_total_power(user_data) == power
+    assert wsb.verify_power_caches() == ["chat_a:u1"]
+    assert user_data["power_cache"] == wsb.compute_total_power(user_data)
+    
+    # ارتقای آکادمی نظامی
+    user_data["capital"]["military_academy"] = 2
+    wsb.invalidate_power(user_data)
+    assert wsb.calculate_total_power(user_data) == wsb.compute_total_power(user_data)
+    assert wsb.verify_power_caches() == []
+    
+    wsb.install_state(wsb.empty_game_data())
+    print("✅ تست کش قدرت نظامی موفق!")
+
+def test_name_resolver():
+    """تست کش نام اعضا"""
+    print("🧪 تست کش نام اعضا...")
+    
+    import asyncio
+    from types import SimpleNamespace
+    import war_simulation_bot as wsb
+    
+    requested = []
+    
+    async def get_chat_member(chat_id, user_id):
+        requested.append(user_id)
+        if user_id == 99:
+            raise ValueError("member not found")
+        return SimpleNamespace(user=SimpleNamespace(user_id=user_id, first_name=f"name{user_id}"))
+    
+    original_bot = wsb.bot
+    wsb.bot = SimpleNamespace(get_chat_member=get_chat_member)
+    try:
+        resolver = wsb.NameResolver(ttl=60, max_size=2, concurrency=2)
+        resolver.remember_user("chat_a", SimpleNamespace(user_id=1, first_name="Ali"))
+        
+        names = asyncio.run(resolver.resolve_many("chat_a", [1, 2, 99]))
+        assert names == {"1": "Ali", "2": "name2", "99": "User 99"}
+        assert sorted(requested) == [2, 99]
+        assert resolver.hits == 1 and resolver.misses == 2 and resolver.errors == 1
+        
+        # کاربر 1 به دلیل LRU حذف شده و کاربر 2 از کش خوانده می‌شود
+        resolver.remember("chat_a", 3, "Sara")
+        assert resolver.lookup("chat_a", 1) is None
+        assert asyncio.run(resolver.resolve("chat_a", 2)) == "name2"
+        assert requested.count(2) == 1
+        
+        # انقضای TTL
+        resolver.ttl = -1
+        resolver.remember("chat_a", 4, "Reza")
+        assert resolver.lookup("chat_a", 4) is None
+    finally:
+        wsb.bot = original_bot
+    
+    print("✅ تست کش نام اعضا موفق!")
+
+def test_monitoring():
+    """تست متریک‌ها و سرور مانیتورینگ"""
+    print("🧪 تست مانیتورینگ...")
+    
+    import asyncio
+    import war_simulation_bot as wsb
+    
+    registry = wsb.MetricsRegistry()
+    latency = registry.histogram("test_latency_seconds", "Test latency", ("command",), buckets=(0.1, 1.0))
+    latency.observe(0.05, "/status")
+    latency.observe(0.5, "/status")
+    latency.observe(5, "/status")
+    counter = registry.counter("test_events", "Test events")
+    counter.inc(3)
+    text = registry.render()
+    assert 'test_latency_seconds_bucket{command="/status",le="0.1"} 1.0' in text
+    assert 'test_latency_seconds_bucket{command="/status",le="1.0"} 2.0' in text
+    assert 'test_latency_seconds_bucket{command="/status",le="+Inf"} 3.0' in text
+    assert 'test_latency_seconds_count{command="/status"} 3.0' in text
+    assert "test_events_total 3.0" in text
+    assert wsb.command_label("/buy soldier 5") == "/buy"
+    assert wsb.command_label("/unknown") == "other"
+    
+    async def request(port, path):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+        response = await reader.read()
+        writer.close()
+        return response.decode("utf-8")
+    
+    async def scenario():
+        server = wsb.MonitoringServer("127.0.0.1", 0, lag_interval=0.01)
+        await server.start()
+        port = server._server.sockets[0].getsockname()[1]
+        try:
+            metrics_response = await request(port, "/metrics")
+            assert metrics_response.startswith("HTTP/1.1 200")
+            assert "war_bot_players" in metrics_response
+            # ربات هنوز آماده نیست و حلقه‌های ذخیره‌سازی اجرا نشده‌اند
+            health_response = await request(port, "/health")
+            assert health_response.startswith("HTTP/1.1 503")
+            assert (await request(port, "/missing")).startswith("HTTP/1.1 404")
+        finally:
+            server.close()
+    
+    asyncio.run(scenario())
+    print("✅ تست مانیتورینگ موفق!")
+
+def test_command_tracing():
+    """تست ردیابی زمان دستورات و لاگ دستورات کند"""
+    print("🧪 تست ردیابی دستورات...")
+    
+    import asyncio
+    import json
+    from types import SimpleNamespace
+    import war_simulation_bot as wsb
+    
+    replies = []
+    
+    async def reply(text, *args, **kwargs):
+        await asyncio.sleep(0.01)
+        replies.append(text)
+    
+    entries = []
+    original_log, original_threshold = wsb.log_message, wsb.SLOW_COMMAND_THRESHOLD
+    wsb.log_message = lambda chat_id, user_id, action, content: entries.append((action, content))
+    wsb.SLOW_COMMAND_THRESHOLD = 0.005
+    try:
+        wsb.install_state(wsb.empty_game_data())
+        message = SimpleNamespace(content="/status", reply=reply)
+        count = wsb.command_latency.count("/status")
+        asyncio.run(wsb.handle_command(message, "/status", "chat_t", "u1"))
+        
+        assert replies, "دستور باید پاسخ دهد"
+        assert wsb.command_latency.count("/status") == count + 1
+        action, content = entries[-1]
+        assert action == "slow_command"
+        entry = json.loads(content)
+        assert entry["command"] == "/status" and entry["chat_size"] == 1
+        assert entry["network_ms"] >= 10 and entry["wall_ms"] >= entry["network_ms"]
+        assert wsb.current_trace.get() is None
+        
+        # ارسال از صف و نوشتن WAL پس از پایان هندلر به همان دستور نسبت داده می‌شود
+        async def queued_reply(text, *args, **kwargs):
+            await asyncio.sleep(0.02)
+            replies.append(text)
+        
+        async def slow_write(*args):
+            await asyncio.sleep(0.03)
+        
+        async def deferred():
+            wsb.outbox.start()
+            wsb.persistence.start()
+            try:
+                message = SimpleNamespace(content="/status", reply=queued_reply, chat=SimpleNamespace(id="chat_q"))
+                await wsb.handle_command(message, "/status", "chat_q", "u1")
+                assert not any('"chat_q"' in content for _, content in entries), "ثبت تا پایان ارسال و ذخیره منتظر می‌ماند"
+                wsb.persistence.wake()
+                for _ in range(200):
+                    if any('"chat_q"' in content for _, content in entries):
+                        break
+                    await asyncio.sleep(0.01)
+            finally:
+                wsb.outbox.close()
+                wsb.persistence.close()
+        
+        entries.clear()
+        wsb.SLOW_COMMAND_THRESHOLD = 0
+        original_run, original_save = wsb.io_executor.run, wsb.save_data
+        wsb.io_executor.run, wsb.save_data = slow_write, lambda: None
+        try:
+            asyncio.run(deferred())
+        finally:
+            wsb.io_executor.run, wsb.save_data = original_run, original_save
+        entry = json.loads(entries[-1][1])
+        assert entry["chat_id"] == "chat_q"
+        assert entry["network_ms"] >= 20 and entry["persistence_ms"] >= 30
+        assert wsb.persistence.pending() == 0 and not wsb.persistence.traces
+    finally:
+        wsb.log_message, wsb.SLOW_COMMAND_THRESHOLD = original_log, original_threshold
+        wsb.install_state(wsb.empty_game_data())
+    
+    print("✅ تست ردیابی دستورات موفق!")
+
+def test_command_router():
+    """تست مسیریاب دستورات"""
+    print("🧪 تست مسیریاب دستورات...")
+    
+    import war_simulation_bot as wsb
+    
+    route, tokens = wsb.router.resolve("/BUY@war_bot Soldier 5")
+    assert route.handler is wsb.buy_command
+    assert route.schema.parse(tokens) == ["soldier", 5]
+    assert route.schema.parse(["tank"]) == ["tank", 1]
+    
+    route, tokens = wsb.router.resolve("/alliance create Iron Pact")
+    assert route.label == "/alliance create"
+    assert route.schema.parse(tokens) == ["Iron Pact"]
+    
+    route, tokens = wsb.router.resolve("/leaderboard wins")
+    assert route.schema.parse(tokens) == ["battles_won"]
+    
+    for bad_tokens in (["soldier", "x"], []):
+        try:
+            wsb.router.resolve("/buy")[0].schema.parse(bad_tokens)
+            assert False, "آرگومان نامعتبر باید رد شود"
+        except wsb.ArgumentError:
+            pass
+    
+    assert wsb.router.resolve("/unknown")[0] is None
+    assert wsb.command_label("/alliance kick") == "/alliance kick"
+    assert wsb.router.buttons["💰 وضعیت"] is wsb.status_command
+    assert len(wsb.router.buttons) == 9
+    
+    print("✅ تست مسیریاب دستورات موفق!")
+
+def test_resource_accrual():
+    """تست تسویه درآمد بر اساس زمان"""
+    print("🧪 تست تسویه درآمد...")
+    
+    from datetime import timedelta
+    import war_simulation_bot as wsb
+    
+    wsb.install_state(wsb.empty_game_data())
+    user_data = wsb.get_user_data("chat_a", "u1")
+    interval = wsb.PRODUCTION_INTERVAL
+    now = user_data["accrued_at"] + 2 * interval + 30
+    money = user_data["resources"]["money"]
+    
+    cycles, income = wsb.accrue_resources(user_data, now)
+    assert cycles == 2
+    assert income["money"] == int(2 * wsb.production_vector(user_data)[wsb.RESOURCE_ORDER.index("money")])
+    assert user_data["resources"]["money"] == money + income["money"]
+    # باقیمانده چرخه ناقص حفظ می‌شود
+    assert now - user_data["accrued_at"] == 30
+    assert wsb.accrue_resources(user_data, now) == (0, {})
+    
+    # رکورد قدیمی بدون accrued_at
+    old_user = wsb.get_user_data("chat_a", "u2")
+    del old_user["accrued_at"]
+    old_user["last_active"] = (datetime.now() - timedelta(days=2)).isoformat()
+    cycles, _ = wsb.accrue_resources(old_user)
+    assert cycles == int(2 * 24 * 3600 // interval)
+    
+    wsb.install_state(wsb.empty_game_data())
+    print("✅ تست تسویه درآمد موفق!")
+
+def test_production_engine():
+    """تست بردار تولید کالکتورها و سیستم مدیریت"""
+    print("🧪 تست موتور تولید...")
+    
+    import war_simulation_bot as wsb
+    
+    wsb.install_state(wsb.empty_game_data())
+    user_data = wsb.get_user_data("chat_a", "u1")
+    money = wsb.RESOURCE_ORDER.index("money")
+    
+    base = wsb.production_vector(user_data)
+    assert user_data["rate_cache"] is base
+    # دموکراسی: 20% بونوس تمام منابع
+    assert abs(base[money] - 10 * 1.2) < 1e-9
+    
+    # بدون invalidate مقدار کش شده استفاده می‌شود
+    user_data["collectors"]["money_collector"] = 3
+    assert wsb.production_vector(user_data) is base
+    wsb.invalidate_production(user_data)
+    per_cycle = 3 * 100 * wsb.PRODUCTION_INTERVAL / 3600
+    assert abs(wsb.production_vector(user_data)[money] - (10 + per_cycle) * 1.2) < 1e-9
+    
+    # کمونیسم: بونوس منابع، بونوس کالکتور و جریمه پول
+    user_data["government"] = "communism"
+    wsb.invalidate_production(user_data)
+    expected = (10 + per_cycle * 1.4) * 1.5 * 0.7
+    assert abs(wsb.production_vector(user_data)[money] - expected) < 1e-9
+    assert wsb.production_vector(user_data) == wsb.compute_production_vector(user_data)
+    
+    wsb.install_state(wsb.empty_game_data())
+    print("✅ تست موتور تولید موفق!")
+
+def test_log_sink():
+    """تست صف لاگ و چرخش فایل"""
+    print("🧪 تست صف لاگ...")
+    
+    from war_simulation_bot import LogSink, game_data
+    
+    assert "logs" not in game_data, "لاگ‌ها نباید در داده‌های اصلی ذخیره شوند"
+    
+    sink = LogSink("test_logs.txt", max_bytes=200, rotate_interval=0, backup_count=2)
+    try:
+        for i in range(10):
+            sink.emit("chat", "user", "message", f"line {i}\nsecond")
+        assert sink.rotations > 0
+        assert os.path.exists("test_logs.txt.1") and os.path.exists("test_logs.txt.2")
+        assert not os.path.exists("test_logs.txt.3")
+        
+        with open("test_logs.txt", 'r', encoding='utf-8') as f:
+            last_line = f.readlines()[-1]
+        assert last_line.endswith("| chat | user | message | line 9\\nsecond\n")
+        
+        # نگهداری با MAX_LOGS: فایل فعلی و دو فایل چرخیده روی هم حداکثر 6 لاگ
+        for path in ("test_logs.txt", "test_logs.txt.1", "test_logs.txt.2"):
+            os.remove(path)
+        sink = LogSink("test_logs.txt", max_bytes=10 ** 6, rotate_interval=0, backup_count=2, max_logs=6)
+        assert sink.max_lines == 2
+        for i in range(5):
+            sink.emit("chat", "user", "message", f"single {i}")
+        # دسته بزرگ‌تر از سهم هر فایل بین فایل‌ها تقسیم می‌شود
+        for i in range(5):
+            sink.pending.append(("t", "chat", "user", "message", f"batch {i}"))
+        assert sink.flush() == 5
+        kept = []
+        for path in ("test_logs.txt.2", "test_logs.txt.1", "test_logs.txt"):
+            with open(path, 'r', encoding='utf-8') as f:
+                lines = f.readlines()
+            assert len(lines) <= 2
+            kept.extend(line.rsplit("| ", 1)[1].strip() for line in lines)
+        assert kept == ["single 4", "batch 0", "batch 1", "batch 2", "batch 3", "batch 4"]
+        
+        # شمارش لاگ‌های فایل موجود پس از راه‌اندازی مجدد
+        restarted = LogSink("test_logs.txt", max_bytes=10 ** 6, rotate_interval=0, backup_count=2, max_logs=6)
+        restarted.emit("chat", "user", "message", "after restart")
+        with open("test_logs.txt", 'r', encoding='utf-8') as f:
+            assert f.read().count("\n") == 1
+    finally:
+        for path in ("test_logs.txt", "test_logs.txt.1", "test_logs.txt.2"):
+            if os.path.exists(path):
+                os.remove(path)
+    
+    print("✅ تست صف لاگ موفق!")
+
+def test_economy_store():
+    """تست tick برداری اقتصاد"""
+    print("🧪 تست اقتصاد برداری...")
+    
+    import copy
+    import war_simulation_bot as wsb
+    
+    if not wsb.EconomyStore.available():
+        print("⏭️ numpy نصب نیست؛ تست رد شد")
+        return
+    
+    wsb.install_state(wsb.empty_game_data())
+    for i in range(40):
+        user_data = wsb.get_user_data("chat_a", f"u{i}")
+        collector = list(wsb.RESOURCE_COLLECTORS)[i % len(wsb.RESOURCE_COLLECTORS)]
+        user_data["collectors"][collector] = i % 5
+        user_data["accrued_at"] -= (i % 7) * wsb.PRODUCTION_INTERVAL + 10
+        wsb.invalidate_production(user_data)
+        wsb.mark_user_dirty("chat_a", f"u{i}")
+    
+    now = wsb.time.time()
+    expected = copy.deepcopy(wsb.game_data["users"])
+    for user_data in expected.values():
+        user_data.pop("rate_cache", None)
+        wsb.accrue_resources(user_data, now)
+    
+    settled = wsb.economy.tick(now)
+    assert settled == sum(1 for i in range(40) if i % 7)
+    for i in range(40):
+        user_data = wsb.get_user_data("chat_a", f"u{i}")
+        reference = expected[f"chat_a:u{i}"]
+        assert user_data["resources"] == reference["resources"]
+        assert user_data["experience"] == reference["experience"]
+        assert user_data["accrued_at"] == reference["accrued_at"]
+    
+    # tick دوباره بدون گذشت زمان تغییری ایجاد نمی‌کند
+    assert wsb.economy.tick(now) == 0
+    
+    wsb.install_state(wsb.empty_game_data())
+    assert not wsb.economy.built
+    print("✅ تست اقتصاد برداری موفق!")
+
+def test_unit_catalog():
+    """تست کاتالوگ ستونی واحدهای نظامی"""
+    print("🧪 تست کاتالوگ واحدها...")
+    
+    import war_simulation_bot as wsb
+    
+    catalog = wsb.UNIT_CATALOG
+    assert len(catalog) == len(wsb.MILITARY_UNITS) == len(wsb.UNIT_DEFINITIONS)
+    
+    # کلید تکراری رد می‌شود
+    duplicate = [("railgun", dict(wsb.MILITARY_UNITS["railgun"]))] * 2
+    try:
+        wsb.UnitCatalog(duplicate)
+        assert False, "کلید تکراری باید خطا بدهد"
+    except ValueError:
+        pass
+    
+    # واحدهای در دسترس با جستجوی دودویی
+    for level in range(0, 12):
+        available, locked = catalog.split_by_level(level)
+        assert len(available) + len(locked) == len(catalog)
+        expected = {key for key, unit in wsb.MILITARY_UNITS.items() if unit["level_req"] <= level}
+        assert {catalog.keys[unit_id] for unit_id in available} == expected
+    
+    # قدرت ارتش با آرایه‌ها برابر محاسبه دیکشنری است
+    military = {"soldier": 10, "railgun": 2, "tank_unknown": 5, "f16": 0}
+    assert catalog.army_power(military) == 10 * 5 + 2 * wsb.MILITARY_UNITS["railgun"]["power"]
+    groups = catalog.group_by_category(military)
+    assert [category for category, _ in groups] == ["infantry", "special"]
+    
+    print("✅ تست کاتالوگ واحدها موفق!")
+
+def test_template_cache():
+    """تست کش قالب‌های پیام"""
+    print("🧪 تست کش قالب‌ها...")
+    
+    import war_simulation_bot as wsb
+    
+    cache = wsb.TemplateCache(max_size=2)
+    builds = []
+    
+    @cache.template("greeting")
+    def greeting(level):
+        builds.append(level)
+        return f"سطح {level} | پول: {{money}}"
+    
+    first = cache.render("greeting", 1)
+    assert cache.render("greeting", 1) is first
+    assert builds == [1]
+    assert cache.fill(first, money="1,000") == "سطح 1 | پول: 1,000"
+    
+    # حذف قدیمی‌ترین قالب با LRU
+    cache.render("greeting", 2)
+    cache.render("greeting", 3)
+    cache.render("greeting", 1)
+    assert builds == [1, 2, 3, 1]
+    assert cache.stats()["size"] == 2 and cache.stats()["hits"] == 1
+    
+    # فروشگاه برای سطح‌های با واحدهای یکسان مشترک است
+    wsb.templates.clear()
+    unlocked = len(wsb.UNIT_CATALOG.available(5))
+    shop = wsb.templates.render("shop", unlocked)
+    assert "{money}" in shop and "{level}" in shop
+    assert wsb.templates.render("shop", unlocked) is shop
+    
+    # بارگذاری دوباره کاتالوگ کش را پاک می‌کند
+    wsb.install_catalog(wsb.UNIT_DEFINITIONS)
+    assert wsb.templates.stats()["size"] == 0
+    
+    print("✅ تست کش قالب‌ها موفق!")
+
+def test_player_locks():
+    """تست قفل‌های بازیکنان"""
+    print("🧪 تست قفل بازیکنان...")
+    
+    import asyncio
+    import war_simulation_bot as wsb
+    
+    async def scenario():
+        locks = wsb.LockManager()
+        balance = {"u1": 0}
+        
+        async def deposit():
+            async with locks.hold("chat_a", "u1"):
+                value = balance["u1"]
+                await asyncio.sleep(0.001)  # شبیه‌سازی await شبکه بین خواندن و نوشتن
+                balance["u1"] = value + 1
+        
+        await asyncio.gather(*(deposit() for _ in range(20)))
+        assert balance["u1"] == 20, "به‌روزرسانی‌ها نباید از دست بروند"
+        assert locks.waits > 0
+        
+        # ترتیب مرتب از بن‌بست جلوگیری می‌کند
+        async def attack(attacker, defender):
+            async with locks.hold("chat_a", attacker, defender):
+                await asyncio.sleep(0.001)
+        
+        await asyncio.wait_for(asyncio.gather(*(attack("u1", "u2") if i % 2 else attack("u2", "u1") for i in range(10))), 2)
+        
+        # قفل‌های بیکار حذف می‌شوند
+        assert locks.locks == {}
+        assert locks.evictions > 0
+        
+        # بازیکنان مختلف به صورت موازی پردازش می‌شوند
+        async with locks.hold("chat_a", "u1"):
+            async with locks.hold("chat_a", "u2"):
+                assert locks.is_locked("chat_a", "u1") and locks.is_locked("chat_a", "u2")
+    
+    asyncio.run(scenario())
+    print("✅ تست قفل بازیکنان موفق!")
+
+def test_update_dispatcher():
+    """تست توزیع پیام‌ها با صف هر بازیکن در گروه"""
+    print("🧪 تست توزیع پیام‌ها...")
+    
+    import asyncio
+    from types import SimpleNamespace
+    import war_simulation_bot as wsb
+    
+    def make_message(chat_id, user_id, text):
+        return SimpleNamespace(chat=SimpleNamespace(id=chat_id), author=SimpleNamespace(user_id=user_id), content=text)
+    
+    async def scenario():
+        handled = []
+        running = {"now": 0, "peak": 0}
+        
+        async def handler(message):
+            running["now"] += 1
+            running["peak"] = max(running["peak"], running["now"])
+            await asyncio.sleep(0.001)
+            handled.append((message.chat.id, message.author.user_id, message.content))
+            running["now"] -= 1
+        
+        dispatcher = wsb.UpdateDispatcher(handler, max_concurrency=3, queue_size=5)
+        
+        # ترتیب پیام‌های هر بازیکن حفظ و همزمانی محدود می‌شود
+        for i in range(5):
+            for chat_id in ("a", "b", "c", "d"):
+                dispatcher.submit(make_message(chat_id, "u1", f"/cmd {i}"))
+        await dispatcher.drain()
+        assert running["peak"] <= 3
+        for chat_id in ("a", "b", "c", "d"):
+            assert [text for chat, _, text in handled if chat == chat_id] == [f"/cmd {i}" for i in range(5)]
+        assert dispatcher.queues == {} and dispatcher.workers == {} and dispatcher.depths == {}
+        
+        # بازیکنان مختلف یک گروه همزمان پردازش می‌شوند (تا سقف همزمانی گروه)
+        handled.clear()
+        running["peak"] = 0
+        dispatcher = wsb.UpdateDispatcher(handler, max_concurrency=10, queue_size=20, chat_concurrency=2)
+        for i in range(3):
+            for user_id in ("u1", "u2", "u3"):
+                dispatcher.submit(make_message("e", user_id, f"/cmd {i}"))
+        await dispatcher.drain()
+        assert running["peak"] == 2
+        for user_id in ("u1", "u2", "u3"):
+            assert [text for _, user, text in handled if user == user_id] == [f"/cmd {i}" for i in range(3)]
+        
+        # قفل‌های بازیکنان دستورات همزمان روی یک بازیکن را ترتیبی می‌کنند
+        locks = wsb.LockManager()
+        balance = {"target": 0}
+        
+        async def attack(message):
+            async with locks.hold(message.chat.id, message.author.user_id, "target"):
+                value = balance["target"]
+                await asyncio.sleep(0.001)
+                balance["target"] = value + 1
+        
+        dispatcher = wsb.UpdateDispatcher(attack, max_concurrency=10, queue_size=20, chat_concurrency=4)
+        for user_id in ("u1", "u2", "u3", "u4"):
+            dispatcher.submit(make_message("e", user_id, "/attack"))
+        await dispatcher.drain()
+        assert balance["target"] == 4 and locks.waits > 0
+        
+        # دستورات بازیکنان مختلف روی بازیکن مشترک به ترتیب ورود در گروه اجرا می‌شوند
+        events = []
+        
+        def fake(name, delay):
+            async def run(message, chat_id, user_id, *args):
+                events.append(f"{user_id} {name}:start")
+                await asyncio.sleep(delay)
+                events.append(f"{user_id} {name}:end")
+            return run
+        
+        def player(user_id):
+            return SimpleNamespace(user_id=user_id, first_name=user_id, username=None, is_bot=False)
+        
+        def chat_message(user_id, text, reply_to=None):
+            reply = SimpleNamespace(message_id=1, author=player(reply_to)) if reply_to else None
+            return SimpleNamespace(chat=SimpleNamespace(id="g"), author=player(user_id), content=text,
+                                   message_id=2, reply_to_message=reply)
+        
+        attack_route = wsb.router.routes[("/attack", None)]
+        buy_route = wsb.router.routes[("/buy", None)]
+        saved_handlers = attack_route.handler, buy_route.handler
+        try:
+            attack_route.handler = fake("attack", 0.01)
+            buy_route.handler = fake("buy", 0.02)
+            dispatcher = wsb.UpdateDispatcher(wsb.process_message, max_concurrency=10, queue_size=20,
+                                              chat_concurrency=4, lock_targets=wsb.message_lock_targets)
+            # حمله u1 پشت دستور کند قبلی او منتظر است؛ خرید بعدی u2 نباید از آن جلو بزند
+            dispatcher.submit(chat_message("u1", "/buy soldier 1"))
+            dispatcher.submit(chat_message("u1", "/attack", reply_to="u2"))
+            dispatcher.submit(chat_message("u2", "/buy soldier 1"))
+            await dispatcher.drain()
+            assert events == ["u1 buy:start", "u1 buy:end", "u1 attack:start", "u1 attack:end",
+                              "u2 buy:start", "u2 buy:end"], events
+            
+            # ترتیب معکوس: خرید بازیکن پیش از حمله بعدی به او اعمال می‌شود
+            events.clear()
+            dispatcher.submit(chat_message("u2", "/buy soldier 1"))
+            dispatcher.submit(chat_message("u1", "/attack", reply_to="u2"))
+            await dispatcher.drain()
+            assert events == ["u2 buy:start", "u2 buy:end", "u1 attack:start", "u1 attack:end"], events
+            assert wsb.player_locks.locks == {}
+        finally:
+            attack_route.handler, buy_route.handler = saved_handlers
+        
+        # دکمه جاسوسی مثل /spy قفل بازیکن ریپلای شده را هم می‌گیرد
+        assert wsb.message_lock_targets(chat_message("u1", "🕵️ جاسوسی", reply_to="u2")) == ["u1", "u2"]
+        assert wsb.message_lock_targets(chat_message("u1", "💰 وضعیت", reply_to="u2")) == ["u1"]
+        assert wsb.message_lock_targets(chat_message("u1", "/buy soldier", reply_to="u2")) == ["u1"]
+        
+        # chatter یک کاربر ادغام می‌شود و صف پر گروه chatter را حذف می‌کند
+        handled.clear()
+        dispatcher = wsb.UpdateDispatcher(handler, max_concurrency=3, queue_size=5)
+        dispatcher.submit(make_message("a", "u1", "/first"))
+        dispatcher.submit(make_message("a", "u2", "سلام"))
+        dispatcher.submit(make_message("a", "u2", "سلام دوباره"))
+        assert dispatcher.depth() == 2
+        for i in range(3):
+            dispatcher.submit(make_message("a", f"x{i}", "chatter"))
+        assert dispatcher.depth() == 5
+        assert not dispatcher.submit(make_message("a", "x9", "chatter"))
+        assert dispatcher.submit(make_message("a", "u1", "/second"))
+        assert dispatcher.depth() == 5
+        await dispatcher.drain()
+        assert [text for _, user, text in handled if user == "u1"] == ["/first", "/second"]
+        # قدیمی‌ترین chatter (پیام ادغام شده u2) برای دستور جا باز کرد
+        assert not [text for _, user, text in handled if user == "u2"]
+        assert dispatcher.queues == {} and dispatcher.workers == {}
+    
+    asyncio.run(scenario())
+    print("✅ تست توزیع پیام‌ها موفق!")
+
+def test_sharding():
+    """تست حلقه هش و تقسیم داده‌ها بین شاردها"""
+    print("🧪 تست شاردینگ...")
+    
+    import asyncio
+    import queue
+    import tempfile
+    import time
+    from types import SimpleNamespace
+    import war_simulation_bot as wsb
+    
+    chats = [f"chat_{i}" for i in range(2000)]
+    ring = wsb.HashRing(4)
+    owners = {chat_id: ring.shard_for(chat_id) for chat_id in chats}
+    counts = [list(owners.values()).count(shard) for shard in range(4)]
+    assert min(counts) > 300, f"توزیع نامتوازن: {counts}"
+    assert ring.shard_for(12345) == ring.shard_for("12345")
+    
+    # با افزودن یک شارد فقط بخشی از گروه‌ها جابجا می‌شوند
+    grown = wsb.HashRing(5)
+    moved = sum(1 for chat_id in chats if grown.shard_for(chat_id) != owners[chat_id])
+    assert moved < len(chats) * 0.35
+    
+    assert wsb.shard_path("war_data.txt", 2) == "war_data.shard2.txt"
+    
+    # تقسیم داده‌های تک‌فرآیندی
+    state = wsb.empty_game_data()
+    for chat_id in chats[:50]:
+        state["users"][f"{chat_id}:u1"] = {"alliance": "Foo" if chat_id == "chat_0" else None}
+        state["countries"][f"{chat_id}:u1"] = {}
+    state["alliances"]["Foo"] = {"leader": "u1", "members": ["u1"]}
+    # اعضای Bar در دو گروه همان شارد هستند؛ اتحاد فقط در همان شارد قرار می‌گیرد
+    same_shard = [chat_id for chat_id in chats[1:50] if owners[chat_id] == owners["chat_0"]][:2]
+    for chat_id in same_shard:
+        state["users"][f"{chat_id}:u1"]["alliance"] = "Bar"
+    state["alliances"]["Bar"] = {"leader": "u1", "members": ["u1"]}
+    parts = [wsb.split_state(state, shard, ring) for shard in range(4)]
+    assert sum(len(part["users"]) for part in parts) == 50
+    assert all(part["users"].keys() == part["countries"].keys() for part in parts)
+    assert "Foo" in parts[owners["chat_0"]]["alliances"]
+    assert sum("Foo" in part["alliances"] for part in parts) == 1
+    assert [shard for shard in range(4) if "Bar" in parts[shard]["alliances"]] == [owners["chat_0"]]
+    
+    # بازسازی پیام در فرآیند شارد
+    author = SimpleNamespace(user_id=7, first_name="علی", is_bot=False)
+    target = SimpleNamespace(user_id=8, first_name="رضا", is_bot=False)
+    message = SimpleNamespace(chat=SimpleNamespace(id=100), message_id=5, content="/attack", author=author,
+                              reply_to_message=SimpleNamespace(message_id=4, author=target))
+    remote = wsb.RemoteMessage(wsb.encode_update(message))
+    assert remote.chat.id == 100 and remote.content == "/attack" and remote.author.first_name == "علی"
+    assert remote.reply_to_message.author.user_id == 8
+    
+    # اتحادی که اعضایش در شاردهای مختلف هستند مانع راه‌اندازی حالت شارد می‌شود
+    other = next(chat_id for chat_id in chats[1:50] if owners[chat_id] != owners["chat_0"])
+    saved = wsb.read_state, wsb.shard_storage_exists
+    with tempfile.TemporaryDirectory() as temp_dir:
+        manager = wsb.ShardManager(count=4)
+        manager.alliances.path = os.path.join(temp_dir, "alliances.json")
+        try:
+            wsb.shard_storage_exists = lambda index: False
+            wsb.read_state = lambda: state
+            assert manager.check_alliances()
+            assert manager.alliances.owners == {"Foo": owners["chat_0"], "Bar": owners["chat_0"]}
+            state["users"][f"{other}:u1"]["alliance"] = "Foo"
+            assert not manager.check_alliances()
+        finally:
+            wsb.read_state, wsb.shard_storage_exists = saved
+            state["users"][f"{other}:u1"]["alliance"] = None
+        
+        # نام اتحاد در تمام شاردها یکتاست و به اتحاد شارد دیگر نمی‌توان پیوست
+        replies = []
+        
+        class FakeMessage:
+            def __init__(self, chat_id, content):
+                self.chat = SimpleNamespace(id=chat_id)
+                self.content = content
+            
+            async def reply(self, text, **kwargs):
+                replies.append((self.chat.id, text))
+        
+        async def alliance_routing():
+            here, there = owners["chat_0"], owners[other]
+            # نام در فرآیند اصلی فقط با فراخوانی شارد پس از بررسی‌های ساخت ثبت می‌شود
+            assert await manager.check_alliance(FakeMessage(other, "/alliance create New Order"), there)
+            assert manager.alliances.owner("New Order") is None
+            manager.results = [queue.Queue() for _ in range(4)]
+            await manager.handle_call(here, 1, "claim_alliance", ("New Order",), {})
+            await manager.handle_call(there, 2, "claim_alliance", ("New Order",), {})
+            assert manager.results[here].get_nowait() == (1, True, True)
+            assert manager.results[there].get_nowait() == (2, True, False)
+            # شارد دیگر نمی‌تواند نام را آزاد کند
+            await manager.handle_call(there, 3, "release_alliance", ("New Order",), {})
+            assert manager.alliances.owner("New Order") == here
+            assert not await manager.check_alliance(FakeMessage(other, "/alliance join Foo"), there)
+            assert await manager.check_alliance(FakeMessage(same_shard[0], "/alliance join Foo"), here)
+            assert await manager.check_alliance(FakeMessage(other, "/alliance join Unknown"), there)
+            assert await manager.check_alliance(FakeMessage(other, "/status"), there)
+        
+        asyncio.run(alliance_routing())
+        assert [chat_id for chat_id, _ in replies] == [other]
+        reloaded = wsb.AllianceDirectory(manager.alliances.path)
+        reloaded.load()
+        assert reloaded.owner("New Order") == owners["chat_0"]
+    
+    # فراخوانی‌های API شارد در فرآیند اصلی اجرا می‌شوند
+    class ParentClient:
+        async def send_message(self, chat_id, text, components=None, reply_to_message_id=None):
+            return SimpleNamespace(message_id=reply_to_message_id + 1, text=text, components=components)
+        
+        async def get_chat_member(self, chat_id, user_id):
+            return SimpleNamespace(status="creator", user=SimpleNamespace(user_id=user_id, first_name="مریم"))
+        
+        async def delete_message(self, chat_id, message_id):
+            raise ConnectionError("message not found")
+    
+    alliance_replies = []
+    
+    async def record_alliance_reply(text, **kwargs):
+        alliance_replies.append(text)
+    
+    alliance_message = SimpleNamespace(reply=record_alliance_reply)
+    
+    async def bridge():
+        manager = wsb.ShardManager(count=2)
+        manager.alliances.path = os.path.join(bridge_dir, "alliances.json")
+        manager.calls = queue.Queue()
+        manager.results = [queue.Queue(), queue.Queue()]
+        manager.serve()
+        shard_bot = wsb.ParentBot(1, manager.calls, manager.results[1])
+        sent = await shard_bot.send_message(100, "سلام", reply_to_message_id=5)
+        assert sent.chat.id == 100 and sent.message_id == 6
+        member = await shard_bot.get_chat_member(100, 9)
+        assert member.status == "creator" and member.user.first_name == "مریم"
+        try:
+            await sent.delete()
+            assert False, "خطای delete_message باید به شارد برسد"
+        except ConnectionError:
+            pass
+        
+        # /alliance create در شارد نام را پس از بررسی‌ها ثبت و در صورت شکست ساخت آزاد می‌کند
+        other_bot = wsb.ParentBot(0, manager.calls, manager.results[0])
+        assert await other_bot.claim_alliance("Blue")
+        wsb.install_state(wsb.empty_game_data())
+        saved_create = wsb.create_alliance
+        wsb.bot = shard_bot
+        try:
+            creator = wsb.get_user_data(100, 9)
+            creator["alliance"] = "Old"
+            await wsb.alliance_create(alliance_message, 100, 9, "Red")
+            assert manager.alliances.owner("Red") is None, "نام رد شده توسط شارد نباید ثبت شود"
+            creator["alliance"] = None
+            await wsb.alliance_create(alliance_message, 100, 9, "Blue")
+            assert wsb.get_alliance("Blue") is None and creator["alliance"] is None
+            
+            def broken_create(name, data):
+                raise RuntimeError("disk full")
+            wsb.create_alliance = broken_create
+            await wsb.alliance_create(alliance_message, 100, 9, "Red")
+            assert manager.alliances.owner("Red") is None, "نام پس از شکست ساخت آزاد می‌شود"
+            wsb.create_alliance = saved_create
+            await wsb.alliance_create(alliance_message, 100, 9, "Red")
+            assert manager.alliances.owner("Red") == 1 and wsb.get_alliance("Red")["leader"] == 9
+        finally:
+            wsb.bot = parent_client
+            wsb.create_alliance = saved_create
+            wsb.install_state(wsb.empty_game_data())
+        assert [text.startswith("❌") for text in alliance_replies[:2]] == [True, True]
+        other_bot.close()
+        
+        # پس از توقف فرآیند اصلی فراخوانی‌ها بلافاصله شکست می‌خورند
+        manager.results[1].put(wsb.SHARD_CLOSED)
+        await asyncio.sleep(0.05)
+        try:
+            await shard_bot.send_message(100, "x")
+            assert False, "فراخوانی پس از توقف باید شکست بخورد"
+        except ConnectionError:
+            pass
+        shard_bot.close()
+        manager.close()
+    
+    # پاسخ هندلرهای فرآیند شارد واقعی با bot فرآیند اصلی ارسال می‌شود
+    sent = []
+    
+    class RecordingClient:
+        async def send_message(self, chat_id, text, components=None, reply_to_message_id=None):
+            sent.append((chat_id, reply_to_message_id, components is not None))
+            return SimpleNamespace(message_id=len(sent))
+    
+    async def shard_processes(manager):
+        manager.serve()
+        author = SimpleNamespace(user_id=7, first_name="علی", is_bot=False)
+        for chat_id in (1, 2, 3):
+            await manager.route(SimpleNamespace(chat=SimpleNamespace(id=chat_id), message_id=10, content="/start",
+                                                author=author, reply_to_message=None))
+        deadline = time.monotonic() + 60
+        while len(sent) < 3 and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+    
+    saved_bot, cwd = wsb.bot, os.getcwd()
+    wsb.bot = parent_client = ParentClient()
+    try:
+        with tempfile.TemporaryDirectory() as bridge_dir:
+            asyncio.run(bridge())
+        
+        # فرآیند اصلی حالت شارد اسنپ‌شات و WAL تک‌فرآیندی را هنگام خاموش شدن فشرده نمی‌کند
+        closed = []
+        saved_shards = wsb.shards
+        wsb.shards = wsb.ShardManager(count=2)
+        wsb.persistence.close = lambda: closed.append(wsb.bot)
+        try:
+            wsb.shutdown_storage()
+            assert closed == []
+            wsb.bot = wsb.ParentBot(0, queue.Queue(), queue.Queue())
+            wsb.shutdown_storage()
+            assert closed == [wsb.bot], "فرآیند شارد داده‌های خود را ذخیره می‌کند"
+        finally:
+            del wsb.persistence.close
+            wsb.shards = saved_shards
+            wsb.bot = parent_client
+        with tempfile.TemporaryDirectory() as temp_dir:
+            os.chdir(temp_dir)
+            wsb.bot = RecordingClient()
+            manager = wsb.ShardManager(count=2)
+            manager.alliances.path = os.path.join(temp_dir, "alliances.json")
+            assert manager.start()
+            try:
+                asyncio.run(shard_processes(manager))
+            finally:
+                manager.close()
+                os.chdir(cwd)
+        assert sorted(sent) == [(1, 10, True), (2, 10, True), (3, 10, True)]
+    finally:
+        wsb.bot = saved_bot
+        os.chdir(cwd)
+    
+    print("✅ تست شاردینگ موفق!")
+
+def test_outbound_queue():
+    """تست صف ارسال پاسخ‌ها"""
+    print("🧪 تست صف ارسال...")
+    
+    import asyncio
+    from types import SimpleNamespace
+    import war_simulation_bot as wsb
+    
+    # تقسیم متن طولانی در مرز خطوط
+    text = "\n".join(f"عضو {i}" for i in range(500))
+    chunks = wsb.split_text(text, 100)
+    assert "".join(chunks) == text
+    assert all(len(chunk) <= 100 for chunk in chunks)
+    assert wsb.split_text("x" * 250, 100) == ["x" * 100, "x" * 100, "x" * 50]
+    
+    # سطل توکن
+    bucket = wsb.TokenBucket(2, 2)
+    now = bucket.updated
+    assert bucket.take(now) == 0 and bucket.take(now) == 0
+    assert abs(bucket.take(now) - 0.5) < 1e-9
+    assert bucket.take(now + 0.5) == 0
+    
+    sent = []
+    
+    class FakeMessage:
+        def __init__(self, chat_id, failures=0):
+            self.chat = SimpleNamespace(id=chat_id)
+            self.failures = failures
+        
+        async def reply(self, text, **kwargs):
+            if self.failures:
+                self.failures -= 1
+                raise ConnectionError("rate limited")
+            sent.append((self.chat.id, text, kwargs))
+            return text
+    
+    async def scenario():
+        queue = wsb.OutboundQueue(global_rate=1000, chat_rate=1000, chat_burst=1000, max_length=50,
+                                  retry_base=0.001, concurrency=1)
+        # پیش از شروع ارسال‌کننده در صف قرار می‌گیرند تا اولویت قابل مشاهده باشد
+        queue._wakeup = asyncio.Event()
+        queue.enqueue(FakeMessage("a"), "help", wsb.PRIORITY_LOW)
+        queue.enqueue(FakeMessage("a"), "late battle", wsb.PRIORITY_BATTLE)
+        queue.enqueue(FakeMessage("e"), "status")
+        battle = queue.enqueue(FakeMessage("b"), "battle", wsb.PRIORITY_BATTLE)
+        members = queue.enqueue(FakeMessage("c"), "\n".join(["x" * 30] * 3), components="keyboard")
+        retried = queue.enqueue(FakeMessage("d", failures=2), "retry")
+        queue.start()
+        assert await battle == "battle"
+        await queue.drain()
+        assert await retried == "retry"
+        # future پاسخ تقسیم شده با ارسال بخش آخر (همراه کیبورد) کامل می‌شود
+        assert await members == "x" * 30
+        
+        texts = [text for _, text, _ in sent]
+        assert texts[0] == "battle"
+        # اولویت فقط بین گروه‌ها؛ پاسخ‌های یک گروه به ترتیب ورود ارسال می‌شوند
+        assert texts.index("status") < texts.index("help") < texts.index("late battle")
+        member_chunks = [(text, kwargs) for chat_id, text, kwargs in sent if chat_id == "c"]
+        assert len(member_chunks) == 3
+        assert [kwargs for _, kwargs in member_chunks] == [{}, {}, {"components": "keyboard"}]
+        queue.close()
+        
+        # محدودیت نرخ هر گروه
+        sent.clear()
+        limited = wsb.OutboundQueue(global_rate=1000, chat_rate=50, chat_burst=1)
+        limited.start()
+        started = asyncio.get_running_loop().time()
+        for i in range(4):
+            limited.enqueue(FakeMessage("a"), f"m{i}")
+        await limited.drain()
+        assert asyncio.get_running_loop().time() - started >= 0.05
+        assert [text for _, text, _ in sent] == ["m0", "m1", "m2", "m3"]
+        limited.close()
+        
+        # بخش ناموفق پاسخ تقسیم شده صف گروه را تا تلاش دوباره نگه می‌دارد
+        sent.clear()
+        parallel = wsb.OutboundQueue(global_rate=1000, chat_rate=1000, chat_burst=1000, max_length=10,
+                                     retry_base=0.01, concurrency=8)
+        parallel.start()
+        long_text = "\n".join(f"part{i}" for i in range(5))
+        parallel.enqueue(FakeMessage("s", failures=1), long_text)
+        parallel.enqueue(FakeMessage("s"), "after", wsb.PRIORITY_BATTLE)
+        parallel.enqueue(FakeMessage("t"), "other")
+        await parallel.drain()
+        assert "".join(text for chat_id, text, _ in sent if chat_id == "s") == long_text + "after"
+        assert [text for chat_id, text, _ in sent if chat_id == "t"] == ["other"]
+        assert parallel.depth() == 0 and not parallel.chats
+        parallel.close()
+        
+        # سهم هر شارد از نرخ سراسری
+        parallel.set_global_rate(wsb.OUTBOUND_GLOBAL_RATE / 4)
+        assert parallel.global_bucket.rate == parallel.global_bucket.capacity == wsb.OUTBOUND_GLOBAL_RATE / 4
+    
+    asyncio.run(scenario())
+    print("✅ تست صف ارسال موفق!")
+
+def test_fake_bale_benchmark():
+    """تست کلاینت جعلی بله و بار بنچمارک"""
+    print("🧪 تست کلاینت جعلی بله...")
+    
+    import asyncio
+    import fake_bale
+    import benchmark
+    
+    bot = fake_bale.Bot(seed=1)
+    chat = fake_bale.Chat(-1)
+    author = fake_bale.User(7, "علی")
+    
+    @bot.event
+    async def on_message(message):
+        await message.reply(f"echo {message.content}")
+    
+    message = fake_bale.Message("/status", chat, author, bot=bot)
+    asyncio.run(bot.emit(message))
+    assert message.replies == ["echo /status"]
+    assert bot.sent_count == 1 and bot.sent[-1].reply_to_message_id == message.message_id
+    
+    # خطای موقت ارسال برای شبیه‌سازی محدودیت نرخ
+    bot.fail_rate = 1.0
+    try:
+        asyncio.run(bot.send_message(-1, "x"))
+        assert False, "خطای ارسال انتظار می‌رفت"
+    except ConnectionError:
+        assert bot.failed_count == 1
+    
+    bot.admins.add((-1, 7))
+    bot.fail_rate = 0.0
+    member = asyncio.run(bot.get_chat_member(-1, 7))
+    assert member.status == "administrator"
+    
+    # بار با seed یکسان همیشه یکسان است
+    def texts(seed):
+        workload = benchmark.build_workload(fake_bale, fake_bale.Bot(), 5, 3, 200, benchmark.DEFAULT_MIX, seed)
+        return [(kind, m.chat.id, m.author.user_id, m.content) for kind, m in workload]
+    
+    first = texts(3)
+    assert first == texts(3) and first != texts(4)
+    assert {kind for kind, _, _, _ in first} == set(benchmark.DEFAULT_MIX)
+    workload = benchmark.build_workload(fake_bale, fake_bale.Bot(), 5, 3, 200, benchmark.DEFAULT_MIX, 3)
+    for kind, m in workload:
+        if kind == "attack":
+            assert m.reply_to_message.author.user_id != m.author.user_id
+    
+    assert benchmark.percentile([1, 2, 3, 4], 0.5) == 2.5
+    assert benchmark.percentile([5], 0.99) == 5
+    
+    # میانه چند اجرا (--repeat) برای هر معیار و هر نوع پیام
+    runs = [{"p99_ms": value, "by_kind": {"buy": {"p99_ms": value * 2}}} for value in (9, 1, 4)]
+    assert benchmark.median_metrics(runs) == {"p99_ms": 4, "by_kind": {"buy": {"p99_ms": 8}}}
+    
+    # مقایسه با baseline
+    baseline = {"metrics": {"p50_ms": 10, "p95_ms": 20, "p99_ms": 30, "memory_growth_kb": 100, "messages_per_sec": 1000}}
+    same = {"metrics": dict(baseline["metrics"], p50_ms=11)}
+    slower = {"metrics": dict(baseline["metrics"], p99_ms=45, messages_per_sec=600)}
+    assert benchmark.compare(same, baseline, 0.25) == []
+    assert benchmark.compare(slower, baseline, 0.25) == ["p99_ms", "messages_per_sec"]
+    print("✅ تست کلاینت جعلی بله موفق!")
+
+def test_replay_logs():
+    """تست خواندن لاگ‌ها برای بازپخش"""
+    print("🧪 تست بازپخش لاگ‌ها...")
+    
+    import asyncio
+    import tempfile
+    import fake_bale
+    import replay
+    import war_simulation_bot as wsb
+    
+    # پیام‌های ریپلای هدف خود را در خط reply_to ثبت می‌کنند
+    chat = fake_bale.Chat(-5)
+    target = fake_bale.Message("سلام", chat, fake_bale.User(2, "ب"))
+    message = fake_bale.Message("چطوری؟\nخوبی", chat, fake_bale.User(1, "الف"), reply_to_message=target)
+    asyncio.run(wsb.process_message(message))
+    with open(wsb.log_sink.path, "r", encoding="utf-8") as f:
+        lines = f.readlines()[-2:]
+    assert [line.split(" | ")[3] for line in lines] == ["message", "reply_to"]
+    
+    extra = [
+        wsb.LogSink.format_line("2024-01-01T10:00:00", "system", "bot", "startup", "Bot started"),
+        wsb.LogSink.format_line("2024-01-01T10:00:01", -6, 3, "message", "/collect"),
+        wsb.LogSink.format_line("2024-01-01T10:00:02", -6, 4, "message", "/leaderboard"),
+        "خط نامعتبر\n",
+    ]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "war_logs.txt")
+        # نسخه چرخانده شده قدیمی‌تر است
+        with open(path + ".1", "w", encoding="utf-8") as f:
+            f.writelines(extra)
+        with open(path, "w", encoding="utf-8") as f:
+            f.writelines(lines)
+        assert replay.log_files(path) == [path + ".1", path]
+        entries = replay.read_entries(replay.log_files(path))
+    
+    assert [entry.text for entry in entries] == ["/collect", "/leaderboard", "چطوری؟\nخوبی"]
+    assert entries[-1].chat_id == -5 and entries[-1].user_id == 1 and entries[-1].reply_to == 2
+    assert entries[0].reply_to is None
+    assert [entry.chat_id for entry in replay.select_chats(entries, top=1)] == [-6, -6]
+    assert replay.select_chats(entries, chats=[-5]) == entries[-1:]
+    assert replay.label_for(wsb, "/buy soldier 5") == "/buy" and replay.label_for(wsb, "سلام") == "chatter"
+    
+    # digest به فیلدهای زمانی حساس نیست
+    first = {"users": {"1:2": {"level": 3, "accrued_at": 1.0, "last_collection": "x"}}}
+    second = {"users": {"1:2": {"level": 3, "accrued_at": 9.0, "last_collection": "y"}}}
+    third = {"users": {"1:2": {"level": 4, "accrued_at": 1.0, "last_collection": "x"}}}
+    assert replay.state_digest(first) == replay.state_digest(second) != replay.state_digest(third)
+    print("✅ تست بازپخش لاگ‌ها موفق!")
+
+def test_battle_odds():
+    """تست پیش‌بینی مونت‌کارلو نتیجه حمله"""
+    print("🧪 تست پیش‌بینی حمله...")
+    
+    import time
+    import war_simulation_bot as wsb
+    
+    # فرمول‌های مشترک با attack_command
+    loot, conquest = wsb.victory_ratios(1000, 400)
+    assert abs(loot - 0.3) < 1e-9 and abs(conquest - 0.1) < 1e-9
+    loot, conquest = wsb.victory_ratios(1000, 900)
+    assert abs(loot - 0.05) < 1e-9 and abs(conquest - 0.02) < 1e-9
+    assert abs(wsb.defeat_ratio(900, 1000) - 0.03) < 1e-9
+    
+    def forces(**powers):
+        return [float(powers.get(category, 0)) for category in wsb.CATEGORY_KEYS]
+    
+    # مدافع بدون ارتش: پیروزی قطعی با حداکثر غنیمت و شانس فتح
+    odds = wsb.simulate_battle_odds(forces(infantry=10000), forces(), 50001, 20000, 30000)
+    assert odds["win_probability"] == 1.0 and odds["expected_penalty"] == 0
+    assert odds["expected_money"] == int(50001 * 0.3) and odds["expected_oil"] == 6000
+    assert abs(odds["conquest_chance"] - 0.1) < 1e-9
+    
+    # قدرت برابر: احتمال پیروزی نزدیک 50٪ (با numpy و حلقه پایتون)
+    numpy_module = wsb.np
+    try:
+        for module in ([numpy_module] if numpy_module is not None else []) + [None]:
+            wsb.np = module
+            odds = wsb.simulate_battle_odds(forces(infantry=1000), forces(infantry=1000), 50000, 20000, 30000,
+                                            time_limit=10)
+            assert abs(odds["win_probability"] - 0.5) < 0.05
+            assert 0 < odds["conquest_chance"] < 0.05
+            assert 0 < odds["expected_penalty"] < 30000 * 0.2
+    finally:
+        wsb.np = numpy_module
+    
+    # تعداد نمونه با تعداد دسته‌های حاضر کم می‌شود و زمان هر پیش‌بینی محدود است
+    full_army = forces(**{category: 1000 for category in wsb.CATEGORY_KEYS})
+    assert wsb.preview_samples(full_army, full_army) == wsb.BATTLE_PREVIEW_CELLS // len(wsb.CATEGORY_KEYS)
+    assert wsb.preview_samples(forces(infantry=1), forces()) == wsb.BATTLE_PREVIEW_SAMPLES
+    odds = wsb.simulate_battle_odds(full_army, full_army, 10000, 10000, 10000, samples=10 ** 7, time_limit=0)
+    assert odds["samples"] == (wsb.BATTLE_PREVIEW_CHUNK if numpy_module is not None else 1)
+    
+    # شبیه‌سازی برداری باید برای استفاده در چت سریع باشد (چند میلی‌ثانیه حتی با ارتش کامل)
+    if numpy_module is not None:
+        for attacker, defender in ((forces(infantry=5000, fighter=2000), forces(infantry=4000, anti_air=1500)),
+                                   (full_army, full_army)):
+            wsb.simulate_battle_odds(attacker, defender, 10000, 10000, 10000)
+            started = time.perf_counter()
+            for _ in range(10):
+                wsb.simulate_battle_odds(attacker, defender, 10000, 10000, 10000)
+            assert (time.perf_counter() - started) / 10 < 0.01
+    print("✅ تست پیش‌بینی حمله موفق!")
+
+def test_combat_engine():
+    """تست موتور نبرد دسته‌ها"""
+    print("🧪 تست موتور نبرد...")
+    
+    import random
+    import war_simulation_bot as wsb
+    
+    engine = wsb.CombatEngine(rounds=3, lethality=0.1)
+    index = wsb.CATEGORY_KEYS.index
+    assert len(engine.matrix) == len(wsb.CATEGORY_KEYS) == 13
+    assert engine.matrix[index("anti_air")][index("fighter")] > 1 > engine.matrix[index("fighter")][index("anti_air")]
+    
+    def forces(**powers):
+        return [float(powers.get(category, 0)) for category in wsb.CATEGORY_KEYS]
+    
+    # ضدهوایی در برابر جنگنده‌ها بهتر از پیاده نظام هم‌قدرت عمل می‌کند
+    rolls = [(1.0, 1.0)] * 3
+    jets = forces(fighter=1000)
+    _, aa_strength, jets_vs_aa, _ = engine.resolve(jets, forces(anti_air=1000), rolls)
+    _, inf_strength, jets_vs_inf, _ = engine.resolve(jets, forces(infantry=1000), rolls)
+    assert aa_strength > inf_strength and jets_vs_aa[index("fighter")] < jets_vs_inf[index("fighter")]
+    
+    # هزینه هر مرحله به اندازه ارتش بستگی ندارد و نتیجه با مقیاس خطی است
+    small = engine.resolve(forces(tank=10, infantry=5), forces(infantry=12), rolls)
+    large = engine.resolve(forces(tank=10 ** 7, infantry=5 * 10 ** 6), forces(infantry=12 * 10 ** 6), rolls)
+    assert abs(large[0] / small[0] - 10 ** 6) < 1e-3 and abs(large[1] / small[1] - 10 ** 6) < 1e-3
+    
+    # سیستم‌های دفاعی هنگام دفاع قوی‌تر هستند
+    user = {"capital": {"military_academy": 2}, "military": {"soldier": 10, "patriot": 0}}
+    defense_units = [key for key, unit in wsb.MILITARY_UNITS.items() if unit["category"] == "defense"]
+    user["military"][defense_units[0]] = 2
+    attacking, defending = engine.forces(user), engine.forces(user, defending=True)
+    assert abs(attacking[index("infantry")] - 10 * wsb.MILITARY_UNITS["soldier"]["power"] * 1.2) < 1e-9
+    assert defending[index("defense")] == 3 * attacking[index("defense")]
+    
+    # نسخه برداری numpy همان نتیجه حلقه پایتون را با ضرایب یکسان می‌دهد
+    if wsb.np is not None:
+        attacker, defender = forces(infantry=3000, fighter=500, tank=800), forces(infantry=2000, anti_air=900, defense=100)
+        seeded = wsb.np.random.default_rng(7)
+        attack, defense = engine.simulate(attacker, defender, 4, seeded)
+        rolls = wsb.np.random.default_rng(7).uniform(0.8, 1.2, (3, 2, 4))
+        for sample in range(4):
+            expected = engine.resolve(attacker, defender, [(rolls[r, 0, sample], rolls[r, 1, sample]) for r in range(3)])
+            assert abs(attack[sample] - expected[0]) < 1e-6 and abs(defense[sample] - expected[1]) < 1e-6
+    
+    # تلفات بر اساس نسبت بازمانده هر دسته به هر نوع واحد اعمال می‌شود
+    military = {"soldier": 100, "f16": 10}
+    before = engine.forces({"capital": {}, "military": military})
+    after = list(before)
+    after[index("infantry")] *= 0.75
+    losses = engine.casualties(military, before, after)
+    assert losses == {"soldier": 25}
+    user = {"capital": {}, "military": dict(military), "power_cache": 123}
+    assert wsb.apply_casualties(user, {"soldier": 25, "f16": 10}) == 35
+    assert user["military"] == {"soldier": 75} and user["power_cache"] is None
+    
+    # نبرد کامل با ضرایب تصادفی
+    random.seed(3)
+    attack, defense, left_attacker, left_defender = engine.resolve(forces(infantry=1000), forces(infantry=1000))
+    assert 0 < sum(left_attacker) < 1000 and 0 < sum(left_defender) < 1000
+    print("✅ تست موتور نبرد موفق!")
+
+def test_battle_ledger():
+    """تست دفتر نبردها"""
+    print("🧪 تست دفتر نبردها...")
+    
+    import asyncio
+    import war_simulation_bot as wsb
+    from war_simulation_bot import BattleLedger, BATTLE_RECORD
+    
+    path = "test_battles.dat"
+    ledger = BattleLedger(path, retention=4)
+    try:
+        # بافر حلقوی: فقط 4 نبرد آخر گروه نگه داشته می‌شود و ایندکس‌ها هم‌زمان پاک می‌شوند
+        ledger.record(-1, 1, 2, 500.0, 300.0, money=100, oil=10, won=True, timestamp=1.0)
+        ledger.record(-1, 2, 1, 200.0, 400.0, money=50, attacker_lost=3, timestamp=2.0)
+        ledger.record(-1, 3, 1, 900.0, 100.0, money=70, oil=7, defender_lost=5, won=True, conquest=True, timestamp=3.0)
+        ledger.record(-2, 1, 3, 100.0, 100.0, timestamp=4.0)
+        for i in range(3):
+            ledger.record(-1, 4, 5, 10.0, 20.0, timestamp=5.0 + i)
+        assert [battle.seq for battle in ledger.recent(-1)] == [5, 4, 3, 2]
+        assert (-1, 1) not in ledger.by_attacker and list(ledger.by_defender[(-1, 1)]) == [2]
+        assert list(ledger.by_attacker[(-1, 4)]) == [3, 4, 5]
+        
+        # نبردهای هر گروه جدا هستند
+        assert [battle.defender for battle in ledger.player(-2, 1)] == [3]
+        battle = ledger.player(-1, 1)[0]
+        assert battle.attacker == 3 and battle.won and battle.conquest and battle.money == 70
+        
+        stats = ledger.stats(-1, 1)
+        assert stats["defenses"] == 1 and stats["attacks"] == 0
+        assert stats["lost_money"] == 70 and stats["lost_oil"] == 7 and stats["units_lost"] == 5
+        assert ledger.revenge_target(-1, 1).attacker == 3
+        assert ledger.revenge_target(-1, 5) is None
+        
+        # فایل افزایشی است و با بارگذاری همان ایندکس‌ها بازسازی می‌شوند
+        assert os.path.getsize(path) == 7 * BATTLE_RECORD.size
+        loaded = BattleLedger(path, retention=4)
+        assert loaded.load() == 7
+        assert [battle.seq for battle in loaded.recent(-1)] == [5, 4, 3, 2]
+        assert loaded.stats(-1, 1) == stats
+        
+        # با بزرگ شدن فایل فقط رکوردهای نگه داشته شده بازنویسی می‌شوند
+        for i in range(10):
+            loaded.record(-1, 6, 7, 1.0, 2.0, timestamp=10.0 + i)
+        assert os.path.getsize(path) <= 2 * loaded.retained() * BATTLE_RECORD.size
+        compacted = BattleLedger(path, retention=4)
+        assert compacted.load() == loaded.retained() == 5
+        assert [battle.attacker for battle in compacted.recent(-2)] == [1]
+        
+        # رکورد ناقص انتهای فایل نادیده گرفته و حذف می‌شود
+        with open(path, 'ab') as f:
+            f.write(b"\x01\x02\x03")
+        recovered = BattleLedger(path, retention=4)
+        recovered.load()
+        recovered.flush()
+        assert os.path.getsize(path) % BATTLE_RECORD.size == 0
+        assert [battle.timestamp for battle in recovered.recent(-1, 2)] == [19.0, 18.0]
+        
+        # انتقال بخشی از فایل (شاردها)
+        shard = BattleLedger(path + ".shard", retention=4)
+        shard.load(path, keep=lambda chat_id: chat_id == -2)
+        shard.flush()
+        assert list(shard.chats) == [-2] and os.path.getsize(path + ".shard") == BATTLE_RECORD.size
+        
+        # نبردهای drain شده پس از شکست یا لغو نوشتن پس‌زمینه از دست نمی‌روند
+        writer = BattleLedger(path + ".writer", retention=4, flush_interval=60)
+        
+        async def failing_write(*args):
+            raise OSError("disk full")
+        
+        async def hanging_write(*args):
+            await asyncio.sleep(10)
+        
+        async def scenario():
+            writer.start()
+            writer.record(-3, 1, 2, 1.0, 2.0)
+            writer.record(-3, 2, 1, 1.0, 2.0)
+            wsb.io_executor.run = failing_write
+            writer.wake()
+            await asyncio.sleep(0.01)
+            assert writer.pending_count == 2
+            wsb.io_executor.run = hanging_write
+            writer.wake()
+            await asyncio.sleep(0.01)
+            assert writer.pending_count == 0
+        
+        original_run = wsb.io_executor.run
+        try:
+            asyncio.run(scenario())
+        finally:
+            wsb.io_executor.run = original_run
+        writer.close()
+        assert os.path.getsize(path + ".writer") == 2 * BATTLE_RECORD.size
+    finally:
+        for name in (path, path + ".shard", path + ".writer"):
+            if os.path.exists(name):
+                os.remove(name)
+    
+    print("✅ تست دفتر نبردها موفق!")
+
 def main():
     """اجرای تمام تست‌ها"""
     print("🚀 شروع تست‌های ربات جنگ...")
@@ -147,6 +1640,78 @@ def main():
         test_user_data_structure()
         print()
         
+        test_persistence_flush()
+        print()
+        
+        test_wal_recovery()
+        print()
+        
+        test_sqlite_repository()
+        print()
+        
+        test_leaderboard_index()
+        print()
+        
+        test_power_cache()
+        print()
+        
+        test_name_resolver()
+        print()
+        
+        test_monitoring()
+        print()
+        
+        test_command_tracing()
+        print()
+        
+        test_command_router()
+        print()
+        
+        test_resource_accrual()
+        print()
+        
+        test_production_engine()
+        print()
+        
+        test_log_sink()
+        print()
+        
+        test_economy_store()
+        print()
+        
+        test_unit_catalog()
+        print()
+        
+        test_template_cache()
+        print()
+        
+        test_player_locks()
+        print()
+        
+        test_update_dispatcher()
+        print()
+        
+        test_sharding()
+        print()
+        
+        test_outbound_queue()
+        print()
+        
+        test_fake_bale_benchmark()
+        print()
+        
+        test_replay_logs()
+        print()
+        
+        test_battle_odds()
+        print()
+        
+        test_combat_engine()
+        print()
+        
+        test_battle_ledger()
+        print()
+        
         print("=" * 50)
         print("🎉 تمام تست‌ها موفق بود!")
         print("✅ ربات آماده اجرا است!")
@@ -8,26 +8,44 @@ War Simulation Bot - Advanced Military Strategy Game for Bale
 import os
 import json
 import time
+import sqlite3
 import random
+import atexit
 import asyncio
+import functools
+import hashlib
+import heapq
+import itertools
+import struct
 import traceback
 import logging
+import multiprocessing
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
 from datetime import datetime, timedelta
+from types import MappingProxyType
+from queue import Empty as QueueEmpty, Full as QueueFull
 from typing import Dict, List, Optional, Tuple
 from bale import Bot, Message, User, Chat, ChatMember, InlineKeyboard, InlineKeyboardButton, MenuKeyboardButton, MenuKeyboardMarkup
 
+try:
+    import numpy as np
+except ImportError:
+    np = None  # numpy اختیاری است (فقط برای اقتصاد برداری)
+
 # ==================== CONFIGURATION ====================
 # تلاش برای بارگذاری تنظیمات از فایل config.py
 try:
     from config import BOT_TOKEN, GAME_CONFIG, LOG_CONFIG, DATABASE_CONFIG
     TOKEN = BOT_TOKEN
-    DATA_FILE = DATABASE_CONFIG.get("DATA_FILE", "war_data.txt")
-    LOG_FILE = LOG_CONFIG.get("LOG_FILE", "war_logs.txt")
 except ImportError:
     # استفاده از تنظیمات پیش‌فرض
     TOKEN = "YOUR_BOT_TOKEN_HERE"  # توکن ربات خود را اینجا قرار دهید
-    DATA_FILE = "war_data.txt"
-    LOG_FILE = "war_logs.txt"
+    LOG_CONFIG = {}
+    DATABASE_CONFIG = {}
     GAME_CONFIG = {
         "RESOURCE_PRODUCTION_INTERVAL": 5,
         "MAX_COUNTRY_LEVEL": 50,
@@ -38,142 +56,230 @@ except ImportError:
         "SPY_SUCCESS_BASE": 30,
     }
 
+# تنظیمات مانیتورینگ (اختیاری در config.py)
+try:
+    from config import MONITORING_CONFIG
+except ImportError:
+    MONITORING_CONFIG = {}
+
+METRICS_PORT = MONITORING_CONFIG.get("METRICS_PORT", 8080)
+SLOW_COMMAND_THRESHOLD = MONITORING_CONFIG.get("SLOW_COMMAND_THRESHOLD", 0.5)  # ثانیه
+
+# تنظیمات توزیع پیام‌ها (اختیاری در config.py)
+try:
+    from config import DISPATCH_CONFIG
+except ImportError:
+    DISPATCH_CONFIG = {}
+
+DISPATCH_CONCURRENCY = DISPATCH_CONFIG.get("MAX_CONCURRENCY", 32)  # حداکثر هندلر همزمان در کل ربات
+DISPATCH_QUEUE_SIZE = DISPATCH_CONFIG.get("CHAT_QUEUE_SIZE", 100)  # حداکثر پیام در صف هر گروه
+DISPATCH_CHATTER_POLICY = DISPATCH_CONFIG.get("CHATTER_POLICY", "coalesce")  # coalesce یا drop
+DISPATCH_CHAT_CONCURRENCY = DISPATCH_CONFIG.get("CHAT_CONCURRENCY", 4)  # حداکثر هندلر همزمان بازیکنان مختلف یک گروه
+
+# حالت چندفرآیندی (اختیاری در config.py)
+try:
+    from config import SHARD_CONFIG
+except ImportError:
+    SHARD_CONFIG = {}
+
+SHARD_COUNT = SHARD_CONFIG.get("SHARDS", 1)  # بیش از 1: هر گروه در یکی از این تعداد فرآیند پردازش می‌شود
+SHARD_QUEUE_SIZE = SHARD_CONFIG.get("QUEUE_SIZE", 1000)  # حداکثر پیام در صف هر فرآیند شارد
+SHARD_REPLICAS = SHARD_CONFIG.get("REPLICAS", 64)  # گره‌های مجازی هر شارد در حلقه هش
+SHARD_CALL_TIMEOUT = SHARD_CONFIG.get("CALL_TIMEOUT", 10)  # ثانیه؛ انتظار شارد برای پاسخ فراخوانی API از فرآیند اصلی
+SHARD_ALLIANCE_FILE = SHARD_CONFIG.get("ALLIANCE_FILE", "war_alliances.json")  # شارد مالک هر نام اتحاد
+
+# صف ارسال پاسخ‌ها (اختیاری در config.py)
+try:
+    from config import OUTBOUND_CONFIG
+except ImportError:
+    OUTBOUND_CONFIG = {}
+
+OUTBOUND_ENABLED = OUTBOUND_CONFIG.get("ENABLED", True)
+OUTBOUND_GLOBAL_RATE = OUTBOUND_CONFIG.get("GLOBAL_RATE", 30)  # پیام در ثانیه برای کل ربات
+OUTBOUND_CHAT_RATE = OUTBOUND_CONFIG.get("CHAT_RATE", 1)  # پیام در ثانیه برای هر گروه
+OUTBOUND_CHAT_BURST = OUTBOUND_CONFIG.get("CHAT_BURST", 5)
+OUTBOUND_MAX_LENGTH = OUTBOUND_CONFIG.get("MAX_MESSAGE_LENGTH", 4000)  # پاسخ‌های طولانی‌تر تقسیم می‌شوند
+OUTBOUND_MAX_RETRIES = OUTBOUND_CONFIG.get("MAX_RETRIES", 5)
+OUTBOUND_RETRY_BASE = OUTBOUND_CONFIG.get("RETRY_BASE", 0.5)  # ثانیه
+OUTBOUND_CONCURRENCY = OUTBOUND_CONFIG.get("CONCURRENCY", 8)  # حداکثر درخواست ارسال همزمان
+
+# طول هر چرخه تولید منابع (ثانیه)
+PRODUCTION_INTERVAL = GAME_CONFIG.get("RESOURCE_PRODUCTION_INTERVAL", 5) * 60
+
+# tick برداری تولید تمام بازیکنان (نیازمند numpy)
+ECONOMY_TICK = GAME_CONFIG.get("ECONOMY_TICK", False)
+
+# تعداد نبردهای شبیه‌سازی شده در /attack preview (بدون numpy نمونه‌های کمتری با حلقه پایتون)
+BATTLE_PREVIEW_SAMPLES = GAME_CONFIG.get("BATTLE_PREVIEW_SAMPLES", 20000)
+BATTLE_PREVIEW_FALLBACK_SAMPLES = GAME_CONFIG.get("BATTLE_PREVIEW_FALLBACK_SAMPLES", 2000)
+BATTLE_PREVIEW_CELLS = GAME_CONFIG.get("BATTLE_PREVIEW_CELLS", 40000)  # سقف نمونه × دسته‌های حاضر در نبرد
+BATTLE_PREVIEW_TIME_LIMIT = GAME_CONFIG.get("BATTLE_PREVIEW_TIME_LIMIT", 0.005)  # ثانیه
+
+# نبرد چند مرحله‌ای بین دسته‌های واحدها
+COMBAT_ROUNDS = GAME_CONFIG.get("COMBAT_ROUNDS", 3)
+COMBAT_LETHALITY = GAME_CONFIG.get("COMBAT_LETHALITY", 0.05)  # نسبت قدرت حریف که هر مرحله از بین می‌رود
+
+# تعداد نبردهای نگه داشته شده برای هر گروه در /battles
+BATTLE_HISTORY_PER_CHAT = GAME_CONFIG.get("BATTLE_HISTORY_PER_CHAT", 500)
+
+# بررسی سازگاری کش قدرت با محاسبه مستقیم (فقط برای دیباگ)
+DEBUG_POWER_CHECK = GAME_CONFIG.get("DEBUG_POWER_CHECK", False)
+
+# کش نام اعضای گروه
+NAME_CACHE_TTL = GAME_CONFIG.get("NAME_CACHE_TTL", 600)  # ثانیه
+NAME_CACHE_SIZE = GAME_CONFIG.get("NAME_CACHE_SIZE", 10000)
+NAME_FETCH_CONCURRENCY = GAME_CONFIG.get("NAME_FETCH_CONCURRENCY", 8)  # حداکثر درخواست همزمان get_chat_member
+
+DATA_FILE = DATABASE_CONFIG.get("DATA_FILE", "war_data.txt")
+LOG_FILE = LOG_CONFIG.get("LOG_FILE", "war_logs.txt")
+BATTLES_FILE = DATABASE_CONFIG.get("BATTLES_FILE", "war_battles.dat")  # تاریخچه نبردها جدا از داده‌های اصلی
+
+# تنظیمات ذخیره‌سازی دسته‌ای
+FLUSH_INTERVAL = DATABASE_CONFIG.get("FLUSH_INTERVAL", 5)  # ثانیه
+FLUSH_THRESHOLD = DATABASE_CONFIG.get("FLUSH_THRESHOLD", 500)  # تعداد رکوردهای تغییر یافته
+WAL_MAX_BYTES = DATABASE_CONFIG.get("WAL_MAX_BYTES", 8 * 1024 * 1024)  # حجم WAL پیش از ادغام در اسنپ‌شات
+WAL_FSYNC = DATABASE_CONFIG.get("WAL_FSYNC", True)
+STORAGE_BACKEND = DATABASE_CONFIG.get("BACKEND", "json")  # json یا sqlite
+SQLITE_FILE = DATABASE_CONFIG.get("SQLITE_FILE", "war_data.db")
+MAX_PENDING_RECORDS = DATABASE_CONFIG.get("MAX_PENDING_RECORDS", 10 * FLUSH_THRESHOLD)  # فشار معکوس روی هندلرها
+IO_QUEUE_SIZE = DATABASE_CONFIG.get("IO_QUEUE_SIZE", 256)  # حداکثر کارهای در صف نخ I/O
+
 # Initialize bot
 bot = Bot(token=TOKEN)
 
 # ==================== GAME CONFIGURATION ====================
 
-# Military Units Database - 120+ units
-MILITARY_UNITS = {
+# Military Units Database - 120+ units (کاتالوگ در UNIT_CATALOG ساخته می‌شود)
+UNIT_DEFINITIONS = [
     # === INFANTRY ===
-    "soldier": {"name": "سرباز", "cost": 10, "power": 5, "category": "infantry", "emoji": "🪖", "level_req": 1},
-    "marine": {"name": "تفنگدار دریایی", "cost": 25, "power": 12, "category": "infantry", "emoji": "🪖", "level_req": 2},
-    "special_forces": {"name": "نیروی ویژه", "cost": 50, "power": 25, "category": "infantry", "emoji": "🪖", "level_req": 3},
-    "sniper": {"name": "تک‌تیرانداز", "cost": 30, "power": 18, "category": "infantry", "emoji": "🎯", "level_req": 2},
-    "engineer": {"name": "مهندس نظامی", "cost": 40, "power": 15, "category": "infantry", "emoji": "🔧", "level_req": 2},
-    "medic": {"name": "پزشک نظامی", "cost": 35, "power": 10, "category": "infantry", "emoji": "⚕️", "level_req": 2},
-    "paratrooper": {"name": "چترباز", "cost": 60, "power": 22, "category": "infantry", "emoji": "🪂", "level_req": 3},
-    "commando": {"name": "کماندو", "cost": 80, "power": 35, "category": "infantry", "emoji": "⚔️", "level_req": 4},
+    ("soldier", {"name": "سرباز", "cost": 10, "power": 5, "category": "infantry", "emoji": "🪖", "level_req": 1}),
+    ("marine", {"name": "تفنگدار دریایی", "cost": 25, "power": 12, "category": "infantry", "emoji": "🪖", "level_req": 2}),
+    ("special_forces", {"name": "نیروی ویژه", "cost": 50, "power": 25, "category": "infantry", "emoji": "🪖", "level_req": 3}),
+    ("sniper", {"name": "تک‌تیرانداز", "cost": 30, "power": 18, "category": "infantry", "emoji": "🎯", "level_req": 2}),
+    ("engineer", {"name": "مهندس نظامی", "cost": 40, "power": 15, "category": "infantry", "emoji": "🔧", "level_req": 2}),
+    ("medic", {"name": "پزشک نظامی", "cost": 35, "power": 10, "category": "infantry", "emoji": "⚕️", "level_req": 2}),
+    ("paratrooper", {"name": "چترباز", "cost": 60, "power": 22, "category": "infantry", "emoji": "🪂", "level_req": 3}),
+    ("commando", {"name": "کماندو", "cost": 80, "power": 35, "category": "infantry", "emoji": "⚔️", "level_req": 4}),
     
     # === LIGHT VEHICLES ===
-    "jeep": {"name": "جیپ نظامی", "cost": 100, "power": 20, "category": "light_vehicle", "emoji": "🚙", "level_req": 1},
-    "humvee": {"name": "هموی", "cost": 150, "power": 30, "category": "light_vehicle", "emoji": "🚗", "level_req": 2},
-    "armored_car": {"name": "خودرو زرهی", "cost": 200, "power": 40, "category": "light_vehicle", "emoji": "🚐", "level_req": 2},
-    "recon_vehicle": {"name": "خودرو شناسایی", "cost": 180, "power": 35, "category": "light_vehicle", "emoji": "🔍", "level_req": 2},
-    "mrap": {"name": "خودرو ضد مین", "cost": 300, "power": 50, "category": "light_vehicle", "emoji": "🛡️", "level_req": 3},
+    ("jeep", {"name": "جیپ نظامی", "cost": 100, "power": 20, "category": "light_vehicle", "emoji": "🚙", "level_req": 1}),
+    ("humvee", {"name": "هموی", "cost": 150, "power": 30, "category": "light_vehicle", "emoji": "🚗", "level_req": 2}),
+    ("armored_car", {"name": "خودرو زرهی", "cost": 200, "power": 40, "category": "light_vehicle", "emoji": "🚐", "level_req": 2}),
+    ("recon_vehicle", {"name": "خودرو شناسایی", "cost": 180, "power": 35, "category": "light_vehicle", "emoji": "🔍", "level_req": 2}),
+    ("mrap", {"name": "خودرو ضد مین", "cost": 300, "power": 50, "category": "light_vehicle", "emoji": "🛡️", "level_req": 3}),
     
     # === TANKS ===
-    "light_tank": {"name": "تانک سبک", "cost": 500, "power": 80, "category": "tank", "emoji": "🚗", "level_req": 2},
-    "medium_tank": {"name": "تانک متوسط", "cost": 800, "power": 120, "category": "tank", "emoji": "🚗", "level_req": 3},
-    "heavy_tank": {"name": "تانک سنگین", "cost": 1200, "power": 180, "category": "tank", "emoji": "🚗", "level_req": 4},
-    "mbt": {"name": "تانک اصلی نبرد", "cost": 2000, "power": 300, "category": "tank", "emoji": "🚗", "level_req": 5},
-    "abrams": {"name": "آبرامز M1A2", "cost": 3000, "power": 450, "category": "tank", "emoji": "🚗", "level_req": 6},
-    "leopard": {"name": "لئوپارد 2A7", "cost": 3200, "power": 480, "category": "tank", "emoji": "🚗", "level_req": 6},
-    "t90": {"name": "تی-90", "cost": 2800, "power": 420, "category": "tank", "emoji": "🚗", "level_req": 6},
-    "challenger": {"name": "چلنجر 2", "cost": 3500, "power": 500, "category": "tank", "emoji": "🚗", "level_req": 7},
-    "armata": {"name": "آرماتا T-14", "cost": 4000, "power": 600, "category": "tank", "emoji": "🚗", "level_req": 8},
+    ("light_tank", {"name": "تانک سبک", "cost": 500, "power": 80, "category": "tank", "emoji": "🚗", "level_req": 2}),
+    ("medium_tank", {"name": "تانک متوسط", "cost": 800, "power": 120, "category": "tank", "emoji": "🚗", "level_req": 3}),
+    ("heavy_tank", {"name": "تانک سنگین", "cost": 1200, "power": 180, "category": "tank", "emoji": "🚗", "level_req": 4}),
+    ("mbt", {"name": "تانک اصلی نبرد", "cost": 2000, "power": 300, "category": "tank", "emoji": "🚗", "level_req": 5}),
+    ("abrams", {"name": "آبرامز M1A2", "cost": 3000, "power": 450, "category": "tank", "emoji": "🚗", "level_req": 6}),
+    ("leopard", {"name": "لئوپارد 2A7", "cost": 3200, "power": 480, "category": "tank", "emoji": "🚗", "level_req": 6}),
+    ("t90", {"name": "تی-90", "cost": 2800, "power": 420, "category": "tank", "emoji": "🚗", "level_req": 6}),
+    ("challenger", {"name": "چلنجر 2", "cost": 3500, "power": 500, "category": "tank", "emoji": "🚗", "level_req": 7}),
+    ("armata", {"name": "آرماتا T-14", "cost": 4000, "power": 600, "category": "tank", "emoji": "🚗", "level_req": 8}),
     
     # === ARTILLERY ===
-    "mortar": {"name": "خمپاره", "cost": 200, "power": 60, "category": "artillery", "emoji": "💣", "level_req": 2},
-    "howitzer": {"name": "توپخانه", "cost": 600, "power": 150, "category": "artillery", "emoji": "💣", "level_req": 3},
-    "mlrs": {"name": "سامانه راکت انداز", "cost": 1000, "power": 250, "category": "artillery", "emoji": "🚀", "level_req": 4},
-    "railgun": {"name": "توپ ریل", "cost": 5000, "power": 800, "category": "artillery", "emoji": "⚡", "level_req": 8},
-    "himears": {"name": "هایمارز", "cost": 1500, "power": 300, "category": "artillery", "emoji": "🚀", "level_req": 5},
-    "pzh2000": {"name": "پی‌زد 2000", "cost": 2000, "power": 400, "category": "artillery", "emoji": "💣", "level_req": 6},
+    ("mortar", {"name": "خمپاره", "cost": 200, "power": 60, "category": "artillery", "emoji": "💣", "level_req": 2}),
+    ("howitzer", {"name": "توپخانه", "cost": 600, "power": 150, "category": "artillery", "emoji": "💣", "level_req": 3}),
+    ("mlrs", {"name": "سامانه راکت انداز", "cost": 1000, "power": 250, "category": "artillery", "emoji": "🚀", "level_req": 4}),
+    ("rail_artillery", {"name": "توپخانه ریلی", "cost": 5000, "power": 800, "category": "artillery", "emoji": "⚡", "level_req": 8}),
+    ("himears", {"name": "هایمارز", "cost": 1500, "power": 300, "category": "artillery", "emoji": "🚀", "level_req": 5}),
+    ("pzh2000", {"name": "پی‌زد 2000", "cost": 2000, "power": 400, "category": "artillery", "emoji": "💣", "level_req": 6}),
     
     # === ANTI-AIR ===
-    "stinger": {"name": "استینگر", "cost": 300, "power": 40, "category": "anti_air", "emoji": "🚀", "level_req": 2},
-    "patriot": {"name": "پاتریوت", "cost": 2000, "power": 200, "category": "anti_air", "emoji": "🛡️", "level_req": 5},
-    "s400": {"name": "اس-400", "cost": 3000, "power": 300, "category": "anti_air", "emoji": "🛡️", "level_req": 6},
-    "iron_dome": {"name": "گنبد آهنی", "cost": 1500, "power": 150, "category": "anti_air", "emoji": "🛡️", "level_req": 4},
-    "thad": {"name": "تاد", "cost": 4000, "power": 500, "category": "anti_air", "emoji": "🛡️", "level_req": 7},
+    ("stinger", {"name": "استینگر", "cost": 300, "power": 40, "category": "anti_air", "emoji": "🚀", "level_req": 2}),
+    ("patriot", {"name": "پاتریوت", "cost": 2000, "power": 200, "category": "anti_air", "emoji": "🛡️", "level_req": 5}),
+    ("s400", {"name": "اس-400", "cost": 3000, "power": 300, "category": "anti_air", "emoji": "🛡️", "level_req": 6}),
+    ("iron_dome", {"name": "گنبد آهنی", "cost": 1500, "power": 150, "category": "anti_air", "emoji": "🛡️", "level_req": 4}),
+    ("thad", {"name": "تاد", "cost": 4000, "power": 500, "category": "anti_air", "emoji": "🛡️", "level_req": 7}),
     
     # === FIGHTER AIRCRAFT ===
-    "f16": {"name": "اف-16", "cost": 2000, "power": 200, "category": "fighter", "emoji": "✈️", "level_req": 3},
-    "f22": {"name": "اف-22 رپتور", "cost": 5000, "power": 500, "category": "fighter", "emoji": "✈️", "level_req": 6},
-    "f35": {"name": "اف-35", "cost": 6000, "power": 600, "category": "fighter", "emoji": "✈️", "level_req": 7},
-    "su27": {"name": "سو-27", "cost": 3000, "power": 300, "category": "fighter", "emoji": "✈️", "level_req": 4},
-    "su35": {"name": "سو-35", "cost": 4000, "power": 400, "category": "fighter", "emoji": "✈️", "level_req": 5},
-    "su57": {"name": "سو-57", "cost": 7000, "power": 700, "category": "fighter", "emoji": "✈️", "level_req": 8},
-    "j20": {"name": "جی-20", "cost": 5500, "power": 550, "category": "fighter", "emoji": "✈️", "level_req": 7},
-    "eurofighter": {"name": "یوروفایتر", "cost": 3500, "power": 350, "category": "fighter", "emoji": "✈️", "level_req": 5},
-    "rafale": {"name": "رافال", "cost": 3800, "power": 380, "category": "fighter", "emoji": "✈️", "level_req": 5},
-    "gripen": {"name": "گریپن", "cost": 2500, "power": 250, "category": "fighter", "emoji": "✈️", "level_req": 4},
+    ("f16", {"name": "اف-16", "cost": 2000, "power": 200, "category": "fighter", "emoji": "✈️", "level_req": 3}),
+    ("f22", {"name": "اف-22 رپتور", "cost": 5000, "power": 500, "category": "fighter", "emoji": "✈️", "level_req": 6}),
+    ("f35", {"name": "اف-35", "cost": 6000, "power": 600, "category": "fighter", "emoji": "✈️", "level_req": 7}),
+    ("su27", {"name": "سو-27", "cost": 3000, "power": 300, "category": "fighter", "emoji": "✈️", "level_req": 4}),
+    ("su35", {"name": "سو-35", "cost": 4000, "power": 400, "category": "fighter", "emoji": "✈️", "level_req": 5}),
+    ("su57", {"name": "سو-57", "cost": 7000, "power": 700, "category": "fighter", "emoji": "✈️", "level_req": 8}),
+    ("j20", {"name": "جی-20", "cost": 5500, "power": 550, "category": "fighter", "emoji": "✈️", "level_req": 7}),
+    ("eurofighter", {"name": "یوروفایتر", "cost": 3500, "power": 350, "category": "fighter", "emoji": "✈️", "level_req": 5}),
+    ("rafale", {"name": "رافال", "cost": 3800, "power": 380, "category": "fighter", "emoji": "✈️", "level_req": 5}),
+    ("gripen", {"name": "گریپن", "cost": 2500, "power": 250, "category": "fighter", "emoji": "✈️", "level_req": 4}),
     
     # === BOMBERS ===
-    "b52": {"name": "بی-52", "cost": 4000, "power": 400, "category": "bomber", "emoji": "✈️", "level_req": 5},
-    "b1": {"name": "بی-1 لنسر", "cost": 5000, "power": 500, "category": "bomber", "emoji": "✈️", "level_req": 6},
-    "b2": {"name": "بی-2 اسپیریت", "cost": 8000, "power": 800, "category": "bomber", "emoji": "✈️", "level_req": 8},
-    "tu95": {"name": "تو-95", "cost": 3500, "power": 350, "category": "bomber", "emoji": "✈️", "level_req": 5},
-    "tu160": {"name": "تو-160", "cost": 6000, "power": 600, "category": "bomber", "emoji": "✈️", "level_req": 7},
-    "tu22m": {"name": "تو-22M", "cost": 4500, "power": 450, "category": "bomber", "emoji": "✈️", "level_req": 6},
+    ("b52", {"name": "بی-52", "cost": 4000, "power": 400, "category": "bomber", "emoji": "✈️", "level_req": 5}),
+    ("b1", {"name": "بی-1 لنسر", "cost": 5000, "power": 500, "category": "bomber", "emoji": "✈️", "level_req": 6}),
+    ("b2", {"name": "بی-2 اسپیریت", "cost": 8000, "power": 800, "category": "bomber", "emoji": "✈️", "level_req": 8}),
+    ("tu95", {"name": "تو-95", "cost": 3500, "power": 350, "category": "bomber", "emoji": "✈️", "level_req": 5}),
+    ("tu160", {"name": "تو-160", "cost": 6000, "power": 600, "category": "bomber", "emoji": "✈️", "level_req": 7}),
+    ("tu22m", {"name": "تو-22M", "cost": 4500, "power": 450, "category": "bomber", "emoji": "✈️", "level_req": 6}),
     
     # === HELICOPTERS ===
-    "apache": {"name": "آپاچی", "cost": 1500, "power": 150, "category": "helicopter", "emoji": "🚁", "level_req": 3},
-    "black_hawk": {"name": "بلک هاوک", "cost": 1200, "power": 120, "category": "helicopter", "emoji": "🚁", "level_req": 3},
-    "chinook": {"name": "چینوک", "cost": 1000, "power": 100, "category": "helicopter", "emoji": "🚁", "level_req": 2},
-    "mi24": {"name": "می-24", "cost": 1800, "power": 180, "category": "helicopter", "emoji": "🚁", "level_req": 4},
-    "mi28": {"name": "می-28", "cost": 2000, "power": 200, "category": "helicopter", "emoji": "🚁", "level_req": 4},
-    "ka52": {"name": "کا-52", "cost": 2200, "power": 220, "category": "helicopter", "emoji": "🚁", "level_req": 5},
-    "tiger": {"name": "تیگر", "cost": 2500, "power": 250, "category": "helicopter", "emoji": "🚁", "level_req": 5},
+    ("apache", {"name": "آپاچی", "cost": 1500, "power": 150, "category": "helicopter", "emoji": "🚁", "level_req": 3}),
+    ("black_hawk", {"name": "بلک هاوک", "cost": 1200, "power": 120, "category": "helicopter", "emoji": "🚁", "level_req": 3}),
+    ("chinook", {"name": "چینوک", "cost": 1000, "power": 100, "category": "helicopter", "emoji": "🚁", "level_req": 2}),
+    ("mi24", {"name": "می-24", "cost": 1800, "power": 180, "category": "helicopter", "emoji": "🚁", "level_req": 4}),
+    ("mi28", {"name": "می-28", "cost": 2000, "power": 200, "category": "helicopter", "emoji": "🚁", "level_req": 4}),
+    ("ka52", {"name": "کا-52", "cost": 2200, "power": 220, "category": "helicopter", "emoji": "🚁", "level_req": 5}),
+    ("tiger", {"name": "تیگر", "cost": 2500, "power": 250, "category": "helicopter", "emoji": "🚁", "level_req": 5}),
     
     # === DRONES ===
-    "predator": {"name": "پردیتور", "cost": 800, "power": 80, "category": "drone", "emoji": "🚁", "level_req": 2},
-    "reaper": {"name": "ریپر", "cost": 1200, "power": 120, "category": "drone", "emoji": "🚁", "level_req": 3},
-    "global_hawk": {"name": "گلوبال هاوک", "cost": 2000, "power": 200, "category": "drone", "emoji": "🚁", "level_req": 4},
-    "bayraktar": {"name": "بیرق‌دار", "cost": 600, "power": 60, "category": "drone", "emoji": "🚁", "level_req": 2},
-    "shahed": {"name": "شاهد", "cost": 400, "power": 40, "category": "drone", "emoji": "🚁", "level_req": 1},
-    "switchblade": {"name": "سوئیچ‌بلید", "cost": 300, "power": 30, "category": "drone", "emoji": "🚁", "level_req": 1},
-    "kamikaze": {"name": "کامیکازه", "cost": 200, "power": 20, "category": "drone", "emoji": "💥", "level_req": 1},
+    ("predator", {"name": "پردیتور", "cost": 800, "power": 80, "category": "drone", "emoji": "🚁", "level_req": 2}),
+    ("reaper", {"name": "ریپر", "cost": 1200, "power": 120, "category": "drone", "emoji": "🚁", "level_req": 3}),
+    ("global_hawk", {"name": "گلوبال هاوک", "cost": 2000, "power": 200, "category": "drone", "emoji": "🚁", "level_req": 4}),
+    ("bayraktar", {"name": "بیرق‌دار", "cost": 600, "power": 60, "category": "drone", "emoji": "🚁", "level_req": 2}),
+    ("shahed", {"name": "شاهد", "cost": 400, "power": 40, "category": "drone", "emoji": "🚁", "level_req": 1}),
+    ("switchblade", {"name": "سوئیچ‌بلید", "cost": 300, "power": 30, "category": "drone", "emoji": "🚁", "level_req": 1}),
+    ("kamikaze", {"name": "کامیکازه", "cost": 200, "power": 20, "category": "drone", "emoji": "💥", "level_req": 1}),
     
     # === NAVAL SHIPS ===
-    "patrol_boat": {"name": "قایق گشت", "cost": 500, "power": 50, "category": "naval", "emoji": "🚤", "level_req": 2},
-    "corvette": {"name": "کوروت", "cost": 1500, "power": 150, "category": "naval", "emoji": "🚢", "level_req": 3},
-    "frigate": {"name": "فرگیت", "cost": 3000, "power": 300, "category": "naval", "emoji": "🚢", "level_req": 4},
-    "destroyer": {"name": "ناوشکن", "cost": 5000, "power": 500, "category": "naval", "emoji": "🚢", "level_req": 5},
-    "cruiser": {"name": "کروزر", "cost": 8000, "power": 800, "category": "naval", "emoji": "🚢", "level_req": 6},
-    "battleship": {"name": "ناو جنگی", "cost": 12000, "power": 1200, "category": "naval", "emoji": "🚢", "level_req": 7},
-    "aircraft_carrier": {"name": "ناو هواپیمابر", "cost": 25000, "power": 2500, "category": "naval", "emoji": "🚢", "level_req": 8},
-    "submarine": {"name": "زیردریایی", "cost": 6000, "power": 600, "category": "naval", "emoji": "🛳️", "level_req": 5},
-    "nuclear_sub": {"name": "زیردریایی هسته‌ای", "cost": 15000, "power": 1500, "category": "naval", "emoji": "🛳️", "level_req": 7},
-    "littoral": {"name": "ناو ساحلی", "cost": 2000, "power": 200, "category": "naval", "emoji": "🚢", "level_req": 3},
+    ("patrol_boat", {"name": "قایق گشت", "cost": 500, "power": 50, "category": "naval", "emoji": "🚤", "level_req": 2}),
+    ("corvette", {"name": "کوروت", "cost": 1500, "power": 150, "category": "naval", "emoji": "🚢", "level_req": 3}),
+    ("frigate", {"name": "فرگیت", "cost": 3000, "power": 300, "category": "naval", "emoji": "🚢", "level_req": 4}),
+    ("destroyer", {"name": "ناوشکن", "cost": 5000, "power": 500, "category": "naval", "emoji": "🚢", "level_req": 5}),
+    ("cruiser", {"name": "کروزر", "cost": 8000, "power": 800, "category": "naval", "emoji": "🚢", "level_req": 6}),
+    ("battleship", {"name": "ناو جنگی", "cost": 12000, "power": 1200, "category": "naval", "emoji": "🚢", "level_req": 7}),
+    ("aircraft_carrier", {"name": "ناو هواپیمابر", "cost": 25000, "power": 2500, "category": "naval", "emoji": "🚢", "level_req": 8}),
+    ("submarine", {"name": "زیردریایی", "cost": 6000, "power": 600, "category": "naval", "emoji": "🛳️", "level_req": 5}),
+    ("nuclear_sub", {"name": "زیردریایی هسته‌ای", "cost": 15000, "power": 1500, "category": "naval", "emoji": "🛳️", "level_req": 7}),
+    ("littoral", {"name": "ناو ساحلی", "cost": 2000, "power": 200, "category": "naval", "emoji": "🚢", "level_req": 3}),
     
     # === MISSILES ===
-    "hellfire": {"name": "هلفایر", "cost": 200, "power": 100, "category": "missile", "emoji": "🚀", "level_req": 2},
-    "tomahawk": {"name": "توماهوک", "cost": 1000, "power": 500, "category": "missile", "emoji": "🚀", "level_req": 4},
-    "scud": {"name": "اسکاد", "cost": 800, "power": 400, "category": "missile", "emoji": "🚀", "level_req": 3},
-    "patriot_missile": {"name": "موشک پاتریوت", "cost": 500, "power": 250, "category": "missile", "emoji": "🚀", "level_req": 3},
-    "s400_missile": {"name": "موشک اس-400", "cost": 600, "power": 300, "category": "missile", "emoji": "🚀", "level_req": 4},
-    "icbm": {"name": "موشک بالستیک قاره‌ای", "cost": 5000, "power": 2000, "category": "missile", "emoji": "🚀", "level_req": 8},
-    "cruise": {"name": "موشک کروز", "cost": 1200, "power": 600, "category": "missile", "emoji": "🚀", "level_req": 4},
-    "ballistic": {"name": "موشک بالستیک", "cost": 2000, "power": 1000, "category": "missile", "emoji": "🚀", "level_req": 5},
-    "hypersonic": {"name": "موشک فراصوت", "cost": 3000, "power": 1500, "category": "missile", "emoji": "🚀", "level_req": 6},
-    "nuclear_missile": {"name": "موشک هسته‌ای", "cost": 10000, "power": 5000, "category": "missile", "emoji": "☢️", "level_req": 9},
+    ("hellfire", {"name": "هلفایر", "cost": 200, "power": 100, "category": "missile", "emoji": "🚀", "level_req": 2}),
+    ("tomahawk", {"name": "توماهوک", "cost": 1000, "power": 500, "category": "missile", "emoji": "🚀", "level_req": 4}),
+    ("scud", {"name": "اسکاد", "cost": 800, "power": 400, "category": "missile", "emoji": "🚀", "level_req": 3}),
+    ("patriot_missile", {"name": "موشک پاتریوت", "cost": 500, "power": 250, "category": "missile", "emoji": "🚀", "level_req": 3}),
+    ("s400_missile", {"name": "موشک اس-400", "cost": 600, "power": 300, "category": "missile", "emoji": "🚀", "level_req": 4}),
+    ("icbm", {"name": "موشک بالستیک قاره‌ای", "cost": 5000, "power": 2000, "category": "missile", "emoji": "🚀", "level_req": 8}),
+    ("cruise", {"name": "موشک کروز", "cost": 1200, "power": 600, "category": "missile", "emoji": "🚀", "level_req": 4}),
+    ("ballistic", {"name": "موشک بالستیک", "cost": 2000, "power": 1000, "category": "missile", "emoji": "🚀", "level_req": 5}),
+    ("hypersonic", {"name": "موشک فراصوت", "cost": 3000, "power": 1500, "category": "missile", "emoji": "🚀", "level_req": 6}),
+    ("nuclear_missile", {"name": "موشک هسته‌ای", "cost": 10000, "power": 5000, "category": "missile", "emoji": "☢️", "level_req": 9}),
     
     # === SPECIAL WEAPONS ===
-    "laser_weapon": {"name": "سلاح لیزری", "cost": 8000, "power": 1000, "category": "special", "emoji": "⚡", "level_req": 8},
-    "railgun": {"name": "توپ ریل", "cost": 6000, "power": 800, "category": "special", "emoji": "⚡", "level_req": 7},
-    "plasma_weapon": {"name": "سلاح پلاسما", "cost": 12000, "power": 1500, "category": "special", "emoji": "⚡", "level_req": 9},
-    "nuclear_bomb": {"name": "بمب هسته‌ای", "cost": 15000, "power": 3000, "category": "special", "emoji": "☢️", "level_req": 9},
-    "hydrogen_bomb": {"name": "بمب هیدروژنی", "cost": 25000, "power": 5000, "category": "special", "emoji": "☢️", "level_req": 10},
-    "neutron_bomb": {"name": "بمب نوترونی", "cost": 20000, "power": 4000, "category": "special", "emoji": "☢️", "level_req": 9},
-    "emp_weapon": {"name": "سلاح الکترومغناطیسی", "cost": 10000, "power": 2000, "category": "special", "emoji": "⚡", "level_req": 8},
-    "chemical_weapon": {"name": "سلاح شیمیایی", "cost": 5000, "power": 1000, "category": "special", "emoji": "☠️", "level_req": 6},
-    "biological_weapon": {"name": "سلاح بیولوژیکی", "cost": 8000, "power": 1500, "category": "special", "emoji": "🦠", "level_req": 7},
-    "cyber_weapon": {"name": "سلاح سایبری", "cost": 3000, "power": 500, "category": "special", "emoji": "💻", "level_req": 5},
+    ("laser_weapon", {"name": "سلاح لیزری", "cost": 8000, "power": 1000, "category": "special", "emoji": "⚡", "level_req": 8}),
+    ("railgun", {"name": "توپ ریل", "cost": 6000, "power": 800, "category": "special", "emoji": "⚡", "level_req": 7}),
+    ("plasma_weapon", {"name": "سلاح پلاسما", "cost": 12000, "power": 1500, "category": "special", "emoji": "⚡", "level_req": 9}),
+    ("nuclear_bomb", {"name": "بمب هسته‌ای", "cost": 15000, "power": 3000, "category": "special", "emoji": "☢️", "level_req": 9}),
+    ("hydrogen_bomb", {"name": "بمب هیدروژنی", "cost": 25000, "power": 5000, "category": "special", "emoji": "☢️", "level_req": 10}),
+    ("neutron_bomb", {"name": "بمب نوترونی", "cost": 20000, "power": 4000, "category": "special", "emoji": "☢️", "level_req": 9}),
+    ("emp_weapon", {"name": "سلاح الکترومغناطیسی", "cost": 10000, "power": 2000, "category": "special", "emoji": "⚡", "level_req": 8}),
+    ("chemical_weapon", {"name": "سلاح شیمیایی", "cost": 5000, "power": 1000, "category": "special", "emoji": "☠️", "level_req": 6}),
+    ("biological_weapon", {"name": "سلاح بیولوژیکی", "cost": 8000, "power": 1500, "category": "special", "emoji": "🦠", "level_req": 7}),
+    ("cyber_weapon", {"name": "سلاح سایبری", "cost": 3000, "power": 500, "category": "special", "emoji": "💻", "level_req": 5}),
     
     # === DEFENSE SYSTEMS ===
-    "bunker": {"name": "پناهگاه", "cost": 1000, "power": 200, "category": "defense", "emoji": "🏰", "level_req": 3},
-    "fortress": {"name": "قلعه", "cost": 3000, "power": 600, "category": "defense", "emoji": "🏰", "level_req": 5},
-    "wall": {"name": "دیوار دفاعی", "cost": 500, "power": 100, "category": "defense", "emoji": "🧱", "level_req": 2},
-    "minefield": {"name": "میدان مین", "cost": 300, "power": 50, "category": "defense", "emoji": "💣", "level_req": 1},
-    "radar": {"name": "رادار", "cost": 800, "power": 0, "category": "defense", "emoji": "📡", "level_req": 2},
-    "sonar": {"name": "سونار", "cost": 600, "power": 0, "category": "defense", "emoji": "📡", "level_req": 2},
-    "satellite": {"name": "ماهواره", "cost": 5000, "power": 0, "category": "defense", "emoji": "🛰️", "level_req": 6},
-    "space_station": {"name": "ایستگاه فضایی", "cost": 20000, "power": 2000, "category": "defense", "emoji": "🛰️", "level_req": 9},
-    "force_field": {"name": "میدان نیرو", "cost": 15000, "power": 3000, "category": "defense", "emoji": "🛡️", "level_req": 8},
-    "quantum_shield": {"name": "سپر کوانتومی", "cost": 30000, "power": 5000, "category": "defense", "emoji": "🛡️", "level_req": 10},
-}
+    ("bunker", {"name": "پناهگاه", "cost": 1000, "power": 200, "category": "defense", "emoji": "🏰", "level_req": 3}),
+    ("fortress", {"name": "قلعه", "cost": 3000, "power": 600, "category": "defense", "emoji": "🏰", "level_req": 5}),
+    ("wall", {"name": "دیوار دفاعی", "cost": 500, "power": 100, "category": "defense", "emoji": "🧱", "level_req": 2}),
+    ("minefield", {"name": "میدان مین", "cost": 300, "power": 50, "category": "defense", "emoji": "💣", "level_req": 1}),
+    ("radar", {"name": "رادار", "cost": 800, "power": 0, "category": "defense", "emoji": "📡", "level_req": 2}),
+    ("sonar", {"name": "سونار", "cost": 600, "power": 0, "category": "defense", "emoji": "📡", "level_req": 2}),
+    ("satellite", {"name": "ماهواره", "cost": 5000, "power": 0, "category": "defense", "emoji": "🛰️", "level_req": 6}),
+    ("space_station", {"name": "ایستگاه فضایی", "cost": 20000, "power": 2000, "category": "defense", "emoji": "🛰️", "level_req": 9}),
+    ("force_field", {"name": "میدان نیرو", "cost": 15000, "power": 3000, "category": "defense", "emoji": "🛡️", "level_req": 8}),
+    ("quantum_shield", {"name": "سپر کوانتومی", "cost": 30000, "power": 5000, "category": "defense", "emoji": "🛡️", "level_req": 10}),
+]
 
 # Resource Types
 RESOURCES = {
@@ -476,376 +582,3532 @@ CAPITAL_UPGRADES = {
     "nuclear_program": {"name": "برنامه هسته‌ای", "levels": 5, "cost_multiplier": 10000, "benefits": ["nuclear_units", "deterrence"]},
 }
 
-# ==================== DATA MANAGEMENT ====================
-def load_data():
-    """بارگذاری داده‌ها از فایل"""
-    global game_data
-    try:
-        if os.path.exists(DATA_FILE):
-            with open(DATA_FILE, 'r', encoding='utf-8') as f:
-                game_data = json.load(f)
-        else:
-            game_data = {
-                "users": {},
-                "countries": {},
-                "alliances": {},
-                "battles": [],
-                "logs": []
-            }
-    except Exception as e:
-        print(f"خطا در بارگذاری داده‌ها: {e}")
-        game_data = {
-            "users": {},
-            "countries": {},
-            "alliances": {},
-            "battles": [],
-            "logs": []
-        }
+# Research & Diplomacy
+RESEARCH_TYPES = {
+    "military": "فناوری نظامی",
+    "defense": "فناوری دفاعی",
+    "economy": "فناوری اقتصادی",
+    "intelligence": "فناوری اطلاعاتی",
+    "space": "فناوری فضایی",
+}
 
-def save_data():
-    """ذخیره داده‌ها در فایل"""
-    try:
-        with open(DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(game_data, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"خطا در ذخیره داده‌ها: {e}")
+DIPLOMACY_TYPES = {
+    "trade": "مذاکره تجاری",
+    "non_aggression": "پیمان عدم تجاوز",
+    "military_pact": "اتحاد نظامی",
+    "sanction": "تحریم اقتصادی",
+    "peace": "مذاکره صلح",
+}
 
-def log_message(chat_id, user_id, message_type, content):
-    """ثبت پیام در لاگ"""
-    try:
-        log_entry = {
-            "timestamp": datetime.now().isoformat(),
-            "chat_id": chat_id,
-            "user_id": user_id,
-            "type": message_type,
-            "content": content
-        }
-        game_data["logs"].append(log_entry)
-        
-        # محدود کردن تعداد لاگ‌ها
-        if len(game_data["logs"]) > 10000:
-            game_data["logs"] = game_data["logs"][-5000:]  # نگه داشتن 5000 لاگ آخر
-        
-        # ذخیره در فایل لاگ
-        with open(LOG_FILE, 'a', encoding='utf-8') as f:
-            f.write(f"{datetime.now().isoformat()} | {chat_id} | {user_id} | {message_type} | {content}\n")
-        
-        # ذخیره داده‌ها
-        save_data()
-        
-    except Exception as e:
-        print(f"خطا در ثبت لاگ: {e}")
+# ==================== UNIT CATALOG ====================
+UNIT_FIELDS = ("name", "cost", "power", "category", "emoji", "level_req")
 
-def get_user_data(chat_id, user_id):
-    """دریافت یا ایجاد داده کاربر"""
-    user_key = f"{chat_id}:{user_id}"
-    if user_key not in game_data["users"]:
-        game_data["users"][user_key] = {
-            "level": 1,
-            "experience": 0,
-            "resources": {resource: 1000 for resource in RESOURCES},
-            "military": {},
-            "capital": {upgrade: 0 for upgrade in CAPITAL_UPGRADES},
-            "battles_won": 0,
-            "battles_lost": 0,
-            "territory_conquered": 0,
-            "alliance": None,
-            "last_active": datetime.now().isoformat(),
-            "achievements": [],
-            "research": {},
-            "diplomacy": {},
-            "spies": 0,
-            "intelligence": 0,
-            "government": "democracy",  # سیستم مدیریت
-            "collectors": {collector: 0 for collector in RESOURCE_COLLECTORS},  # کالکتورها
-            "last_collection": datetime.now().isoformat(),  # آخرین جمع‌آوری
-            "stability": 100,  # پایداری کشور
-            "rebellion_risk": 0,  # خطر شورش
-            "government_changes": 0,  # تعداد تغییرات حکومت
-            "collector_efficiency": 1.0  # کارایی کالکتورها
-        }
-    return game_data["users"][user_key]
+UNIT_CATEGORIES = {
+    "infantry": "پیاده نظام",
+    "light_vehicle": "خودروهای سبک",
+    "tank": "تانک‌ها",
+    "artillery": "توپخانه",
+    "anti_air": "ضدهوایی",
+    "fighter": "جنگنده‌ها",
+    "bomber": "بمب‌افکن‌ها",
+    "helicopter": "هلیکوپترها",
+    "drone": "پهپادها",
+    "naval": "نیروی دریایی",
+    "missile": "موشک‌ها",
+    "special": "سلاح‌های ویژه",
+    "defense": "سیستم‌های دفاعی"
+}
 
-def get_country_data(chat_id, user_id):
-    """دریافت یا ایجاد داده کشور"""
-    country_key = f"{chat_id}:{user_id}"
-    if country_key not in game_data["countries"]:
-        game_data["countries"][country_key] = {
-            "name": f"کشور {user_id}",
-            "level": 1,
-            "population": 1000000,
-            "territory": 1000,
-            "defense_level": 1,
-            "fortifications": 0,
-            "conquered_by": None,
-            "conquest_time": None,
-            "rebellion_chance": 0.1
-        }
-    return game_data["countries"][country_key]
+CATEGORY_KEYS = tuple(UNIT_CATEGORIES)
 
-# ==================== HELPER FUNCTIONS ====================
-def calculate_total_power(user_data):
-    """محاسبه قدرت کل نظامی"""
-    total_power = 0
-    for unit_type, count in user_data["military"].items():
-        if unit_type in MILITARY_UNITS and count > 0:
-            unit_power = MILITARY_UNITS[unit_type]["power"]
-            # اعمال بونوس آکادمی نظامی
-            academy_level = user_data["capital"].get("military_academy", 0)
-            power_bonus = 1 + (academy_level * 0.1)
-            total_power += unit_power * count * power_bonus
-    return int(total_power)
+class UnitCatalog:
+    """
+    کاتالوگ ثابت واحدهای نظامی که یکبار هنگام import ساخته می‌شود
 
-def calculate_country_level(user_data):
-    """محاسبه سطح کشور بر اساس قدرت و منابع"""
-    military_power = calculate_total_power(user_data)
-    total_resources = sum(user_data["resources"].values())
-    experience = user_data["experience"]
-    
-    # فرمول محاسبه سطح
-    level = 1 + (military_power // 1000) + (total_resources // 10000) + (experience // 1000)
-    return min(level, 50)  # حداکثر سطح 50
+    هر واحد یک شناسه عددی دارد و هزینه، قدرت و سطح مورد نیاز در آرایه‌های موازی
+    نگهداری می‌شوند. ایندکس دسته‌ها و ایندکس مرتب بر اساس سطح (برای جستجوی دودویی
+    واحدهای در دسترس) از پیش محاسبه می‌شوند. کلید تکراری یا فیلد ناقص خطا می‌دهد.
+    """
 
-def can_afford_unit(user_data, unit_type, quantity=1):
-    """بررسی امکان خرید واحد"""
-    if unit_type not in MILITARY_UNITS:
-        return False, "واحد نامعتبر"
-    
-    unit = MILITARY_UNITS[unit_type]
-    user_level = user_data["level"]
-    
-    if user_level < unit["level_req"]:
-        return False, f"نیاز به سطح {unit['level_req']}"
-    
-    # بررسی منابع مورد نیاز
-    cost = unit["cost"] * quantity
-    if user_data["resources"]["money"] < cost:
-        return False, "پول کافی ندارید"
-    
-    return True, "موفق"
+    def __init__(self, definitions):
+        keys = []
+        specs = {}
+        for key, spec in definitions:
+            if key in specs:
+                raise ValueError(f"کلید تکراری در کاتالوگ واحدها: {key}")
+            missing = [field for field in UNIT_FIELDS if field not in spec]
+            if missing:
+                raise ValueError(f"فیلدهای ناقص برای واحد {key}: {', '.join(missing)}")
+            if spec["category"] not in UNIT_CATEGORIES:
+                raise ValueError(f"دسته نامعتبر برای واحد {key}: {spec['category']}")
+            keys.append(key)
+            specs[key] = MappingProxyType(dict(spec))
 
-def can_attack(attacker_data, defender_data, attacker_country, defender_country):
-    """بررسی امکان حمله"""
-    attacker_level = attacker_country["level"]
-    defender_level = defender_country["level"]
-    
-    # نمی‌توان به کشورهای خیلی قوی‌تر حمله کرد
-    if defender_level > attacker_level * 2:
-        return False, "کشور هدف خیلی قوی است"
-    
-    # بررسی اتحاد
-    if (attacker_data["alliance"] and defender_data["alliance"] and 
-        attacker_data["alliance"] == defender_data["alliance"]):
-        return False, "نمی‌توان به متحد حمله کرد"
-    
-    return True, "موفق"
+        self.keys = tuple(keys)
+        self.ids = MappingProxyType({key: unit_id for unit_id, key in enumerate(keys)})
+        self.units = MappingProxyType(specs)
+        self.cost = tuple(specs[key]["cost"] for key in keys)
+        self.power = tuple(specs[key]["power"] for key in keys)
+        self.level = tuple(specs[key]["level_req"] for key in keys)
+        self.category_index = tuple(CATEGORY_KEYS.index(specs[key]["category"]) for key in keys)
 
-# ==================== BOT COMMANDS ====================
-@bot.event
-async def on_ready():
-    """راه‌اندازی ربات"""
-    print(f"🤖 {bot.user.username} آماده است!")
-    load_data()
-    log_message("system", "bot", "startup", "Bot started successfully")
+        # ایندکس دسته‌ها (به ترتیب تعریف)
+        by_category = {}
+        for unit_id, key in enumerate(keys):
+            by_category.setdefault(specs[key]["category"], []).append(unit_id)
+        self.by_category = MappingProxyType({category: tuple(ids) for category, ids in by_category.items()})
+        self.category_order = MappingProxyType({category: order for order, category in enumerate(by_category)})
 
-@bot.event
-async def on_message(message: Message):
-    """مدیریت پیام‌ها"""
-    try:
-        if message.author.is_bot:
-            return
-        
-        chat_id = message.chat.id
-        user_id = message.author.user_id
-        text = message.content or ""
-        
-        # ثبت لاگ
-        log_message(chat_id, user_id, "message", text)
-        
-        # اعطای امتیاز برای فعالیت
-        await handle_activity_points(message, chat_id, user_id)
-        
-        # پردازش دستورات
-        if text.startswith("/"):
-            await handle_command(message, text.lower(), chat_id, user_id)
-        elif text in ["🏰 پایتخت", "⚔️ نیروی نظامی", "🛒 فروشگاه", "💰 وضعیت", "🏆 رتبه‌بندی", "🤝 اتحاد", "🕵️ جاسوسی", "🔬 تحقیقات", "🤝 دیپلماسی"]:
-            await handle_menu_button(message, text, chat_id, user_id)
-            
-    except Exception as e:
-        print(f"خطا در on_message: {e}")
-        traceback.print_exc()
+        # ایندکس مرتب بر اساس سطح مورد نیاز
+        self.by_level = tuple(sorted(range(len(keys)), key=lambda unit_id: (self.level[unit_id], unit_id)))
+        self.sorted_levels = tuple(self.level[unit_id] for unit_id in self.by_level)
 
-async def handle_activity_points(message, chat_id, user_id):
-    """اعطای امتیاز برای فعالیت"""
-    try:
-        user_data = get_user_data(chat_id, user_id)
-        current_time = datetime.now()
-        last_active = datetime.fromisoformat(user_data["last_active"])
-        
-        # اعطای امتیاز هر 5 دقیقه
-        if (current_time - last_active).seconds >= 300:
-            # تولید منابع بر اساس سطح پایتخت
-            government_level = user_data["capital"].get("government", 0)
-            economy_level = user_data["capital"].get("economy", 0)
-            
-            # محاسبه درآمد
-            money_income = 10 + (government_level * 5) + (economy_level * 3)
-            oil_income = 5 + (government_level * 2)
-            uranium_income = 1 + (government_level // 2)
-            social_credit_income = 2 + (government_level // 3)
-            technology_income = 1 + (user_data["capital"].get("research_lab", 0) * 2)
-            
-            # اعطای منابع
-            user_data["resources"]["money"] += money_income
-            user_data["resources"]["oil"] += oil_income
-            user_data["resources"]["uranium"] += uranium_income
-            user_data["resources"]["social_credit"] += social_credit_income
-            user_data["resources"]["technology"] += technology_income
-            user_data["experience"] += money_income // 2
-            user_data["last_active"] = current_time.isoformat()
-            save_data()
-            
-    except Exception as e:
-        print(f"خطا در handle_activity_points: {e}")
+    def __len__(self):
+        return len(self.keys)
 
-async def handle_command(message, command, chat_id, user_id):
-    """پردازش دستورات"""
-    try:
-        if command == "/start":
-            await start_command(message)
-        elif command == "/help":
-            await help_command(message)
-        elif command == "/status":
-            await status_command(message, chat_id, user_id)
-        elif command == "/military":
-            await military_command(message, chat_id, user_id)
-        elif command == "/shop":
-            await shop_command(message, chat_id, user_id)
-        elif command.startswith("/buy"):
-            await buy_command(message, chat_id, user_id)
-        elif command == "/attack":
-            await attack_command(message, chat_id, user_id)
-        elif command == "/capital":
-            await capital_command(message, chat_id, user_id)
-        elif command.startswith("/upgrade"):
-            await upgrade_command(message, chat_id, user_id)
-        elif command == "/alliance":
-            await alliance_command(message, chat_id, user_id)
-        elif command == "/leaderboard":
-            await leaderboard_command(message, chat_id)
-        elif command == "/clean":
-            await clean_command(message, chat_id, user_id)
-        elif command == "/spy":
-            await spy_command(message, chat_id, user_id)
-        elif command == "/research":
-            await research_command(message, chat_id, user_id)
-        elif command == "/diplomacy":
-            await diplomacy_command(message, chat_id, user_id)
-        elif command == "/collect":
-            await collect_command(message, chat_id, user_id)
-        elif command.startswith("/alliance"):
-            await handle_alliance_command(message, chat_id, user_id)
-        else:
-            await message.reply("❌ دستور نامعتبر! از /help برای راهنمایی استفاده کنید.")
-            
-    except Exception as e:
-        print(f"خطا در handle_command: {e}")
-        traceback.print_exc()
-        await message.reply("⚠️ خطایی رخ داد!")
+    def split_by_level(self, level):
+        """شناسه واحدهای در دسترس و قفل شده برای سطح داده شده"""
+        cut = bisect_right(self.sorted_levels, level)
+        return self.by_level[:cut], self.by_level[cut:]
 
-# ==================== COMMAND IMPLEMENTATIONS ====================
-async def start_command(message):
-    """دستور شروع"""
-    welcome_text = """
-🎮 **ربات شبیه‌سازی جنگ پیشرفته** 🎮
+    def available(self, level):
+        """شناسه واحدهای در دسترس برای سطح داده شده"""
+        return self.split_by_level(level)[0]
 
-خوش آمدید به دنیای جنگ و استراتژی!
+    def army_power(self, military):
+        """مجموع قدرت پایه ارتش با استفاده از آرایه‌های کاتالوگ"""
+        ids, power = self.ids, self.power
+        total = 0
+        for unit_type, count in military.items():
+            unit_id = ids.get(unit_type)
+            if unit_id is not None and count > 0:
+                total += power[unit_id] * count
+        return total
 
-**قابلیت‌های اصلی:**
-🏰 **پایتخت**: سیستم اپگرید پیشرفته
-⚔️ **120+ واحد نظامی**: از سرباز تا سلاح‌های هسته‌ای
-💰 **منابع متنوع**: پول، نفت، اورانیوم، فناوری و...
-🌍 **فتح کشورها**: حمله و فتح کشورهای دیگر
-🤝 **اتحاد و دیپلماسی**: تشکیل اتحاد و مذاکره
-🔬 **تحقیقات**: توسعه فناوری‌های جدید
-🕵️ **جاسوسی**: جمع‌آوری اطلاعات دشمن
+    def category_power(self, military):
+        """بردار قدرت پایه ارتش به ترتیب CATEGORY_KEYS"""
+        ids, power, category_index = self.ids, self.power, self.category_index
+        vector = [0.0] * len(CATEGORY_KEYS)
+        for unit_type, count in military.items():
+            unit_id = ids.get(unit_type)
+            if unit_id is not None and count > 0:
+                vector[category_index[unit_id]] += power[unit_id] * count
+        return vector
 
-**دستورات اصلی:**
-/status - وضعیت کشور شما
-/military - نیروی نظامی
-/shop - فروشگاه
-/capital - پایتخت
-/attack - حمله
-/alliance - اتحادها
-/leaderboard - رتبه‌بندی
+    def casualties(self, military, survival):
+        """تلفات هر نوع واحد از نسبت بازمانده هر دسته؛ خروجی {نوع واحد: تعداد}"""
+        losses = {}
+        for unit_type, count in military.items():
+            unit_id = self.ids.get(unit_type)
+            if unit_id is None or count <= 0:
+                continue
+            lost = int(count * (1 - survival[self.category_index[unit_id]]))
+            if lost > 0:
+                losses[unit_type] = min(lost, count)
+        return losses
 
-برای شروع از دکمه‌های زیر استفاده کنید!
-    """
-    
-    # ایجاد کیبورد منو
-    keyboard = MenuKeyboardMarkup()
-    keyboard.add(MenuKeyboardButton("💰 وضعیت"))
-    keyboard.add(MenuKeyboardButton("⚔️ نیروی نظامی"))
-    keyboard.add(MenuKeyboardButton("🛒 فروشگاه"))
-    keyboard.add(MenuKeyboardButton("🏰 پایتخت"))
-    keyboard.add(MenuKeyboardButton("🏆 رتبه‌بندی"))
-    keyboard.add(MenuKeyboardButton("🤝 اتحاد"))
-    keyboard.add(MenuKeyboardButton("🕵️ جاسوسی"))
-    keyboard.add(MenuKeyboardButton("🔬 تحقیقات"))
-    keyboard.add(MenuKeyboardButton("🤝 دیپلماسی"))
-    
-    await message.reply(welcome_text, components=keyboard)
+    def group_by_category(self, military):
+        """گروه‌بندی واحدهای ارتش بر اساس دسته؛ خروجی لیست (دسته، [(کلید، تعداد، واحد)])"""
+        groups = {}
+        for unit_type, count in military.items():
+            unit_id = self.ids.get(unit_type)
+            if unit_id is not None and count > 0:
+                unit = self.units[unit_type]
+                groups.setdefault(unit["category"], []).append((unit_id, unit_type, count, unit))
+        ordered = sorted(groups.items(), key=lambda item: self.category_order[item[0]])
+        return [(category, [row[1:] for row in sorted(rows)]) for category, rows in ordered]
 
-async def help_command(message):
-    """دستور راهنما"""
-    help_text = """
-📖 **راهنمای کامل ربات جنگ** 📖
+UNIT_CATALOG = UnitCatalog(UNIT_DEFINITIONS)
+MILITARY_UNITS = UNIT_CATALOG.units
 
-**دستورات اصلی:**
-/status - وضعیت کامل کشور
-/military - نمایش نیروی نظامی
-/shop - فروشگاه واحدها
-/capital - مدیریت پایتخت
-/attack - حمله به کشور دیگر
-/alliance - مدیریت اتحادها
-/leaderboard - جدول رتبه‌بندی
-/spy - عملیات جاسوسی
-/research - تحقیقات
-/diplomacy - دیپلماسی
-/collect - جمع‌آوری منابع
-/clean - پاکسازی پیام‌ها
+def install_catalog(definitions):
+    """بارگذاری دوباره کاتالوگ واحدها و پاک کردن قالب‌های وابسته"""
+    global UNIT_CATALOG, MILITARY_UNITS
+    UNIT_CATALOG = UnitCatalog(definitions)
+    MILITARY_UNITS = UNIT_CATALOG.units
+    templates.clear()
+    for user_data in game_data["users"].values():
+        user_data["power_cache"] = None
 
-**دستورات اتحاد:**
-/alliance create [نام] - ایجاد اتحاد
-/alliance join [نام] - پیوستن به اتحاد
-/alliance leave - ترک اتحاد
-/alliance list - لیست اتحادها
-/alliance info [نام] - اطلاعات اتحاد
-/alliance invite [ریپلای] - دعوت عضو
-/alliance kick [ریپلای] - اخراج عضو
+# ==================== I/O EXECUTOR ====================
+def cancel_task(task):
+    """لغو تسک پس‌زمینه حتی اگر event loop بسته شده باشد"""
+    if task is None or task.done():
+        return
+    try:
+        task.cancel()
+    except RuntimeError:
+        pass
 
-**منابع:**
-💰 پول - برای خرید واحدها
-🛢️ نفت - برای سوخت
-☢️ اورانیوم - برای سلاح‌های هسته‌ای
-⭐ اعتبار اجتماعی - برای دیپلماسی
-🔬 فناوری - برای تحقیقات
-👥 جمعیت - برای نیروی کار
-⚙️ فولاد - برای ساخت تجهیزات
-🔧 آلومینیوم - برای هواپیماها
-💎 تیتانیوم - برای فضاپیماها
-💠 فلزات نادر - برای فناوری پیشرفته
+class IOExecutor:
+    """
+    اجرای تمام کارهای دیسک خارج از event loop
 
-**نکات مهم:**
-• هر 5 دقیقه منابع تولید می‌شود
-• از /collect برای جمع‌آوری استفاده کنید
-• سطح کشور بر اساس قدرت و منابع محاسبه می‌شود
-• نمی‌توان به کشورهای خیلی قوی‌تر حمله کرد
-• اتحادها از حمله متقابل جلوگیری می‌کنند
-• 120+ واحد نظامی مختلف در دسترس است
+    کارها در یک صف محدود (IO_QUEUE_SIZE) قرار می‌گیرند و به ترتیب روی یک نخ
+    جداگانه اجرا می‌شوند؛ ترتیب نوشتن‌های WAL، فشرده‌سازی و لاگ حفظ می‌شود.
+    وقتی صف پر باشد، ثبت کار جدید تا آزاد شدن جا منتظر می‌ماند (فشار معکوس).
+    """
+
+    def __init__(self, max_queue):
+        self.max_queue = max_queue
+        self.completed = 0
+        self.failed = 0
+        self._executor = None
+        self._queue = None
+        self._drained = None
+        self._task = None
+
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def depth(self):
+        """تعداد کارهای در صف"""
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def submit(self, fn, *args):
+        """ثبت کار در صف؛ خروجی یک future برای نتیجه کار است"""
+        if self._task is None:
+            self.start()
+        future = asyncio.get_event_loop().create_future()
+        await self._queue.put((fn, args, future))
+        return future
+
+    async def run(self, fn, *args):
+        """ثبت کار و انتظار برای نتیجه آن"""
+        with trace_span("persistence"):
+            return await (await self.submit(fn, *args))
+
+    async def wait_drained(self):
+        """انتظار برای اتمام کار بعدی در صف"""
+        self._drained.clear()
+        await self._drained.wait()
+
+    async def _worker(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            fn, args, future = await self._queue.get()
+            try:
+                result = await loop.run_in_executor(self._executor, fn, *args)
+            except Exception as e:
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                self.completed += 1
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self._queue.task_done()
+                self._drained.set()
+
+    def start(self):
+        """شروع نخ I/O و تسک توزیع کار (داخل event loop ربات)"""
+        if self.running():
+            return
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="war-io")
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._drained = asyncio.Event()
+        self._task = asyncio.ensure_future(self._worker())
+
+    def close(self):
+        """توقف نخ I/O و اجرای همزمان کارهای باقیمانده صف"""
+        cancel_task(self._task)
+        self._task = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        while self._queue is not None and not self._queue.empty():
+            fn, args, _ = self._queue.get_nowait()
+            try:
+                fn(*args)
+            except Exception as e:
+                print(f"خطا در اجرای کار I/O: {e}")
+        self._queue = None
+
+io_executor = IOExecutor(IO_QUEUE_SIZE)
+
+# ==================== MONITORING ====================
+def escape_label(value):
+    """فرار از کاراکترهای خاص مقدار برچسب Prometheus"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class Metric:
+    """پایه متریک‌ها با خروجی متنی Prometheus"""
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def format_labels(self, values, extra=()):
+        pairs = list(zip(self.labelnames, values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in pairs) + "}"
+
+    def samples(self):
+        """نمونه‌ها به صورت (پسوند نام، برچسب‌ها، مقدار)"""
+        return []
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {float(value)!r}")
+        return "\n".join(lines)
+
+class Counter(Metric):
+    """شمارنده افزایشی"""
+
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self.values = {} if self.labelnames else {(): 0}
+
+    def inc(self, amount=1, *labels):
+        key = tuple(str(label) for label in labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, *labels):
+        return self.values.get(tuple(str(label) for label in labels), 0)
+
+    def samples(self):
+        return [("_total" if not self.name.endswith("_total") else "", self.format_labels(key), value)
+                for key, value in list(self.values.items())]
+
+class Gauge(Metric):
+    """مقدار لحظه‌ای؛ در صورت تعیین function هنگام خواندن محاسبه می‌شود"""
+
+    kind = "gauge"
+
+    def __init__(self, name, documentation, function=None):
+        super().__init__(name, documentation)
+        self.function = function
+        self.current = 0
+
+    def set(self, value):
+        self.current = value
+
+    def value(self):
+        return self.function() if self.function is not None else self.current
+
+    def samples(self):
+        return [("", "", self.value())]
+
+class Histogram(Metric):
+    """توزیع مقادیر در سطل‌های ثابت"""
+
+    kind = "histogram"
+    DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.series = {}
+
+    def observe(self, value, *labels):
+        key = tuple(str(label) for label in labels)
+        series = self.series.get(key)
+        if series is None:
+            # [شمارش هر سطل (غیرتجمعی) + سطل +Inf، مجموع، تعداد]
+            series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def count(self, *labels):
+        series = self.series.get(tuple(str(label) for label in labels))
+        return series[2] if series else 0
+
+    def samples(self):
+        samples = []
+        for key, (counts, total, count) in list(self.series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                samples.append(("_bucket", self.format_labels(key, (("le", le),)), cumulative))
+            samples.append(("_sum", self.format_labels(key), total))
+            samples.append(("_count", self.format_labels(key), count))
+        return samples
+
+class MetricsRegistry:
+    """مجموعه متریک‌های قابل ارائه در /metrics"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, function=None):
+        return self.register(Gauge(name, documentation, function))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=Histogram.DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+metrics = MetricsRegistry()
+messages_total = metrics.counter("war_bot_messages_total", "Messages processed")
+message_rate = metrics.gauge("war_bot_messages_per_second", "Messages processed per second (last monitor interval)")
+command_latency = metrics.histogram("war_bot_command_duration_seconds", "Command handling latency", ("command",))
+command_network = metrics.histogram("war_bot_command_network_seconds", "Time spent awaiting Bale per command", ("command",))
+command_persistence = metrics.histogram("war_bot_command_persistence_seconds", "Time spent in persistence per command", ("command",))
+slow_commands = metrics.counter("war_bot_slow_commands_total", "Commands slower than SLOW_COMMAND_THRESHOLD", ("command",))
+save_duration = metrics.histogram("war_bot_save_duration_seconds", "Duration of persisting dirty records")
+save_bytes = metrics.counter("war_bot_save_bytes_total", "Bytes written by persistence")
+event_loop_lag = metrics.gauge("war_bot_event_loop_lag_seconds", "Event loop scheduling lag")
+dispatch_wait = metrics.histogram("war_bot_dispatch_wait_seconds", "Time updates spend queued before handling", ("kind",))
+dispatch_dropped = metrics.counter("war_bot_dispatch_dropped_total", "Updates dropped because a chat queue was full", ("kind",))
+dispatch_coalesced = metrics.counter("war_bot_dispatch_coalesced_total", "Chatter updates merged into a pending one")
+shard_updates = metrics.counter("war_bot_shard_updates_total", "Updates routed to each shard process", ("shard",))
+outbound_latency = metrics.histogram("war_bot_outbound_delivery_seconds", "Time from enqueueing a reply to its delivery", ("priority",))
+outbound_throttled = metrics.counter("war_bot_outbound_throttled_total", "Sends delayed by a token bucket", ("bucket",))
+outbound_retries = metrics.counter("war_bot_outbound_retries_total", "Reply sends retried after an error")
+outbound_failed = metrics.counter("war_bot_outbound_failed_total", "Replies dropped after exhausting retries")
+outbound_split = metrics.counter("war_bot_outbound_split_total", "Replies split because they exceeded the length limit")
+lock_waits = metrics.counter("war_bot_player_lock_waits_total", "Handlers that waited for another handler's player lock")
+metrics.gauge("war_bot_players", "Registered players", lambda: len(game_data["users"]))
+metrics.gauge("war_bot_alliances", "Alliances", lambda: len(game_data["alliances"]))
+metrics.gauge("war_bot_chats", "Chats with at least one player", lambda: leaderboard_index.chat_count())
+metrics.gauge("war_bot_pending_records", "Dirty records waiting to be persisted", lambda: persistence.pending())
+metrics.gauge("war_bot_io_queue_depth", "Jobs waiting for the I/O thread", lambda: io_executor.depth())
+metrics.gauge("war_bot_name_cache_hit_ratio", "Member name cache hit ratio", lambda: name_resolver.hit_rate())
+metrics.gauge("war_bot_template_cache_hit_ratio", "Rendered template cache hit ratio", lambda: templates.hit_rate())
+metrics.gauge("war_bot_dispatch_queue_depth", "Updates waiting in all chat queues", lambda: dispatcher.depth())
+metrics.gauge("war_bot_dispatch_max_chat_depth", "Longest single chat queue", lambda: dispatcher.max_depth())
+metrics.gauge("war_bot_dispatch_chats", "Chats with queued or running updates", lambda: len(dispatcher.queues))
+metrics.gauge("war_bot_dispatch_in_flight", "Handlers currently running", lambda: dispatcher.in_flight)
+metrics.gauge("war_bot_outbound_queue_depth", "Replies waiting to be sent", lambda: outbox.depth())
+metrics.gauge("war_bot_player_locks", "Player locks currently held or awaited", lambda: len(player_locks.locks))
+
+def command_label(text):
+    """نام دستور برای برچسب متریک (فقط دستورات ثبت شده، بقیه other)"""
+    route, _ = router.resolve(text)
+    return route.label if route is not None else "other"
+
+def menu_label(text):
+    """برچسب متریک دکمه‌های منو"""
+    return f"menu:{text}"
+
+class MonitoringServer:
+    """
+    سرور HTTP سبک برای /metrics (Prometheus) و /health
+
+    همراه سرور یک حلقه پس‌زمینه تاخیر event loop و نرخ پیام‌ها را اندازه می‌گیرد.
+    /health فقط وقتی 200 برمی‌گرداند که ربات آماده، event loop پاسخگو و
+    ذخیره‌سازی در حال اجرا و بدون عقب‌ماندگی باشد؛ در غیر این صورت 503.
+    """
+
+    def __init__(self, host, port, enabled=True, lag_interval=1.0, max_lag=5.0):
+        self.host = host
+        self.port = port
+        self.enabled = enabled
+        self.lag_interval = lag_interval
+        self.max_lag = max_lag
+        self.ready = False
+        self.loop_lag = 0.0
+        self._server = None
+        self._task = None
+
+    def health(self):
+        """وضعیت اجزای ربات؛ خروجی (سالم، جزئیات)"""
+        if shards.enabled:
+            # فرآیند اصلی حالت شارد ذخیره‌سازی ندارد
+            checks = {"ready": self.ready, "event_loop": self.loop_lag < self.max_lag, "shards": shards.alive()}
+            return all(checks.values()), checks
+        checks = {
+            "ready": self.ready,
+            "event_loop": self.loop_lag < self.max_lag,
+            "io_executor": io_executor.running(),
+            "persistence": persistence.running() and not persistence.backlogged(),
+            "log_sink": not log_sink.enabled or (log_sink.running() and not log_sink.backlogged()),
+        }
+        return all(checks.values()), checks
+
+    async def monitor(self):
+        """اندازه‌گیری دوره‌ای تاخیر event loop و نرخ پیام‌ها"""
+        last_time = time.monotonic()
+        last_messages = messages_total.value()
+        while True:
+            await asyncio.sleep(self.lag_interval)
+            now = time.monotonic()
+            self.loop_lag = max(0.0, now - last_time - self.lag_interval)
+            event_loop_lag.set(self.loop_lag)
+            total = messages_total.value()
+            message_rate.set((total - last_messages) / (now - last_time))
+            last_time, last_messages = now, total
+
+    def respond(self, method, path):
+        """ساخت پاسخ؛ خروجی (وضعیت، نوع محتوا، بدنه)"""
+        if method not in ("GET", "HEAD"):
+            return "405 Method Not Allowed", "text/plain; charset=utf-8", b"method not allowed\n"
+        if path == "/metrics":
+            return "200 OK", "text/plain; version=0.0.4; charset=utf-8", metrics.render().encode("utf-8")
+        if path == "/health":
+            healthy, checks = self.health()
+            body = json.dumps({"status": "ok" if healthy else "unhealthy", "checks": checks}).encode("utf-8")
+            return ("200 OK" if healthy else "503 Service Unavailable"), "application/json", body
+        return "404 Not Found", "text/plain; charset=utf-8", b"not found\n"
+
+    async def handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            while True:
+                header = await asyncio.wait_for(reader.readline(), timeout=5)
+                if header in (b"\r\n", b"\n", b""):
+                    break
+            parts = request_line.decode("latin-1").split()
+            method = parts[0] if parts else ""
+            path = parts[1].split("?", 1)[0] if len(parts) > 1 else "/"
+            status, content_type, body = self.respond(method, path)
+            head = (f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                    f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n").encode("latin-1")
+            writer.write(head if method == "HEAD" else head + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception as e:
+            print(f"خطا در سرور مانیتورینگ: {e}")
+        finally:
+            writer.close()
+
+    async def start(self):
+        """شروع سرور HTTP و حلقه اندازه‌گیری (داخل event loop ربات)"""
+        if not self.enabled or self._server is not None:
+            return
+        try:
+            self._server = await asyncio.start_server(self.handle, self.host, self.port)
+        except OSError as e:
+            print(f"خطا در راه‌اندازی سرور مانیتورینگ روی پورت {self.port}: {e}")
+            return
+        self.port = self._server.sockets[0].getsockname()[1]
+        self._task = asyncio.ensure_future(self.monitor())
+        print(f"📈 متریک‌ها روی http://{self.host}:{self.port}/metrics")
+
+    def close(self):
+        cancel_task(self._task)
+        self._task = None
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        self.ready = False
+
+monitoring = MonitoringServer(MONITORING_CONFIG.get("HOST", "0.0.0.0"), METRICS_PORT,
+                              enabled=MONITORING_CONFIG.get("ENABLED", True),
+                              lag_interval=MONITORING_CONFIG.get("LOOP_LAG_INTERVAL", 1.0),
+                              max_lag=MONITORING_CONFIG.get("MAX_LOOP_LAG", 5.0))
+
+# ==================== COMMAND TRACING ====================
+# ردیابی دستور در حال اجرا؛ داخل coroutineهای فراخوانی شده توسط هندلر قابل دسترس است
+current_trace = ContextVar("current_trace", default=None)
+
+class CommandTrace:
+    """
+    زمان‌های ثبت شده برای یک بار اجرای دستور
+
+    پاسخ‌های صف ارسال و رکوردهای علامت‌خورده پس از پایان هندلر ارسال و در WAL نوشته
+    می‌شوند؛ هر کدام با hold کار معوقی روی trace ثبت می‌کنند و زمان ارسال یا نوشتن را
+    پس از انجام به network یا persistence همین دستور اضافه و release می‌کنند.
+    متریک‌ها و لاگ دستور کند پس از آزاد شدن آخرین کار ثبت می‌شوند.
+    """
+
+    __slots__ = ("command", "chat_id", "user_id", "wall", "network", "persistence", "pending")
+
+    def __init__(self, command, chat_id, user_id):
+        self.command = command
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.wall = 0.0
+        self.network = 0.0
+        self.persistence = 0.0
+        self.pending = 1  # خود هندلر
+
+    def hold(self):
+        self.pending += 1
+
+    def release(self):
+        self.pending -= 1
+        if not self.pending:
+            record_trace(self)
+
+@contextmanager
+def trace_span(kind):
+    """افزودن زمان بلوک به بخش network یا persistence دستور جاری"""
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        setattr(trace, kind, getattr(trace, kind) + time.perf_counter() - started)
+
+class TracedMessage:
+    """
+    پوشش پیام که زمان reply و delete را به عنوان زمان شبکه ثبت می‌کند
+
+    در صورت فعال بودن صف ارسال، reply پاسخ را با اولویت دستور جاری در صف قرار
+    می‌دهد و بلافاصله future پیام ارسال شده را برمی‌گرداند؛ زمان ارسال واقعی پس از
+    انجام به network همین دستور اضافه می‌شود.
+    """
+
+    __slots__ = ("_message",)
+
+    def __init__(self, message):
+        self._message = message
+
+    def __getattr__(self, name):
+        return getattr(self._message, name)
+
+    async def reply(self, text, *args, priority=None, **kwargs):
+        if outbox.running() and not args:
+            if priority is None:
+                trace = current_trace.get()
+                priority = router.priority_for(trace.command) if trace is not None else PRIORITY_NORMAL
+            return outbox.enqueue(self._message, text, priority, trace=current_trace.get(), **kwargs)
+        with trace_span("network"):
+            return await self._message.reply(text, *args, **kwargs)
+
+    async def delete(self, *args, **kwargs):
+        with trace_span("network"):
+            return await self._message.delete(*args, **kwargs)
+
+def record_trace(trace):
+    """ثبت متریک‌های دستور و لاگ ساختاریافته دستورات کند"""
+    command_latency.observe(trace.wall, trace.command)
+    command_network.observe(trace.network, trace.command)
+    command_persistence.observe(trace.persistence, trace.command)
+    if trace.wall < SLOW_COMMAND_THRESHOLD:
+        return
+    slow_commands.inc(1, trace.command)
+    entry = {
+        "command": trace.command,
+        "chat_id": trace.chat_id,
+        "chat_size": len(leaderboard_index.chat(trace.chat_id)),
+        "wall_ms": round(trace.wall * 1000, 2),
+        "network_ms": round(trace.network * 1000, 2),
+        "persistence_ms": round(trace.persistence * 1000, 2),
+    }
+    log_message(trace.chat_id, trace.user_id, "slow_command", json.dumps(entry, ensure_ascii=False))
+
+def instrumented(label):
+    """دکوریتور ثبت زمان کل، شبکه و ذخیره‌سازی هندلر؛ label نام دستور را از متن پیام می‌سازد"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(message, text, chat_id, user_id):
+            trace = CommandTrace(label(text), chat_id, user_id)
+            token = current_trace.set(trace)
+            started = time.perf_counter()
+            try:
+                return await handler(TracedMessage(message), text, chat_id, user_id)
+            finally:
+                trace.wall = time.perf_counter() - started
+                current_trace.reset(token)
+                trace.release()
+        return wrapper
+    return decorator
+
+# ==================== DATA MANAGEMENT ====================
+def empty_game_data():
+    """ساختار خالی داده‌های بازی"""
+    return {
+        "users": {},
+        "countries": {},
+        "alliances": {},
+        "battles": []  # تاریخچه نبردها در battle_ledger (فایل BATTLES_FILE) نگه داشته می‌شود
+    }
+
+game_data = empty_game_data()
+
+def read_state():
+    """خواندن تمام داده‌ها از مخزن ذخیره‌سازی (روی نخ I/O قابل اجراست)"""
+    return repository.load()
+
+def install_state(state):
+    """جایگزینی داده‌های بازی با داده‌های بارگذاری شده"""
+    global game_data
+    # کش‌های ذخیره شده ممکن است با جدول واحدها و کالکتورهای فعلی سازگار نباشند
+    for user_data in state["users"].values():
+        user_data.pop("power_cache", None)
+        user_data.pop("rate_cache", None)
+    game_data = state
+    persistence.reset()
+    leaderboard_index.reset()
+    economy.reset()
+
+def load_data():
+    """بارگذاری داده‌ها از اسنپ‌شات و بازپخش WAL"""
+    try:
+        state = read_state()
+    except Exception as e:
+        print(f"خطا در بارگذاری داده‌ها: {e}")
+        state = empty_game_data()
+    install_state(state)
+    load_battles()
+
+async def load_data_async():
+    """بارگذاری داده‌ها روی نخ I/O بدون مسدود کردن event loop"""
+    try:
+        state = await io_executor.run(read_state)
+    except Exception as e:
+        print(f"خطا در بارگذاری داده‌ها: {e}")
+        state = empty_game_data()
+    install_state(state)
+    await io_executor.run(load_battles)
+
+def save_data():
+    """ذخیره کامل: ثبت رکوردهای باقیمانده و ایجاد نقطه بازیابی در مخزن"""
+    try:
+        persistence.flush()
+        repository.checkpoint()
+    except Exception as e:
+        print(f"خطا در ذخیره داده‌ها: {e}")
+
+# ==================== WRITE-AHEAD LOG ====================
+# جدول‌های قابل ثبت در WAL (کد کوتاه -> کلید game_data)
+WAL_TABLES = {"u": "users", "c": "countries", "a": "alliances"}
+
+def apply_wal_record(state, record):
+    """اعمال یک رکورد WAL روی داده‌ها (رکورد None یعنی حذف)"""
+    table = state.setdefault(WAL_TABLES[record["t"]], {})
+    if record["v"] is None:
+        table.pop(record["k"], None)
+    else:
+        table[record["k"]] = record["v"]
+
+class WriteAheadLog:
+    """
+    لاگ افزایشی تغییرات
+
+    هر رکورد تغییر یافته به صورت یک خط JSON فشرده به انتهای فایل WAL اضافه می‌شود
+    (هزینه هر نوشتن متناسب با اندازه رکورد است نه کل داده‌ها). وقتی حجم WAL از
+    max_bytes بیشتر شود، فشرده‌ساز آن را در اسنپ‌شات DATA_FILE ادغام می‌کند تا
+    زمان بازیابی محدود بماند.
+    """
+
+    def __init__(self, max_bytes, fsync=True):
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.bytes_written = 0
+        self.compactions = 0
+
+    @property
+    def path(self):
+        return DATABASE_CONFIG.get("WAL_FILE") or f"{DATA_FILE}.wal"
+
+    @property
+    def sealed_path(self):
+        # بخش بسته شده WAL که در حال ادغام در اسنپ‌شات است
+        return f"{self.path}.compacting"
+
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    def needs_compaction(self):
+        return self.size() >= self.max_bytes
+
+    @staticmethod
+    def encode(records):
+        """سریال‌سازی رکوردها (روی event loop، چون داده‌ها آنجا تغییر می‌کنند)"""
+        return "".join(
+            json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n" for record in records
+        ).encode("utf-8")
+
+    def append(self, records):
+        """افزودن دسته‌ای رکوردها به انتهای WAL"""
+        return self.write(self.encode(records))
+
+    def write(self, payload):
+        """نوشتن رکوردهای سریال شده در WAL (روی نخ I/O)"""
+        if not payload:
+            return 0
+        with open(self.path, 'ab') as f:
+            f.write(payload)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        self.bytes_written += len(payload)
+        return len(payload)
+
+    def _replay_file(self, path, state):
+        count = 0
+        if not os.path.exists(path):
+            return count
+        valid_bytes = 0
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("torn record")
+                    record = json.loads(line.decode("utf-8"))
+                except ValueError:
+                    # خط ناقص انتهای فایل پس از قطع ناگهانی؛ حذف می‌شود تا رکوردهای بعدی سالم بمانند
+                    print(f"⚠️ رکورد ناقص در {path} حذف شد")
+                    break
+                apply_wal_record(state, record)
+                valid_bytes += len(line)
+                count += 1
+        if valid_bytes < os.path.getsize(path):
+            os.truncate(path, valid_bytes)
+        return count
+
+    def replay(self, state):
+        """بازپخش بخش بسته شده و WAL فعال روی اسنپ‌شات"""
+        return self._replay_file(self.sealed_path, state) + self._replay_file(self.path, state)
+
+    def maybe_compact(self):
+        """فشرده‌سازی در صورت عبور حجم WAL از حد مجاز"""
+        return self.compact() if self.needs_compaction() else False
+
+    def compact(self):
+        """ادغام WAL در اسنپ‌شات با جایگزینی اتمیک فایل"""
+        if not os.path.exists(self.sealed_path):
+            if not os.path.exists(self.path):
+                return False
+            # بستن WAL فعلی؛ نوشتن‌های بعدی در فایل WAL جدید انجام می‌شود
+            os.replace(self.path, self.sealed_path)
+
+        if os.path.exists(DATA_FILE):
+            with open(DATA_FILE, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+        else:
+            snapshot = empty_game_data()
+        snapshot.pop("logs", None)
+        self._replay_file(self.sealed_path, snapshot)
+
+        tmp_path = f"{DATA_FILE}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(snapshot, f, ensure_ascii=False, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, DATA_FILE)
+        os.remove(self.sealed_path)
+        self.compactions += 1
+        return True
+
+# ==================== STORAGE BACKENDS ====================
+class GameRepository:
+    """
+    رابط مخزن ذخیره‌سازی داده‌های بازی
+
+    داده‌ها هنگام اجرا در game_data نگهداری می‌شوند؛ مخزن فقط بارگذاری اولیه و
+    ذخیره رکوردهای تغییر یافته را انجام می‌دهد. encode روی event loop و بقیه
+    متدها روی نخ I/O اجرا می‌شوند.
+    """
+
+    name = "base"
+
+    def load(self):
+        """بارگذاری کامل داده‌ها"""
+        raise NotImplementedError
+
+    def encode(self, records):
+        """آماده‌سازی رکوردهای {"t", "k", "v"} برای نوشتن"""
+        raise NotImplementedError
+
+    def write(self, payload):
+        """نوشتن رکوردهای آماده شده؛ خروجی تعداد بایت‌های نوشته شده است"""
+        raise NotImplementedError
+
+    def maybe_compact(self):
+        """نگهداری دوره‌ای (در صورت نیاز)"""
+        return False
+
+    def checkpoint(self):
+        """ایجاد نقطه بازیابی کامل (هنگام خاموش شدن)"""
+        return False
+
+    def close(self):
+        pass
+
+class JsonFileRepository(GameRepository):
+    """مخزن فایل JSON: اسنپ‌شات DATA_FILE به همراه WAL"""
+
+    name = "json"
+
+    def __init__(self, write_ahead_log):
+        self.wal = write_ahead_log
+
+    def load(self):
+        if os.path.exists(DATA_FILE):
+            with open(DATA_FILE, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            # لاگ‌ها در فایل‌های جداگانه نگهداری می‌شوند (داده‌های قدیمی)
+            state.pop("logs", None)
+        else:
+            state = empty_game_data()
+        # رکوردهای نوشته شده پس از آخرین اسنپ‌شات
+        replayed = self.wal.replay(state)
+        if replayed:
+            print(f"♻️ {replayed} رکورد از WAL بازیابی شد")
+        return state
+
+    def encode(self, records):
+        return self.wal.encode(records)
+
+    def write(self, payload):
+        return self.wal.write(payload)
+
+    def maybe_compact(self):
+        return self.wal.maybe_compact()
+
+    def checkpoint(self):
+        return self.wal.compact()
+
+class SQLiteRepository(GameRepository):
+    """
+    مخزن SQLite با جدول‌های ایندکس‌دار
+
+    هر رکورد یک سطر است و ذخیره‌سازی به صورت به‌روزرسانی سطری در یک تراکنش
+    (journal_mode=WAL) انجام می‌شود. ستون‌های پرکاربرد (سطح، قدرت، اتحاد) کنار
+    JSON کامل رکورد نگهداری می‌شوند تا قابل جستجو باشند.
+    """
+
+    name = "sqlite"
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (
+        chat_id TEXT NOT NULL,
+        user_id TEXT NOT NULL,
+        level INTEGER NOT NULL DEFAULT 1,
+        power INTEGER NOT NULL DEFAULT 0,
+        battles_won INTEGER NOT NULL DEFAULT 0,
+        alliance TEXT,
+        data TEXT NOT NULL,
+        PRIMARY KEY (chat_id, user_id)
+    );
+    CREATE INDEX IF NOT EXISTS idx_users_chat_power ON users (chat_id, power DESC);
+    CREATE INDEX IF NOT EXISTS idx_users_alliance ON users (alliance);
+    CREATE TABLE IF NOT EXISTS countries (
+        chat_id TEXT NOT NULL,
+        user_id TEXT NOT NULL,
+        conquered_by TEXT,
+        data TEXT NOT NULL,
+        PRIMARY KEY (chat_id, user_id)
+    );
+    CREATE INDEX IF NOT EXISTS idx_countries_chat ON countries (chat_id);
+    CREATE TABLE IF NOT EXISTS alliances (
+        name TEXT PRIMARY KEY,
+        leader TEXT,
+        created_at TEXT,
+        total_power INTEGER NOT NULL DEFAULT 0,
+        data TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS alliance_members (
+        alliance TEXT NOT NULL,
+        user_id TEXT NOT NULL,
+        PRIMARY KEY (alliance, user_id)
+    );
+    CREATE INDEX IF NOT EXISTS idx_alliance_members_user ON alliance_members (user_id);
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            # اتصال فقط از نخ I/O یا پیش/پس از اجرای event loop استفاده می‌شود
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(self.SCHEMA)
+        return self._conn
+
+    def load(self):
+        state = empty_game_data()
+        conn = self.conn
+        if conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] == 0 and os.path.exists(DATA_FILE):
+            # انتقال یکباره داده‌های فایل JSON به پایگاه داده
+            state = JsonFileRepository(wal).load()
+            records = [{"t": code, "k": key, "v": value}
+                       for code, table in WAL_TABLES.items() for key, value in state[table].items()]
+            self.write(self.encode(records))
+            print(f"📦 {len(records)} رکورد از {DATA_FILE} به {self.path} منتقل شد")
+            return state
+        for chat_id, user_id, data in conn.execute("SELECT chat_id, user_id, data FROM users"):
+            state["users"][f"{chat_id}:{user_id}"] = json.loads(data)
+        for chat_id, user_id, data in conn.execute("SELECT chat_id, user_id, data FROM countries"):
+            state["countries"][f"{chat_id}:{user_id}"] = json.loads(data)
+        for name, data in conn.execute("SELECT name, data FROM alliances"):
+            state["alliances"][name] = json.loads(data)
+        return state
+
+    def encode(self, records):
+        rows = []
+        for record in records:
+            code, key, value = record["t"], record["k"], record["v"]
+            data = None if value is None else json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+            if code == "u":
+                chat_id, user_id = key.split(":", 1)
+                columns = () if value is None else (
+                    value.get("level", 1), calculate_total_power(value), value.get("battles_won", 0), value.get("alliance")
+                )
+                rows.append((code, (chat_id, user_id), data, columns))
+            elif code == "c":
+                chat_id, user_id = key.split(":", 1)
+                columns = () if value is None else (
+                    None if value.get("conquered_by") is None else str(value["conquered_by"]),
+                )
+                rows.append((code, (chat_id, user_id), data, columns))
+            else:
+                columns = () if value is None else (
+                    None if value.get("leader") is None else str(value["leader"]),
+                    value.get("created_at"),
+                    value.get("total_power", 0),
+                    [str(member) for member in value.get("members", [])],
+                )
+                rows.append((code, (key,), data, columns))
+        return rows
+
+    def write(self, payload):
+        if not payload:
+            return 0
+        written = 0
+        with self.conn as conn:
+            for code, key, data, columns in payload:
+                written += len(data or "")
+                if code == "u":
+                    if data is None:
+                        conn.execute("DELETE FROM users WHERE chat_id = ? AND user_id = ?", key)
+                    else:
+                        conn.execute(
+                            "INSERT OR REPLACE INTO users (chat_id, user_id, level, power, battles_won, alliance, data) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?)", key + columns + (data,))
+                elif code == "c":
+                    if data is None:
+                        conn.execute("DELETE FROM countries WHERE chat_id = ? AND user_id = ?", key)
+                    else:
+                        conn.execute(
+                            "INSERT OR REPLACE INTO countries (chat_id, user_id, conquered_by, data) VALUES (?, ?, ?, ?)",
+                            key + columns + (data,))
+                else:
+                    conn.execute("DELETE FROM alliance_members WHERE alliance = ?", key)
+                    if data is None:
+                        conn.execute("DELETE FROM alliances WHERE name = ?", key)
+                    else:
+                        leader, created_at, total_power, members = columns
+                        conn.execute(
+                            "INSERT OR REPLACE INTO alliances (name, leader, created_at, total_power, data) "
+                            "VALUES (?, ?, ?, ?, ?)", key + (leader, created_at, total_power, data))
+                        conn.executemany(
+                            "INSERT OR IGNORE INTO alliance_members (alliance, user_id) VALUES (?, ?)",
+                            [key + (member,) for member in members])
+        return written
+
+    def checkpoint(self):
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return True
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+def create_repository(backend):
+    """ساخت مخزن بر اساس DATABASE_CONFIG["BACKEND"]"""
+    if backend == "sqlite":
+        return SQLiteRepository(SQLITE_FILE)
+    if backend != "json":
+        print(f"⚠️ مخزن ناشناخته {backend!r}؛ از فایل JSON استفاده می‌شود")
+    return JsonFileRepository(wal)
+
+wal = WriteAheadLog(WAL_MAX_BYTES, WAL_FSYNC)
+repository = create_repository(STORAGE_BACKEND)
+
+# ==================== PERSISTENCE ====================
+class PersistenceEngine:
+    """
+    ذخیره‌سازی دسته‌ای رکوردهای تغییر یافته
+
+    هندلرها به جای فراخوانی save_data() فقط رکوردهای تغییر یافته را علامت می‌زنند.
+    رکوردها هر FLUSH_INTERVAL ثانیه یا پس از رسیدن به FLUSH_THRESHOLD رکورد
+    یکجا در WAL نوشته می‌شوند.
+    """
+
+    def __init__(self, flush_interval, flush_threshold):
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self.dirty_users = set()
+        self.dirty_countries = set()
+        self.dirty_alliances = set()
+        self.traces = set()  # دستورهایی که رکوردهایشان در flush بعدی نوشته می‌شود
+        self.flush_count = 0
+        self._wakeup = None
+        self._task = None
+
+    def reset(self):
+        """پاک کردن رکوردهای علامت‌خورده (پس از بارگذاری مجدد)"""
+        self.dirty_users.clear()
+        self.dirty_countries.clear()
+        self.dirty_alliances.clear()
+
+    def pending(self):
+        """تعداد رکوردهای ذخیره نشده"""
+        return len(self.dirty_users) + len(self.dirty_countries) + len(self.dirty_alliances)
+
+    def backlogged(self):
+        """آیا رکوردهای ذخیره نشده از حد مجاز بیشتر شده‌اند؟"""
+        return self.pending() >= MAX_PENDING_RECORDS
+
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _mark(self, dirty_set, key):
+        dirty_set.add(key)
+        trace = current_trace.get()
+        if trace is not None and self.running() and trace not in self.traces:
+            # زمان نوشتن WAL پس از flush به persistence همین دستور اضافه می‌شود
+            trace.hold()
+            self.traces.add(trace)
+        if self._wakeup is not None and self.pending() >= self.flush_threshold:
+            self._wakeup.set()
+
+    def mark_user(self, user_key):
+        self._mark(self.dirty_users, user_key)
+
+    def mark_country(self, country_key):
+        self._mark(self.dirty_countries, country_key)
+
+    def mark_alliance(self, alliance_name):
+        self._mark(self.dirty_alliances, alliance_name)
+
+    def _dirty_sets(self):
+        return (("u", self.dirty_users), ("c", self.dirty_countries), ("a", self.dirty_alliances))
+
+    def collect_records(self):
+        """ساخت رکوردهای WAL از وضعیت فعلی رکوردهای علامت‌خورده"""
+        records = []
+        for code, dirty_set in self._dirty_sets():
+            table = game_data[WAL_TABLES[code]]
+            for key in dirty_set:
+                records.append({"t": code, "k": key, "v": table.get(key)})
+        self.reset()
+        return records
+
+    def take_traces(self):
+        traces, self.traces = self.traces, set()
+        return traces
+
+    @staticmethod
+    def charge(traces, elapsed):
+        """افزودن زمان نوشتن به دستورهای صاحب رکوردها و آزاد کردن آن‌ها"""
+        for trace in traces:
+            trace.persistence += elapsed
+            trace.release()
+
+    def restore_records(self, records):
+        """علامت‌گذاری مجدد رکوردها پس از شکست نوشتن"""
+        dirty_sets = dict(self._dirty_sets())
+        for record in records:
+            dirty_sets[record["t"]].add(record["k"])
+
+    def flush(self):
+        """ثبت همزمان تمام رکوردهای تغییر یافته در WAL"""
+        if not self.pending():
+            return False
+        records = self.collect_records()
+        traces = self.take_traces()
+        started = time.perf_counter()
+        try:
+            write_records(repository.encode(records))
+        except BaseException:
+            self.restore_records(records)
+            self.traces |= traces
+            raise
+        self.flush_count += 1
+        self.charge(traces, time.perf_counter() - started)
+        return True
+
+    async def flush_async(self):
+        """ثبت رکوردهای تغییر یافته در WAL روی نخ I/O"""
+        if not self.pending():
+            return False
+        records = self.collect_records()
+        traces = self.take_traces()
+        started = time.perf_counter()
+        try:
+            await io_executor.run(write_records, repository.encode(records))
+        except BaseException:
+            # لغو تسک هنگام خاموش شدن هم رکوردها را برای ذخیره نهایی برمی‌گرداند
+            self.restore_records(records)
+            self.traces |= traces
+            raise
+        self.flush_count += 1
+        self.charge(traces, time.perf_counter() - started)
+        await io_executor.run(repository.maybe_compact)
+        return True
+
+    async def run(self):
+        """حلقه پس‌زمینه ذخیره‌سازی دوره‌ای و فشرده‌سازی WAL"""
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush_async()
+            except Exception as e:
+                print(f"خطا در ذخیره دسته‌ای: {e}")
+
+    def start(self):
+        """شروع حلقه ذخیره‌سازی (داخل event loop ربات)"""
+        if self._task is not None and not self._task.done():
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.ensure_future(self.run())
+
+    def close(self):
+        """توقف حلقه و ذخیره نهایی (هنگام خاموش شدن)"""
+        cancel_task(self._task)
+        self._task = None
+        self._wakeup = None
+        save_data()
+
+persistence = PersistenceEngine(FLUSH_INTERVAL, FLUSH_THRESHOLD)
+
+def write_records(payload):
+    """نوشتن رکوردهای آماده شده در مخزن و ثبت مدت و حجم نوشتن"""
+    started = time.perf_counter()
+    written = repository.write(payload)
+    save_duration.observe(time.perf_counter() - started)
+    save_bytes.inc(written or 0)
+    return written
+
+def mark_user_dirty(chat_id, user_id):
+    """علامت‌گذاری داده کاربر برای ذخیره و به‌روزرسانی رتبه‌بندی"""
+    user_key = f"{chat_id}:{user_id}"
+    user_data = game_data["users"].get(user_key)
+    persistence.mark_user(user_key)
+    leaderboard_index.update_user(chat_id, user_id, user_data)
+    economy.push(user_key, user_data)
+
+def mark_country_dirty(chat_id, user_id):
+    """علامت‌گذاری داده کشور برای ذخیره"""
+    persistence.mark_country(f"{chat_id}:{user_id}")
+
+def mark_alliance_dirty(alliance_name):
+    """علامت‌گذاری اتحاد برای ذخیره (شامل حذف اتحاد)"""
+    persistence.mark_alliance(alliance_name)
+
+# ==================== GAME LOGS ====================
+class LogSink:
+    """
+    ثبت لاگ‌های بازی خارج از داده‌های اصلی
+
+    لاگ‌ها در صف حافظه قرار می‌گیرند و نویسنده پس‌زمینه آن‌ها را دسته‌ای در LOG_FILE
+    می‌نویسد. نگهداری با max_logs (GAME_CONFIG["MAX_LOGS"]) تعیین می‌شود: هر فایل
+    حداکثر max_logs / (backup_count + 1) لاگ دارد، پس فایل فعلی و فایل‌های چرخیده
+    روی هم حداکثر max_logs لاگ نگه می‌دارند. فایل پیش از آن هم بر اساس حجم
+    (MAX_BYTES) و بازه زمانی (ROTATE_INTERVAL) چرخانده می‌شود.
+    """
+
+    def __init__(self, path, max_bytes, rotate_interval, backup_count, max_logs=None, enabled=True,
+                 flush_interval=1.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rotate_interval = rotate_interval
+        self.backup_count = backup_count
+        # سهم هر فایل از max_logs (گرد شده به پایین تا مجموع از max_logs بیشتر نشود)
+        self.max_lines = max(1, max_logs // (backup_count + 1)) if max_logs else None
+        self.enabled = enabled
+        self.flush_interval = flush_interval
+        self.pending = deque()
+        self.file_lines = None  # تعداد لاگ‌های فایل فعلی (در اولین نوشتن شمرده می‌شود)
+        self.lines_written = 0
+        self.rotations = 0
+        self._wakeup = None
+        self._task = None
+
+    @staticmethod
+    def format_line(timestamp, chat_id, user_id, message_type, content):
+        """قالب خط لاگ؛ خطوط جدید محتوا escape می‌شوند تا هر لاگ یک خط باشد"""
+        content = str(content).replace("\\", "\\\\").replace("\n", "\\n")
+        return f"{timestamp} | {chat_id} | {user_id} | {message_type} | {content}\n"
+
+    def emit(self, chat_id, user_id, message_type, content):
+        """افزودن لاگ به صف (بدون I/O)"""
+        if not self.enabled:
+            return
+        self.pending.append((datetime.now().isoformat(), chat_id, user_id, message_type, content))
+        if self._task is None:
+            # بدون نویسنده پس‌زمینه (تست‌ها و ابزارها) مستقیم نوشته می‌شود
+            self.flush()
+        elif len(self.pending) >= LOG_BATCH_SIZE:
+            self._wakeup.set()
+
+    def _current_lines(self):
+        if self.file_lines is None:
+            try:
+                with open(self.path, 'rb') as f:
+                    self.file_lines = sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(1 << 20), b""))
+            except OSError:
+                self.file_lines = 0
+        return self.file_lines
+
+    def _should_rotate(self, incoming_bytes):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            self.file_lines = 0
+            return False
+        if self.max_lines and self._current_lines() >= self.max_lines:
+            return True
+        if stat.st_size and stat.st_size + incoming_bytes > self.max_bytes:
+            return True
+        if self.rotate_interval and int(stat.st_mtime // self.rotate_interval) != int(time.time() // self.rotate_interval):
+            return True
+        return False
+
+    def rotate(self):
+        """چرخش فایل: war_logs.txt -> war_logs.txt.1 -> ... -> war_logs.txt.N"""
+        for index in range(self.backup_count - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.file_lines = 0
+        self.rotations += 1
+
+    def backlogged(self):
+        """آیا صف لاگ از حد مجاز بیشتر شده است؟"""
+        return len(self.pending) >= LOG_MAX_PENDING
+
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def drain(self):
+        """خالی کردن صف و ساخت محتوای قابل نوشتن"""
+        lines = []
+        while self.pending:
+            lines.append(self.format_line(*self.pending.popleft()))
+        return "".join(lines).encode("utf-8"), len(lines)
+
+    def write_payload(self, payload, line_count):
+        """نوشتن لاگ‌ها در فایل به همراه چرخش (روی نخ I/O)"""
+        if not payload:
+            return 0
+        written = 0
+        while line_count:
+            if self._should_rotate(len(payload)):
+                self.rotate()
+            chunk, count = payload, line_count
+            room = self.max_lines - self._current_lines() if self.max_lines else line_count
+            if count > room:
+                # بقیه لاگ‌ها پس از چرخش در فایل بعدی نوشته می‌شوند
+                cut = 0
+                for _ in range(room):
+                    cut = payload.index(b"\n", cut) + 1
+                chunk, count = payload[:cut], room
+            with open(self.path, 'ab') as f:
+                f.write(chunk)
+            self.file_lines = self._current_lines() + count
+            self.lines_written += count
+            written += count
+            payload, line_count = payload[len(chunk):], line_count - count
+        return written
+
+    def flush(self):
+        """نوشتن همزمان تمام لاگ‌های صف در فایل"""
+        return self.write_payload(*self.drain())
+
+    async def run(self):
+        """نویسنده پس‌زمینه"""
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                payload, line_count = self.drain()
+                if line_count:
+                    await io_executor.run(self.write_payload, payload, line_count)
+            except Exception as e:
+                print(f"خطا در نوشتن لاگ: {e}")
+
+    def start(self):
+        """شروع نویسنده پس‌زمینه (داخل event loop ربات)"""
+        if self._task is not None and not self._task.done():
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.ensure_future(self.run())
+
+    def close(self):
+        """توقف نویسنده و نوشتن لاگ‌های باقیمانده"""
+        cancel_task(self._task)
+        self._task = None
+        self._wakeup = None
+        try:
+            self.flush()
+        except Exception as e:
+            print(f"خطا در نوشتن لاگ: {e}")
+
+LOG_BATCH_SIZE = LOG_CONFIG.get("BATCH_SIZE", 1000)
+LOG_MAX_PENDING = LOG_CONFIG.get("MAX_PENDING", 20000)
+
+log_sink = LogSink(
+    LOG_FILE,
+    max_bytes=LOG_CONFIG.get("MAX_BYTES", 10 * 1024 * 1024),
+    rotate_interval=LOG_CONFIG.get("ROTATE_INTERVAL", 24 * 3600),
+    backup_count=LOG_CONFIG.get("BACKUP_COUNT", 5),
+    max_logs=GAME_CONFIG.get("MAX_LOGS", 10000),
+    enabled=LOG_CONFIG.get("ENABLE_FILE_LOGGING", True),
+)
+
+def shutdown_storage():
+    """توقف نخ I/O و ذخیره نهایی داده‌ها و لاگ‌ها"""
+    io_executor.close()
+    # فرآیند اصلی حالت شارد داده‌ای ندارد؛ ذخیره نهایی اسنپ‌شات و WAL تک‌فرآیندی را با داده خالی فشرده می‌کرد
+    if not shards.is_parent:
+        persistence.close()
+    log_sink.close()
+    battle_ledger.close()
+    repository.close()
+
+atexit.register(shutdown_storage)
+
+async def wait_for_io_capacity():
+    """فشار معکوس: توقف پردازش پیام‌های جدید تا خالی شدن صف‌های ذخیره‌سازی"""
+    if not io_executor.running():
+        if persistence.backlogged():
+            persistence.flush()
+        return
+    while persistence.backlogged() or log_sink.backlogged():
+        persistence.wake()
+        log_sink.wake()
+        await io_executor.wait_drained()
+
+def log_message(chat_id, user_id, message_type, content):
+    """ثبت پیام در لاگ"""
+    try:
+        log_sink.emit(chat_id, user_id, message_type, content)
+    except Exception as e:
+        print(f"خطا در ثبت لاگ: {e}")
+
+def get_user_data(chat_id, user_id):
+    """دریافت یا ایجاد داده کاربر"""
+    user_key = f"{chat_id}:{user_id}"
+    if user_key not in game_data["users"]:
+        game_data["users"][user_key] = {
+            "level": 1,
+            "experience": 0,
+            "resources": {resource: 1000 for resource in RESOURCES},
+            "military": {},
+            "capital": {upgrade: 0 for upgrade in CAPITAL_UPGRADES},
+            "battles_won": 0,
+            "battles_lost": 0,
+            "territory_conquered": 0,
+            "alliance": None,
+            "accrued_at": time.time(),  # زمان آخرین تسویه درآمد (epoch)
+            "achievements": [],
+            "research": {},
+            "diplomacy": {},
+            "spies": 0,
+            "intelligence": 0,
+            "government": "democracy",  # سیستم مدیریت
+            "collectors": {collector: 0 for collector in RESOURCE_COLLECTORS},  # کالکتورها
+            "last_collection": datetime.now().isoformat(),  # آخرین جمع‌آوری
+            "stability": 100,  # پایداری کشور
+            "rebellion_risk": 0,  # خطر شورش
+            "government_changes": 0,  # تعداد تغییرات حکومت
+            "collector_efficiency": 1.0  # کارایی کالکتورها
+        }
+        mark_user_dirty(chat_id, user_id)
+    user_data = game_data["users"][user_key]
+    # انتقال نتیجه آخرین tick برداری اقتصاد
+    economy.pull(user_key, user_data)
+    return user_data
+
+def get_country_data(chat_id, user_id):
+    """دریافت یا ایجاد داده کشور"""
+    country_key = f"{chat_id}:{user_id}"
+    if country_key not in game_data["countries"]:
+        game_data["countries"][country_key] = {
+            "name": f"کشور {user_id}",
+            "level": 1,
+            "population": 1000000,
+            "territory": 1000,
+            "defense_level": 1,
+            "fortifications": 0,
+            "conquered_by": None,
+            "conquest_time": None,
+            "rebellion_chance": 0.1
+        }
+        persistence.mark_country(country_key)
+    return game_data["countries"][country_key]
+
+def get_alliance(alliance_name):
+    """دریافت داده اتحاد (یا None در صورت عدم وجود)"""
+    return game_data["alliances"].get(alliance_name)
+
+def create_alliance(alliance_name, alliance_data):
+    """ثبت اتحاد جدید"""
+    game_data["alliances"][alliance_name] = alliance_data
+    mark_alliance_dirty(alliance_name)
+    return alliance_data
+
+def delete_alliance(alliance_name):
+    """حذف اتحاد"""
+    game_data["alliances"].pop(alliance_name, None)
+    mark_alliance_dirty(alliance_name)
+
+def list_alliances():
+    """تمام اتحادها به صورت (نام، داده)"""
+    return list(game_data["alliances"].items())
+
+def iter_chat_users(chat_id):
+    """بازیکنان یک گروه به صورت (user_id، داده کاربر)"""
+    prefix = f"{chat_id}:"
+    for user_key, user_data in game_data["users"].items():
+        if user_key.startswith(prefix):
+            economy.pull(user_key, user_data)
+            yield user_key[len(prefix):], user_data
+
+# ==================== BATTLE LEDGER ====================
+# رکورد ثابت هر نبرد: گروه، مهاجم، مدافع، زمان، قدرت حمله، قدرت دفاع، پول، نفت،
+# تلفات مهاجم، تلفات مدافع، پرچم‌ها (پول و نفت غنیمت یا جریمه بسته به نتیجه است)
+BATTLE_RECORD = struct.Struct("<qqqdffqqIIB")
+BATTLE_WON = 1  # مهاجم پیروز شد
+BATTLE_CONQUEST = 2  # کشور مدافع فتح شد
+
+class Battle:
+    """یک نبرد خوانده شده از دفتر نبردها"""
+
+    __slots__ = ("seq", "chat_id", "attacker", "defender", "timestamp", "attack_strength", "defense_strength",
+                 "money", "oil", "attacker_lost", "defender_lost", "flags")
+
+    def __init__(self, seq, fields):
+        self.seq = seq
+        (self.chat_id, self.attacker, self.defender, self.timestamp, self.attack_strength, self.defense_strength,
+         self.money, self.oil, self.attacker_lost, self.defender_lost, self.flags) = fields
+
+    @property
+    def won(self):
+        return bool(self.flags & BATTLE_WON)
+
+    @property
+    def conquest(self):
+        return bool(self.flags & BATTLE_CONQUEST)
+
+class BattleRing:
+    """بافر حلقوی رکوردهای نبرد یک گروه با ظرفیت ثابت"""
+
+    __slots__ = ("buffer", "capacity", "count")
+
+    def __init__(self, capacity):
+        self.buffer = bytearray(capacity * BATTLE_RECORD.size)
+        self.capacity = capacity
+        self.count = 0  # شماره نبرد بعدی (تعداد کل نبردهای ثبت شده)
+
+    def oldest(self):
+        """شماره قدیمی‌ترین نبرد نگه داشته شده"""
+        return max(0, self.count - self.capacity)
+
+    def offset(self, seq):
+        return (seq % self.capacity) * BATTLE_RECORD.size
+
+    def get(self, seq):
+        return BATTLE_RECORD.unpack_from(self.buffer, self.offset(seq))
+
+    def raw(self, seq):
+        offset = self.offset(seq)
+        return self.buffer[offset:offset + BATTLE_RECORD.size]
+
+    def write(self, packed):
+        offset = self.offset(self.count)
+        self.buffer[offset:offset + BATTLE_RECORD.size] = packed
+        self.count += 1
+
+class BattleLedger:
+    """
+    دفتر نبردها با رکوردهای ثابت، جدا از فایل اصلی داده‌ها
+
+    هر گروه یک بافر حلقوی با ظرفیت retention دارد و نبرد جدید جای قدیمی‌ترین نبرد را
+    می‌گیرد. ایندکس مهاجم و مدافع شماره نبردهای هر بازیکن را نگه می‌دارند تا /battles،
+    هدف انتقام و آمار بدون پیمایش تاریخچه گروه پاسخ داده شوند. رکوردها به انتهای path
+    اضافه می‌شوند و وقتی فایل از دو برابر رکوردهای نگه داشته شده بزرگ‌تر شد، فقط
+    رکوردهای فعلی بازنویسی می‌شوند.
+    """
+
+    def __init__(self, path, retention, enabled=True, flush_interval=1.0):
+        self.path = path
+        self.retention = max(1, retention)
+        self.enabled = enabled
+        self.flush_interval = flush_interval
+        self.chats = {}  # chat_id -> BattleRing
+        self.by_attacker = {}  # (chat_id, user_id) -> deque شماره نبردها از قدیم به جدید
+        self.by_defender = {}
+        self.pending = bytearray()
+        self.pending_count = 0
+        self.file_records = 0  # رکوردهای موجود در فایل (شامل رکوردهای بازنویسی شده در حافظه)
+        self.rewrite = False  # بازنویسی کامل فایل در نوشتن بعدی
+        self.writes = 0  # تعداد نوشتن‌های موفق (برای تشخیص نوشتن لغو شده)
+        self._inflight = None  # (محتوای drain شده، writes) نوشتن در حال اجرا
+        self._wakeup = None
+        self._task = None
+
+    def reset(self):
+        self.chats = {}
+        self.by_attacker = {}
+        self.by_defender = {}
+        self.pending = bytearray()
+        self.pending_count = 0
+        self.file_records = 0
+        self.rewrite = False
+
+    def _append(self, chat_id, attacker, defender, packed):
+        """افزودن رکورد به بافر گروه و ایندکس‌ها؛ ایندکس نبرد بازنویسی شده حذف می‌شود"""
+        ring = self.chats.get(chat_id)
+        if ring is None:
+            ring = self.chats[chat_id] = BattleRing(self.retention)
+        seq = ring.count
+        if seq >= ring.capacity:
+            evicted = ring.get(seq - ring.capacity)
+            for index, user_id in ((self.by_attacker, evicted[1]), (self.by_defender, evicted[2])):
+                key = (chat_id, user_id)
+                seqs = index.get(key)
+                if seqs and seqs[0] == seq - ring.capacity:
+                    seqs.popleft()
+                    if not seqs:
+                        del index[key]
+        ring.write(packed)
+        self.by_attacker.setdefault((chat_id, attacker), deque()).append(seq)
+        self.by_defender.setdefault((chat_id, defender), deque()).append(seq)
+        return seq
+
+    def record(self, chat_id, attacker, defender, attack_strength, defense_strength, money=0, oil=0,
+               attacker_lost=0, defender_lost=0, won=False, conquest=False, timestamp=None):
+        """ثبت یک نبرد (بدون I/O)؛ شماره نبرد در گروه برگردانده می‌شود"""
+        chat_id, attacker, defender = int(chat_id), int(attacker), int(defender)
+        flags = (BATTLE_WON if won else 0) | (BATTLE_CONQUEST if conquest else 0)
+        packed = BATTLE_RECORD.pack(chat_id, attacker, defender, time.time() if timestamp is None else timestamp,
+                                    attack_strength, defense_strength, int(money), int(oil),
+                                    int(attacker_lost), int(defender_lost), flags)
+        seq = self._append(chat_id, attacker, defender, packed)
+        if self.enabled:
+            self.pending += packed
+            self.pending_count += 1
+            if self._task is None:
+                # بدون نویسنده پس‌زمینه (تست‌ها و ابزارها) مستقیم نوشته می‌شود
+                self.flush()
+        return seq
+
+    def _battles(self, chat_id, seqs):
+        ring = self.chats[chat_id]
+        return [Battle(seq, ring.get(seq)) for seq in seqs]
+
+    def recent(self, chat_id, limit=10):
+        """آخرین نبردهای گروه از جدید به قدیم"""
+        ring = self.chats.get(int(chat_id))
+        if ring is None:
+            return []
+        return self._battles(int(chat_id), range(ring.count - 1, max(ring.oldest(), ring.count - limit) - 1, -1))
+
+    def player(self, chat_id, user_id, limit=10):
+        """آخرین نبردهای بازیکن (حمله و دفاع) از جدید به قدیم"""
+        key = (int(chat_id), int(user_id))
+        attacks = self.by_attacker.get(key, ())
+        defenses = self.by_defender.get(key, ())
+        seqs = heapq.merge(reversed(attacks), reversed(defenses), key=lambda seq: -seq)
+        return self._battles(key[0], list(itertools.islice(seqs, limit))) if attacks or defenses else []
+
+    def stats(self, chat_id, user_id):
+        """آمار نبردهای نگه داشته شده بازیکن"""
+        key = (int(chat_id), int(user_id))
+        stats = {"attacks": 0, "attack_wins": 0, "defenses": 0, "defense_wins": 0,
+                 "loot_money": 0, "loot_oil": 0, "lost_money": 0, "lost_oil": 0, "units_lost": 0}
+        ring = self.chats.get(key[0])
+        for seq in self.by_attacker.get(key, ()):
+            fields = ring.get(seq)
+            stats["attacks"] += 1
+            stats["units_lost"] += fields[8]
+            if fields[10] & BATTLE_WON:
+                stats["attack_wins"] += 1
+                stats["loot_money"] += fields[6]
+                stats["loot_oil"] += fields[7]
+            else:
+                stats["lost_money"] += fields[6]
+        for seq in self.by_defender.get(key, ()):
+            fields = ring.get(seq)
+            stats["defenses"] += 1
+            stats["units_lost"] += fields[9]
+            if fields[10] & BATTLE_WON:
+                stats["lost_money"] += fields[6]
+                stats["lost_oil"] += fields[7]
+            else:
+                stats["defense_wins"] += 1
+        return stats
+
+    def revenge_target(self, chat_id, user_id):
+        """آخرین نبردی که در آن به بازیکن حمله شد و مهاجم پیروز شد (یا None)"""
+        key = (int(chat_id), int(user_id))
+        ring = self.chats.get(key[0])
+        for seq in reversed(self.by_defender.get(key, ())):
+            fields = ring.get(seq)
+            if fields[10] & BATTLE_WON:
+                return Battle(seq, fields)
+        return None
+
+    def retained(self):
+        return sum(min(ring.count, ring.capacity) for ring in self.chats.values())
+
+    def snapshot(self):
+        """رکوردهای نگه داشته شده تمام گروه‌ها به ترتیب ثبت در هر گروه"""
+        return b"".join(ring.raw(seq) for ring in self.chats.values() for seq in range(ring.oldest(), ring.count))
+
+    def drain(self):
+        """خالی کردن صف؛ در صورت بزرگ شدن فایل، محتوای بازنویسی کامل ساخته می‌شود"""
+        if self.rewrite or (self.file_records + self.pending_count > 2 * self.retained()
+                            and self.file_records + self.pending_count > self.retention):
+            payload, count, replace = self.snapshot(), self.retained(), True
+            self.rewrite = False
+        else:
+            payload, count, replace = bytes(self.pending), self.pending_count, False
+        self.pending = bytearray()
+        self.pending_count = 0
+        return payload, count, replace
+
+    def restore(self, payload, count, replace):
+        """بازگرداندن محتوای drain شده به صف پس از شکست یا لغو نوشتن"""
+        if replace:
+            # بازنویسی کامل از حافظه ساخته می‌شود و صف فعلی را هم شامل می‌شود
+            self.rewrite = True
+        else:
+            self.pending[:0] = payload
+            self.pending_count += count
+
+    def write_payload(self, payload, count, replace):
+        """افزودن رکوردها به فایل یا بازنویسی فشرده آن (روی نخ I/O)"""
+        if replace:
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(payload)
+            os.replace(temp_path, self.path)
+            self.file_records = count
+        elif payload:
+            with open(self.path, 'ab') as f:
+                f.write(payload)
+            self.file_records += count
+        self.writes += 1
+        return count
+
+    def flush(self):
+        """نوشتن همزمان نبردهای صف در فایل"""
+        drained = self.drain()
+        try:
+            return self.write_payload(*drained)
+        except BaseException:
+            self.restore(*drained)
+            raise
+
+    def load(self, path=None, keep=None):
+        """
+        بارگذاری نبردها از path (پیش‌فرض فایل دفتر)
+
+        رکورد ناقص انتهای فایل (قطع برق هنگام نوشتن) نادیده گرفته می‌شود. keep تابعی
+        روی chat_id است که برای انتقال بخشی از فایل دیگر (شاردها) استفاده می‌شود؛ در
+        این حالت رکوردهای منتقل شده در نوشتن بعدی در فایل خود دفتر بازنویسی می‌شوند.
+        """
+        if self.pending_count:
+            self.flush()
+        self.reset()
+        source = path or self.path
+        if not os.path.exists(source):
+            return 0
+        with open(source, 'rb') as f:
+            data = f.read()
+        size = BATTLE_RECORD.size
+        records = len(data) // size
+        for offset in range(0, records * size, size):
+            chat_id, attacker, defender = BATTLE_ID_FIELDS.unpack_from(data, offset)
+            if keep is None or keep(chat_id):
+                self._append(chat_id, attacker, defender, data[offset:offset + size])
+        if path is None:
+            self.file_records = records
+            self.rewrite = records * size != len(data)  # حذف رکورد ناقص
+        else:
+            self.rewrite = bool(self.chats)
+        return records
+
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def run(self):
+        """نویسنده پس‌زمینه"""
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if not self.pending_count and not self.rewrite:
+                continue
+            drained = self.drain()
+            self._inflight = (drained, self.writes)
+            try:
+                await io_executor.run(self.write_payload, *drained)
+            except asyncio.CancelledError:
+                # کار ممکن است هنوز در صف I/O باشد؛ close پس از توقف نخ I/O تصمیم می‌گیرد
+                raise
+            except Exception as e:
+                self._inflight = None
+                self.restore(*drained)
+                print(f"خطا در نوشتن تاریخچه نبردها: {e}")
+            else:
+                self._inflight = None
+
+    def start(self):
+        """شروع نویسنده پس‌زمینه (داخل event loop ربات)"""
+        if self._task is not None and not self._task.done():
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.ensure_future(self.run())
+
+    def close(self):
+        """توقف نویسنده و نوشتن نبردهای باقیمانده (پس از io_executor.close)"""
+        cancel_task(self._task)
+        self._task = None
+        self._wakeup = None
+        if self._inflight is not None:
+            drained, writes = self._inflight
+            self._inflight = None
+            if self.writes == writes:
+                # نوشتن لغو شده هرگز اجرا نشد
+                self.restore(*drained)
+        try:
+            if self.pending_count or self.rewrite:
+                self.flush()
+        except Exception as e:
+            print(f"خطا در نوشتن تاریخچه نبردها: {e}")
+
+# سه فیلد اول رکورد برای ساخت ایندکس‌ها هنگام بارگذاری
+BATTLE_ID_FIELDS = struct.Struct("<qqq")
+
+battle_ledger = BattleLedger(BATTLES_FILE, BATTLE_HISTORY_PER_CHAT)
+
+def load_battles():
+    """بارگذاری تاریخچه نبردها (روی نخ I/O قابل اجراست)"""
+    try:
+        battle_ledger.load()
+    except Exception as e:
+        print(f"خطا در بارگذاری تاریخچه نبردها: {e}")
+
+# ==================== RESOURCE ACCRUAL ====================
+# ترتیب منابع در بردار تولید
+RESOURCE_ORDER = tuple(RESOURCES)
+
+# ضرایب حکومتی که فقط روی یک منبع اثر دارند
+GOVERNMENT_RESOURCE_MODIFIERS = {
+    "money": ("money_penalty",),
+    "population": ("population_bonus",),
+    "social_credit": ("social_credit_bonus",),
+    "technology": ("technology_penalty",),
+}
+
+def capital_production(user_data):
+    """تولید پایه هر منبع در یک چرخه بر اساس سطح پایتخت"""
+    capital = user_data["capital"]
+    government_level = capital.get("government", 0)
+    economy_level = capital.get("economy", 0)
+    infrastructure_level = capital.get("infrastructure", 0)
+    return {
+        "money": 10 + (government_level * 5) + (economy_level * 3),
+        "oil": 5 + (government_level * 2) + (infrastructure_level * 1),
+        "uranium": 1 + (government_level // 2),
+        "social_credit": 2 + (government_level // 3),
+        "technology": 1 + (capital.get("research_lab", 0) * 2),
+        "steel": 3 + (infrastructure_level * 2),
+        "aluminum": 2 + (infrastructure_level * 1),
+        "titanium": 1 + (infrastructure_level // 2),
+        "rare_earth": 1 + (infrastructure_level // 3),
+        "population": 20 + (government_level * 10),
+    }
+
+def government_modifiers(user_data):
+    """ضرایب مزایا و معایب سیستم مدیریت کاربر"""
+    government = GOVERNMENT_SYSTEMS.get(user_data.get("government"), {})
+    modifiers = dict(government.get("benefits", {}))
+    modifiers.update(government.get("penalties", {}))
+    return modifiers
+
+def compute_production_vector(user_data):
+    """محاسبه مستقیم تولید هر چرخه به ترتیب RESOURCE_ORDER (پایتخت + کالکتورها با ضرایب حکومت)"""
+    modifiers = government_modifiers(user_data)
+    base = capital_production(user_data)
+    
+    # تولید کالکتورها بر حسب ساعت تعریف شده است
+    collected = dict.fromkeys(RESOURCE_ORDER, 0)
+    for collector, count in user_data.get("collectors", {}).items():
+        info = RESOURCE_COLLECTORS.get(collector)
+        if count > 0 and info is not None:
+            collected[info["resource"]] += info["base_production"] * count
+    collector_scale = (PRODUCTION_INTERVAL / 3600 * user_data.get("collector_efficiency", 1.0)
+                       * modifiers.get("collector_bonus", 1) * modifiers.get("collector_penalty", 1))
+    
+    all_resources = modifiers.get("resource_bonus", 1) * modifiers.get("resource_penalty", 1)
+    vector = []
+    for resource in RESOURCE_ORDER:
+        multiplier = all_resources
+        for modifier in GOVERNMENT_RESOURCE_MODIFIERS.get(resource, ()):
+            multiplier *= modifiers.get(modifier, 1)
+        vector.append((base.get(resource, 0) + collected[resource] * collector_scale) * multiplier)
+    return vector
+
+def production_vector(user_data):
+    """بردار تولید هر چرخه با کش rate_cache روی رکورد کاربر"""
+    cached = user_data.get("rate_cache")
+    if cached is None:
+        cached = user_data["rate_cache"] = compute_production_vector(user_data)
+    return cached
+
+def invalidate_production(user_data):
+    """پاک کردن کش تولید پس از تغییر کالکتورها، اپگرید پایتخت یا سیستم مدیریت"""
+    user_data["rate_cache"] = None
+
+def accrual_time(user_data):
+    """زمان epoch آخرین تسویه درآمد (رکوردهای قدیمی از last_active تبدیل می‌شوند)"""
+    accrued_at = user_data.get("accrued_at")
+    if accrued_at is None:
+        try:
+            accrued_at = datetime.fromisoformat(user_data["last_active"]).timestamp()
+        except (KeyError, TypeError, ValueError):
+            accrued_at = time.time()
+        user_data["accrued_at"] = accrued_at
+    return accrued_at
+
+def pending_cycles(user_data, now=None):
+    """تعداد چرخه‌های تولید کامل شده از آخرین تسویه"""
+    now = time.time() if now is None else now
+    return max(0, int((now - accrual_time(user_data)) // PRODUCTION_INTERVAL))
+
+def accrue_resources(user_data, now=None):
+    """
+    تسویه درآمد انباشته از آخرین تسویه
+
+    درآمد به جای اعطا با هر پیام، هنگام خواندن به صورت (نرخ × تعداد چرخه)
+    محاسبه می‌شود؛ باقیمانده چرخه ناقص برای تسویه بعدی حفظ می‌شود.
+    خروجی (تعداد چرخه‌ها، درآمد هر منبع) است.
+    """
+    cycles = pending_cycles(user_data, now)
+    if not cycles:
+        return 0, {}
+    income = {resource: int(rate * cycles) for resource, rate in zip(RESOURCE_ORDER, production_vector(user_data))}
+    resources = user_data["resources"]
+    for resource, amount in income.items():
+        resources[resource] = resources.get(resource, 0) + amount
+    user_data["experience"] += income["money"] // 10
+    user_data["accrued_at"] += cycles * PRODUCTION_INTERVAL
+    return cycles, income
+
+def settle_user(chat_id, user_id):
+    """دریافت داده کاربر پس از تسویه درآمد انباشته"""
+    user_data = get_user_data(chat_id, user_id)
+    if accrue_resources(user_data)[0]:
+        mark_user_dirty(chat_id, user_id)
+    return user_data
+
+# ==================== VECTORIZED ECONOMY ====================
+class EconomyStore:
+    """
+    ذخیره ستونی اقتصاد تمام بازیکنان (اختیاری، نیازمند numpy)
+
+    موجودی منابع، تجربه، زمان آخرین تسویه و بردار تولید هر بازیکن در ماتریس‌های
+    numpy نگهداری می‌شود تا tick تولید کل دنیا یک عملیات برداری باشد. نتیجه tick
+    ردیف‌ها را stale علامت می‌زند و هنگام خواندن داده کاربر (get_user_data) به
+    دیکشنری او منتقل می‌شود؛ تغییرات هندلرها با mark_user_dirty به ردیف برمی‌گردند.
+    tick همان نتیجه accrue_resources را دارد، پس ردیف‌های منتقل نشده نیازی به ذخیره ندارند.
+    """
+
+    def __init__(self, tick_interval=PRODUCTION_INTERVAL):
+        self.tick_interval = tick_interval
+        self.ticks = 0
+        self._task = None
+        self.reset()
+
+    @staticmethod
+    def available():
+        return np is not None
+
+    def reset(self):
+        self.index = {}
+        self.size = 0
+        self.balances = None
+        self.rates = None
+        self.experience = None
+        self.accrued_at = None
+        self.stale = None
+        self.built = False
+
+    def _allocate(self, capacity):
+        def grow(old, shape, dtype):
+            new = np.zeros(shape, dtype=dtype)
+            if old is not None:
+                new[:self.size] = old[:self.size]
+            return new
+        width = len(RESOURCE_ORDER)
+        self.balances = grow(self.balances, (capacity, width), np.int64)
+        self.rates = grow(self.rates, (capacity, width), np.float64)
+        self.experience = grow(self.experience, capacity, np.int64)
+        self.accrued_at = grow(self.accrued_at, capacity, np.float64)
+        self.stale = grow(self.stale, capacity, np.bool_)
+
+    def build(self):
+        """ساخت ماتریس‌ها از تمام کاربران"""
+        self.reset()
+        self._allocate(max(16, len(game_data["users"])))
+        self.built = True
+        for user_key, user_data in game_data["users"].items():
+            self.push(user_key, user_data)
+
+    def _row(self, user_key):
+        row = self.index.get(user_key)
+        if row is None:
+            if self.size == len(self.accrued_at):
+                self._allocate(self.size * 2)
+            row = self.index[user_key] = self.size
+            self.size += 1
+        return row
+
+    def push(self, user_key, user_data):
+        """انتقال دیکشنری کاربر به ردیف ماتریس (پس از تغییر توسط هندلر)"""
+        if not self.built or user_data is None:
+            return
+        row = self._row(user_key)
+        resources = user_data["resources"]
+        self.balances[row] = [resources.get(resource, 0) for resource in RESOURCE_ORDER]
+        self.rates[row] = production_vector(user_data)
+        self.experience[row] = user_data.get("experience", 0)
+        self.accrued_at[row] = accrual_time(user_data)
+        self.stale[row] = False
+
+    def pull(self, user_key, user_data):
+        """انتقال نتیجه tick از ردیف ماتریس به دیکشنری کاربر"""
+        if not self.built:
+            return False
+        row = self.index.get(user_key)
+        if row is None or not self.stale[row]:
+            return False
+        resources = user_data["resources"]
+        for resource, amount in zip(RESOURCE_ORDER, self.balances[row].tolist()):
+            resources[resource] = amount
+        user_data["experience"] = int(self.experience[row])
+        user_data["accrued_at"] = float(self.accrued_at[row])
+        self.stale[row] = False
+        return True
+
+    def tick(self, now=None):
+        """تسویه درآمد انباشته تمام بازیکنان؛ خروجی تعداد بازیکنان تسویه شده"""
+        if not self.built:
+            self.build()
+        size = self.size
+        now = time.time() if now is None else now
+        cycles = np.maximum(np.floor_divide(now - self.accrued_at[:size], PRODUCTION_INTERVAL), 0)
+        income = np.floor(self.rates[:size] * cycles[:, None]).astype(np.int64)
+        self.balances[:size] += income
+        self.experience[:size] += income[:, RESOURCE_ORDER.index("money")] // 10
+        self.accrued_at[:size] += cycles * PRODUCTION_INTERVAL
+        settled = cycles > 0
+        self.stale[:size] |= settled
+        self.ticks += 1
+        return int(np.count_nonzero(settled))
+
+    def totals(self):
+        """مجموع موجودی هر منبع در کل دنیا"""
+        if not self.built:
+            self.build()
+        return dict(zip(RESOURCE_ORDER, self.balances[:self.size].sum(axis=0).tolist()))
+
+    async def run(self):
+        """حلقه tick دوره‌ای تولید"""
+        while True:
+            await asyncio.sleep(self.tick_interval)
+            try:
+                self.tick()
+            except Exception as e:
+                print(f"خطا در tick اقتصاد: {e}")
+
+    def start(self):
+        if not self.available():
+            print("⚠️ numpy نصب نیست؛ tick برداری اقتصاد غیرفعال است")
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self.run())
+
+    def close(self):
+        cancel_task(self._task)
+        self._task = None
+
+economy = EconomyStore()
+
+# ==================== HELPER FUNCTIONS ====================
+def compute_total_power(user_data):
+    """محاسبه مستقیم قدرت کل نظامی (بدون کش)"""
+    base_power = UNIT_CATALOG.army_power(user_data["military"])
+    # اعمال بونوس آکادمی نظامی
+    academy_level = user_data["capital"].get("military_academy", 0)
+    return int(base_power * (1 + academy_level * 0.1))
+
+def calculate_total_power(user_data):
+    """محاسبه قدرت کل نظامی با استفاده از کش power_cache روی رکورد کاربر"""
+    cached = user_data.get("power_cache")
+    if cached is None:
+        cached = user_data["power_cache"] = compute_total_power(user_data)
+    elif DEBUG_POWER_CHECK:
+        check_power_cache(user_data)
+    return cached
+
+def invalidate_power(user_data):
+    """پاک کردن کش قدرت پس از تغییر نیروی نظامی یا آکادمی نظامی"""
+    user_data["power_cache"] = None
+
+def check_power_cache(user_data):
+    """بررسی سازگاری کش قدرت با محاسبه مستقیم (حالت دیباگ)"""
+    expected = compute_total_power(user_data)
+    cached = user_data.get("power_cache")
+    if cached is not None and cached != expected:
+        print(f"⚠️ کش قدرت نامعتبر: {cached} != {expected}")
+        user_data["power_cache"] = expected
+        return False
+    return True
+
+def verify_power_caches():
+    """بررسی کش قدرت تمام کاربران؛ خروجی کلید کاربران ناسازگار"""
+    return [user_key for user_key, user_data in game_data["users"].items() if not check_power_cache(user_data)]
+
+def calculate_country_level(user_data):
+    """محاسبه سطح کشور بر اساس قدرت و منابع"""
+    military_power = calculate_total_power(user_data)
+    total_resources = sum(user_data["resources"].values())
+    experience = user_data["experience"]
+    
+    # فرمول محاسبه سطح
+    level = 1 + (military_power // 1000) + (total_resources // 10000) + (experience // 1000)
+    return min(level, 50)  # حداکثر سطح 50
+
+def can_afford_unit(user_data, unit_type, quantity=1):
+    """بررسی امکان خرید واحد"""
+    if unit_type not in MILITARY_UNITS:
+        return False, "واحد نامعتبر"
+    
+    unit = MILITARY_UNITS[unit_type]
+    user_level = user_data["level"]
+    
+    if user_level < unit["level_req"]:
+        return False, f"نیاز به سطح {unit['level_req']}"
+    
+    # بررسی منابع مورد نیاز
+    cost = unit["cost"] * quantity
+    if user_data["resources"]["money"] < cost:
+        return False, "پول کافی ندارید"
+    
+    return True, "موفق"
+
+def can_attack(attacker_data, defender_data, attacker_country, defender_country):
+    """بررسی امکان حمله"""
+    attacker_level = attacker_country["level"]
+    defender_level = defender_country["level"]
+    
+    # نمی‌توان به کشورهای خیلی قوی‌تر حمله کرد
+    if defender_level > attacker_level * 2:
+        return False, "کشور هدف خیلی قوی است"
+    
+    # بررسی اتحاد
+    if (attacker_data["alliance"] and defender_data["alliance"] and 
+        attacker_data["alliance"] == defender_data["alliance"]):
+        return False, "نمی‌توان به متحد حمله کرد"
+    
+    return True, "موفق"
+
+# ==================== COMBAT ENGINE ====================
+BATTLE_ROLL = (0.8, 1.2)  # بازه ضریب تصادفی قدرت هر طرف در هر مرحله
+
+battle_rng = np.random.default_rng() if np is not None else None
+
+# ضریب اثر دسته مهاجم (کلید بیرونی) روی دسته هدف؛ جفت‌های ذکر نشده 1.0 هستند
+CATEGORY_MATCHUPS = {
+    "infantry": {"infantry": 1.2, "tank": 0.7, "fighter": 0.2, "bomber": 0.2, "naval": 0.2},
+    "light_vehicle": {"infantry": 1.5, "tank": 0.5, "fighter": 0.2, "bomber": 0.2, "naval": 0.3},
+    "tank": {"infantry": 1.5, "light_vehicle": 2.0, "helicopter": 0.5, "drone": 0.3, "fighter": 0.1, "bomber": 0.1, "naval": 0.3},
+    "artillery": {"infantry": 2.0, "light_vehicle": 1.5, "defense": 1.5, "drone": 0.3, "fighter": 0.1, "bomber": 0.1},
+    "anti_air": {"fighter": 2.5, "bomber": 2.5, "helicopter": 2.5, "drone": 3.0, "missile": 1.5,
+                 "infantry": 0.5, "tank": 0.3, "naval": 0.3},
+    "fighter": {"fighter": 1.5, "bomber": 2.0, "helicopter": 2.0, "drone": 1.5, "naval": 0.8, "anti_air": 0.5},
+    "bomber": {"infantry": 1.5, "tank": 1.5, "artillery": 2.0, "defense": 1.5,
+               "fighter": 0.2, "helicopter": 0.3, "drone": 0.3},
+    "helicopter": {"tank": 2.0, "light_vehicle": 1.5, "infantry": 1.2, "fighter": 0.3, "bomber": 0.5, "anti_air": 0.3},
+    "drone": {"artillery": 1.5, "light_vehicle": 1.5, "defense": 1.2, "fighter": 0.3, "anti_air": 0.5},
+    "naval": {"naval": 2.0, "defense": 1.2, "fighter": 0.7, "bomber": 0.7},
+    "missile": {"defense": 2.0, "naval": 1.5, "artillery": 1.5},
+    "defense": {"missile": 2.5, "bomber": 2.0, "drone": 2.0, "fighter": 1.5, "helicopter": 1.5},
+}
+
+# ضریب قدرت دسته‌ها (هنگام حمله، هنگام دفاع)؛ سیستم‌های دفاعی ثابت هستند
+CATEGORY_STANCE = {"defense": (0.5, 1.5)}
+
+class CombatEngine:
+    """
+    نبرد چند مرحله‌ای بین بردارهای قدرت دسته‌های واحدها
+
+    ارتش هر طرف یکبار به بردار قدرت دسته‌ها (CATEGORY_KEYS) تبدیل می‌شود. در هر مرحله
+    آسیب هر طرف ضرب بردار نیرویش در ماتریس اثر دسته‌هاست که به نسبت حضور دسته‌های
+    حریف بین آن‌ها تقسیم می‌شود؛ هزینه هر مرحله به اندازه ماتریس (نه تعداد واحدها)
+    است. قدرت نهایی هر طرف مجموع قدرت بازمانده و آسیب وارد شده است و نسبت بازمانده
+    هر دسته در پایان به تلفات هر نوع واحد تبدیل می‌شود.
+    """
+
+    def __init__(self, matchups=CATEGORY_MATCHUPS, stance=CATEGORY_STANCE, rounds=COMBAT_ROUNDS,
+                 lethality=COMBAT_LETHALITY):
+        size = len(CATEGORY_KEYS)
+        matrix = [[1.0] * size for _ in range(size)]
+        for attacker, targets in matchups.items():
+            for target, factor in targets.items():
+                matrix[CATEGORY_KEYS.index(attacker)][CATEGORY_KEYS.index(target)] = factor
+        self.matrix = tuple(tuple(row) for row in matrix)
+        self.columns = tuple(zip(*self.matrix))
+        self.array = np.array(self.matrix) if np is not None else None
+        self.attack_stance = tuple(stance.get(category, (1.0, 1.0))[0] for category in CATEGORY_KEYS)
+        self.defense_stance = tuple(stance.get(category, (1.0, 1.0))[1] for category in CATEGORY_KEYS)
+        self.rounds = rounds
+        self.lethality = lethality
+
+    def forces(self, user_data, defending=False):
+        """بردار قدرت دسته‌های ارتش با بونوس آکادمی نظامی و ضریب حمله/دفاع"""
+        academy = 1 + user_data["capital"].get("military_academy", 0) * 0.1
+        stance = self.defense_stance if defending else self.attack_stance
+        return [power * academy * factor for power, factor in zip(UNIT_CATALOG.category_power(user_data["military"]), stance)]
+
+    def rolls(self):
+        """ضریب تصادفی (حمله، دفاع) هر مرحله"""
+        return [(random.uniform(*BATTLE_ROLL), random.uniform(*BATTLE_ROLL)) for _ in range(self.rounds)]
+
+    def _strike(self, source, target, roll):
+        """آسیب یک مرحله source به هر دسته target"""
+        total = sum(target)
+        if not total:
+            return [0.0] * len(target)
+        scale = roll * self.lethality / total
+        return [scale * share * sum(force * factor for force, factor in zip(source, column))
+                for share, column in zip(target, self.columns)]
+
+    def resolve(self, attacker, defender, rolls=None):
+        """اجرای نبرد؛ خروجی (قدرت حمله، قدرت دفاع، بردار بازمانده مهاجم، بردار بازمانده مدافع)"""
+        attacker, defender = list(attacker), list(defender)
+        dealt_attacker = dealt_defender = 0.0
+        for attack_roll, defense_roll in rolls or self.rolls():
+            to_defender = self._strike(attacker, defender, attack_roll)
+            to_attacker = self._strike(defender, attacker, defense_roll)
+            lost_defender = [min(force, damage) for force, damage in zip(defender, to_defender)]
+            lost_attacker = [min(force, damage) for force, damage in zip(attacker, to_attacker)]
+            defender = [force - lost for force, lost in zip(defender, lost_defender)]
+            attacker = [force - lost for force, lost in zip(attacker, lost_attacker)]
+            dealt_attacker += sum(lost_defender)
+            dealt_defender += sum(lost_attacker)
+        return sum(attacker) + dealt_attacker, sum(defender) + dealt_defender, attacker, defender
+
+    def _strike_batch(self, source, target, matrix, roll):
+        # آرایه‌ها (دسته، نمونه) هستند؛ maximum فقط از تقسیم بر صفر برای ارتش خالی جلوگیری می‌کند
+        scale = roll * self.lethality / np.maximum(target.sum(axis=0), 1e-12)
+        damage = matrix @ source
+        damage *= target
+        damage *= scale
+        return np.minimum(target, damage, out=damage)
+
+    def simulate(self, attacker, defender, samples, rng=None):
+        """همان نبرد برای samples نمونه در یک دسته numpy؛ خروجی آرایه‌های قدرت حمله و دفاع"""
+        rng = rng or battle_rng
+        # فقط دسته‌های حاضر در نبرد؛ دسته‌های خالی نه آسیب می‌زنند و نه آسیب می‌بینند
+        active = [index for index, (a, d) in enumerate(zip(attacker, defender)) if a or d]
+        matrix = np.ascontiguousarray(self.array[np.ix_(active, active)].T)
+        attacker = np.repeat(np.asarray(attacker, dtype=float)[active, None], samples, axis=1)
+        defender = np.repeat(np.asarray(defender, dtype=float)[active, None], samples, axis=1)
+        rolls = rng.uniform(BATTLE_ROLL[0], BATTLE_ROLL[1], (self.rounds, 2, samples))
+        dealt_attacker = np.zeros(samples)
+        dealt_defender = np.zeros(samples)
+        for attack_roll, defense_roll in rolls:
+            lost_defender = self._strike_batch(attacker, defender, matrix, attack_roll)
+            lost_attacker = self._strike_batch(defender, attacker, matrix, defense_roll)
+            defender -= lost_defender
+            attacker -= lost_attacker
+            dealt_attacker += lost_defender.sum(axis=0)
+            dealt_defender += lost_attacker.sum(axis=0)
+        return attacker.sum(axis=0) + dealt_attacker, defender.sum(axis=0) + dealt_defender
+
+    @staticmethod
+    def casualties(military, before, after):
+        """تلفات هر نوع واحد از بردار قدرت دسته‌ها پیش و پس از نبرد"""
+        survival = [left / start if start else 1.0 for start, left in zip(before, after)]
+        return UNIT_CATALOG.casualties(military, survival)
+
+combat_engine = CombatEngine()
+
+def apply_casualties(user_data, losses):
+    """کم کردن تلفات از ارتش؛ خروجی تعداد کل واحدهای از دست رفته"""
+    military = user_data["military"]
+    for unit_type, lost in losses.items():
+        remaining = military.get(unit_type, 0) - lost
+        if remaining > 0:
+            military[unit_type] = remaining
+        else:
+            military.pop(unit_type, None)
+    if losses:
+        invalidate_power(user_data)
+    return sum(losses.values())
+
+# ==================== BATTLE ODDS ====================
+def victory_ratios(attack_strength, defense_strength, minimum=min):
+    """نسبت غنیمت و شانس فتح پس از پیروزی حمله کننده (minimum برای آرایه‌ها np.minimum است)"""
+    margin = (attack_strength - defense_strength) / attack_strength
+    return minimum(0.3, margin * 0.5), minimum(0.1, margin * 0.2)
+
+def defeat_ratio(attack_strength, defense_strength, minimum=min):
+    """نسبت جریمه پول حمله کننده پس از شکست"""
+    return minimum(0.2, (defense_strength - attack_strength) / defense_strength * 0.3)
+
+# اندازه هر دسته numpy در پیش‌بینی؛ زمان پس از هر دسته با BATTLE_PREVIEW_TIME_LIMIT مقایسه می‌شود
+BATTLE_PREVIEW_CHUNK = 10000
+
+def preview_samples(attacker_forces, defender_forces):
+    """تعداد نمونه‌های پیش‌بینی متناسب با تعداد دسته‌های حاضر در نبرد"""
+    active = sum(1 for attack, defense in zip(attacker_forces, defender_forces) if attack or defense)
+    return max(1, min(BATTLE_PREVIEW_SAMPLES, BATTLE_PREVIEW_CELLS // max(1, active)))
+
+def simulate_battle_odds(attacker_forces, defender_forces, defender_money, defender_oil, attacker_money,
+                         samples=None, rng=None, time_limit=None):
+    """
+    شبیه‌سازی مونت‌کارلو حمله با همان موتور نبرد و فرمول‌های attack_command
+
+    با numpy نمونه‌ها در دسته‌های برداری (CombatEngine.simulate) محاسبه می‌شوند و تعداد
+    آن‌ها با تعداد دسته‌های حاضر کم می‌شود؛ بدون numpy تعداد کمتری نمونه با حلقه پایتون.
+    پس از گذشتن time_limit ثانیه نمونه‌گیری متوقف می‌شود و samples خروجی تعداد واقعی
+    نمونه‌هاست. غنیمت، جریمه و شانس فتح امید ریاضی روی تمام نمونه‌ها هستند (شانس فتح
+    هر پیروزی مستقیماً جمع می‌شود، بدون قرعه دوم).
+    """
+    money = oil = conquest = penalty = 0.0
+    wins = done = 0
+    deadline = time.perf_counter() + (BATTLE_PREVIEW_TIME_LIMIT if time_limit is None else time_limit)
+    if np is not None:
+        samples = samples or preview_samples(attacker_forces, defender_forces)
+        while done < samples:
+            size = min(BATTLE_PREVIEW_CHUNK, samples - done)
+            attack, defense = combat_engine.simulate(attacker_forces, defender_forces, size, rng)
+            won = attack > defense
+            chunk_wins = int(np.count_nonzero(won))
+            if chunk_wins:
+                loot, chance = victory_ratios(attack[won], defense[won], np.minimum)
+                money += float(np.floor(defender_money * loot).sum())
+                oil += float(np.floor(defender_oil * loot).sum())
+                conquest += float(chance.sum())
+            if chunk_wins < size:
+                lost = ~won
+                penalty += float(np.floor(attacker_money * defeat_ratio(attack[lost], defense[lost], np.minimum)).sum())
+            wins += chunk_wins
+            done += size
+            if time.perf_counter() > deadline:
+                break
+    else:
+        samples = samples or BATTLE_PREVIEW_FALLBACK_SAMPLES
+        while done < samples:
+            attack_strength, defense_strength, _, _ = combat_engine.resolve(attacker_forces, defender_forces)
+            if attack_strength > defense_strength:
+                wins += 1
+                loot, chance = victory_ratios(attack_strength, defense_strength)
+                money += int(defender_money * loot)
+                oil += int(defender_oil * loot)
+                conquest += chance
+            else:
+                penalty += int(attacker_money * defeat_ratio(attack_strength, defense_strength))
+            done += 1
+            if time.perf_counter() > deadline:
+                break
+    return {
+        "samples": done,
+        "win_probability": wins / done,
+        "expected_money": money / done,
+        "expected_oil": oil / done,
+        "conquest_chance": conquest / done,
+        "expected_penalty": penalty / done,
+    }
+
+# ==================== LEADERBOARD INDEX ====================
+# معیارهای رتبه‌بندی و نام‌های قابل استفاده در /leaderboard
+LEADERBOARD_METRICS = ("power", "level", "battles_won")
+LEADERBOARD_ALIASES = {
+    "power": "power", "قدرت": "power",
+    "level": "level", "سطح": "level",
+    "wins": "battles_won", "battles_won": "battles_won", "برد": "battles_won",
+}
+LEADERBOARD_TITLES = {"power": "قدرت", "level": "سطح", "battles_won": "برد"}
+
+class RankedList:
+    """
+    لیست مرتب بلوکی (به روش sortedcontainers) با درخت فنویک روی اندازه بلوک‌ها
+
+    عناصر در بلوک‌های مرتب با حداکثر 2*load عضو نگهداری می‌شوند و maxes بزرگترین
+    عضو هر بلوک است. درج و حذف فقط یک بلوک کوچک را جابجا می‌کنند و رتبه با جمع
+    پیشوندی فنویک در O(log n) به دست می‌آید؛ درخت فقط هنگام تقسیم یا ادغام بلوک‌ها
+    دوباره ساخته می‌شود.
+    """
+
+    def __init__(self, load=64):
+        self.load = load
+        self.blocks = []
+        self.maxes = []
+        self.tree = [0]  # فنویک (از اندیس 1) روی طول بلوک‌ها
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.blocks)
+
+    def _rebuild(self):
+        tree = [0] + [len(block) for block in self.blocks]
+        for index in range(1, len(tree)):
+            parent = index + (index & -index)
+            if parent < len(tree):
+                tree[parent] += tree[index]
+        self.tree = tree
+
+    def _adjust(self, block_index, delta):
+        index = block_index + 1
+        while index < len(self.tree):
+            self.tree[index] += delta
+            index += index & -index
+
+    def _prefix(self, block_index):
+        """تعداد عناصر بلوک‌های قبل از block_index"""
+        total = 0
+        index = block_index
+        while index:
+            total += self.tree[index]
+            index -= index & -index
+        return total
+
+    def _split(self, block_index):
+        block = self.blocks[block_index]
+        self.blocks.insert(block_index + 1, block[self.load:])
+        del block[self.load:]
+        self.maxes.insert(block_index, block[-1])
+
+    def add(self, item):
+        self.size += 1
+        if not self.blocks:
+            self.blocks.append([item])
+            self.maxes.append(item)
+            self._rebuild()
+            return
+        block_index = bisect_left(self.maxes, item)
+        if block_index == len(self.maxes):
+            block_index -= 1
+            self.blocks[block_index].append(item)
+            self.maxes[block_index] = item
+        else:
+            insort(self.blocks[block_index], item)
+        if len(self.blocks[block_index]) > 2 * self.load:
+            self._split(block_index)
+            self._rebuild()
+        else:
+            self._adjust(block_index, 1)
+
+    def remove(self, item):
+        """حذف عنصر موجود"""
+        block_index = bisect_left(self.maxes, item)
+        block = self.blocks[block_index]
+        del block[bisect_left(block, item)]
+        self.size -= 1
+        if len(block) >= self.load // 2 or len(self.blocks) == 1:
+            if block:
+                self.maxes[block_index] = block[-1]
+                self._adjust(block_index, -1)
+                return
+            del self.blocks[block_index]
+            del self.maxes[block_index]
+        else:
+            # ادغام بلوک کوچک با همسایه (و تقسیم دوباره در صورت بزرگ شدن)
+            merged = block_index - 1 if block_index else 0
+            self.blocks[merged].extend(self.blocks.pop(merged + 1))
+            del self.maxes[merged + 1]
+            if self.blocks[merged]:
+                self.maxes[merged] = self.blocks[merged][-1]
+            if len(self.blocks[merged]) > 2 * self.load:
+                self._split(merged)
+        self._rebuild()
+
+    def index(self, item):
+        """تعداد عناصر کوچکتر از item"""
+        block_index = bisect_left(self.maxes, item)
+        if block_index == len(self.maxes):
+            return self.size
+        return self._prefix(block_index) + bisect_left(self.blocks[block_index], item)
+
+    def head(self, count):
+        """count عنصر ابتدای لیست"""
+        return list(itertools.islice(self, count))
+
+class ChatLeaderboard:
+    """
+    رتبه‌بندی مرتب بازیکنان یک گروه
+
+    برای هر معیار یک RankedList از (-مقدار، user_id) نگهداری می‌شود؛ به‌روزرسانی
+    و رتبه هر بازیکن O(log n) و n نفر برتر از ابتدای لیست به دست می‌آیند.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.orders = {metric: RankedList() for metric in LEADERBOARD_METRICS}
+
+    def __len__(self):
+        return len(self.values)
+
+    def update(self, user_id, values):
+        """ثبت مقادیر جدید (قدرت، سطح، برد) یک بازیکن"""
+        old_values = self.values.get(user_id)
+        if old_values == values:
+            return
+        for index, metric in enumerate(LEADERBOARD_METRICS):
+            order = self.orders[metric]
+            if old_values is not None:
+                order.remove((-old_values[index], user_id))
+            order.add((-values[index], user_id))
+        self.values[user_id] = values
+
+    def remove(self, user_id):
+        old_values = self.values.pop(user_id, None)
+        if old_values is None:
+            return
+        for index, metric in enumerate(LEADERBOARD_METRICS):
+            self.orders[metric].remove((-old_values[index], user_id))
+
+    def top(self, metric, count):
+        """n بازیکن برتر به صورت (user_id، مقادیر)"""
+        return [(user_id, self.values[user_id]) for _, user_id in self.orders[metric].head(count)]
+
+    def rank(self, user_id, metric):
+        """رتبه بازیکن (از 1) یا None"""
+        values = self.values.get(user_id)
+        if values is None:
+            return None
+        index = LEADERBOARD_METRICS.index(metric)
+        return self.orders[metric].index((-values[index], user_id)) + 1
+
+class LeaderboardIndex:
+    """ایندکس رتبه‌بندی تمام گروه‌ها؛ یکبار از داده‌ها ساخته و سپس با هر تغییر به‌روز می‌شود"""
+
+    def __init__(self):
+        self.chats = {}
+        self.built = False
+
+    def reset(self):
+        self.chats = {}
+        self.built = False
+
+    @staticmethod
+    def user_values(user_data):
+        return (calculate_total_power(user_data), user_data.get("level", 1), user_data.get("battles_won", 0))
+
+    def build(self):
+        """ساخت ایندکس با یک پیمایش روی تمام کاربران"""
+        self.chats = {}
+        for user_key, user_data in game_data["users"].items():
+            chat_id, user_id = user_key.split(":", 1)
+            self.chats.setdefault(chat_id, ChatLeaderboard()).update(user_id, self.user_values(user_data))
+        self.built = True
+
+    def chat_count(self):
+        if not self.built:
+            self.build()
+        return sum(1 for board in self.chats.values() if len(board))
+
+    def chat(self, chat_id):
+        if not self.built:
+            self.build()
+        return self.chats.setdefault(str(chat_id), ChatLeaderboard())
+
+    def update_user(self, chat_id, user_id, user_data):
+        """به‌روزرسانی رتبه بازیکن پس از تغییر قدرت، سطح یا برد"""
+        if not self.built:
+            return
+        board = self.chat(chat_id)
+        if user_data is None:
+            board.remove(str(user_id))
+        else:
+            board.update(str(user_id), self.user_values(user_data))
+
+leaderboard_index = LeaderboardIndex()
+
+# ==================== NAME RESOLVER ====================
+class NameResolver:
+    """
+    کش نام نمایشی اعضا با TTL و LRU
+
+    نام‌ها از نویسنده هر پیام بدون هزینه ثبت می‌شوند و نام‌های ناموجود به صورت
+    همزمان (حداکثر concurrency درخواست) با get_chat_member دریافت می‌شوند.
+    """
+
+    def __init__(self, ttl=NAME_CACHE_TTL, max_size=NAME_CACHE_SIZE, concurrency=NAME_FETCH_CONCURRENCY):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.concurrency = concurrency
+        self.names = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.fetches = 0
+        self.errors = 0
+        self._semaphore = None
+
+    @staticmethod
+    def _key(chat_id, user_id):
+        return (str(chat_id), str(user_id))
+
+    def remember(self, chat_id, user_id, name):
+        """ثبت نام یک عضو در کش"""
+        if not name:
+            return
+        key = self._key(chat_id, user_id)
+        self.names[key] = (name, time.monotonic() + self.ttl)
+        self.names.move_to_end(key)
+        while len(self.names) > self.max_size:
+            self.names.popitem(last=False)
+
+    def remember_user(self, chat_id, user):
+        """ثبت نام از شیء User پیام"""
+        if user is not None:
+            self.remember(chat_id, user.user_id, user.first_name)
+
+    def lookup(self, chat_id, user_id):
+        """نام موجود در کش یا None"""
+        key = self._key(chat_id, user_id)
+        entry = self.names.get(key)
+        if entry is not None and entry[1] > time.monotonic():
+            self.names.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+        if entry is not None:
+            del self.names[key]
+        self.misses += 1
+        return None
+
+    async def fetch(self, chat_id, user_id):
+        """دریافت نام از بله با محدودیت همزمانی"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            self.fetches += 1
+            try:
+                member = await bot.get_chat_member(chat_id, int(user_id))
+                name = member.user.first_name
+            except Exception:
+                self.errors += 1
+                return None
+        self.remember(chat_id, user_id, name)
+        return name
+
+    async def resolve_many(self, chat_id, user_ids):
+        """نام چند عضو به صورت {user_id: name}؛ نام‌های ناموجود همزمان دریافت می‌شوند"""
+        names = {}
+        missing = []
+        for user_id in user_ids:
+            user_id = str(user_id)
+            if user_id in names:
+                continue
+            names[user_id] = self.lookup(chat_id, user_id)
+            if names[user_id] is None:
+                missing.append(user_id)
+        if missing:
+            with trace_span("network"):
+                fetched = await asyncio.gather(*(self.fetch(chat_id, user_id) for user_id in missing))
+            for user_id, name in zip(missing, fetched):
+                names[user_id] = name or f"User {user_id}"
+        return names
+
+    async def resolve(self, chat_id, user_id):
+        names = await self.resolve_many(chat_id, [user_id])
+        return names[str(user_id)]
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        """آمار کش برای مانیتورینگ"""
+        return {
+            "size": len(self.names),
+            "hits": self.hits,
+            "misses": self.misses,
+            "fetches": self.fetches,
+            "errors": self.errors,
+            "hit_rate": self.hit_rate(),
+        }
+
+name_resolver = NameResolver()
+
+# ==================== TEMPLATE CACHE ====================
+class TemplateCache:
     """
-    
-    # ایجاد کیبورد منو
+    کش پیام‌ها و کیبوردهای از پیش ساخته شده
+
+    هر قالب یک تابع سازنده دارد که فقط یکبار برای هر ترکیب پارامتر (مثلاً سطح در
+    فروشگاه) اجرا می‌شود. فیلدهای مخصوص هر کاربر به صورت {name} در متن می‌مانند و
+    با fill جایگزین می‌شوند. با بارگذاری دوباره کاتالوگ واحدها کش پاک می‌شود.
+    """
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.builders = {}
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def template(self, name):
+        """دکوریتور ثبت تابع سازنده قالب"""
+        def decorator(builder):
+            self.builders[name] = builder
+            return builder
+        return decorator
+
+    def render(self, name, *params):
+        """خروجی کش شده قالب برای پارامترهای داده شده"""
+        key = (name, params)
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+        self.misses += 1
+        entry = self.entries[key] = self.builders[name](*params)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return entry
+
+    @staticmethod
+    def fill(text, **fields):
+        """جایگزینی فیلدهای مخصوص کاربر در متن قالب"""
+        for field, value in fields.items():
+            text = text.replace("{" + field + "}", str(value))
+        return text
+
+    def clear(self):
+        self.entries.clear()
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        """آمار کش برای مانیتورینگ"""
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate(),
+        }
+
+templates = TemplateCache()
+
+# ==================== PLAYER LOCKS ====================
+# کلید قفل‌هایی که تسک فعلی نگه داشته است (برای گرفتن دوباره قفل در هندلرها)
+held_locks = ContextVar("held_locks", default=frozenset())
+
+class LockManager:
+    """
+    قفل ترتیبی برای هر بازیکن (chat_id, user_id)
+
+    هندلرهایی که بین خواندن و نوشتن داده‌ها await می‌کنند قفل بازیکنان درگیر را
+    نگه می‌دارند. هر قفل صف FIFO از نوبت‌ها (future) است و سر صف دارنده قفل.
+    reserve نوبت تمام بازیکنان یک دستور را بدون await در صف‌ها ثبت می‌کند، پس
+    دستورات به ترتیب رزرو اجرا می‌شوند و بن‌بست رخ نمی‌دهد؛ dispatcher هنگام ورود
+    پیام نوبت را رزرو می‌کند تا مثلاً /attack روی یک بازیکن و /buy بعدی همان بازیکن
+    به ترتیب ورود اجرا شوند. قفل‌هایی که تسک فعلی نگه داشته دوباره گرفته نمی‌شوند و
+    صف‌های خالی بلافاصله حذف می‌شوند.
+    """
+
+    def __init__(self):
+        self.locks = {}  # key -> deque[future نوبت]
+        self.waits = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _key(chat_id, user_id):
+        return (str(chat_id), str(user_id))
+
+    def reserve(self, chat_id, *user_ids):
+        """ثبت نوبت بازیکنان در صف قفل‌ها؛ خروجی به claim داده می‌شود"""
+        held = held_locks.get()
+        loop = asyncio.get_event_loop()
+        tickets = []
+        for key in sorted({self._key(chat_id, user_id) for user_id in user_ids} - held):
+            queue = self.locks.get(key)
+            if queue is None:
+                queue = self.locks[key] = deque()
+            ticket = loop.create_future()
+            if not queue:
+                ticket.set_result(None)
+            queue.append(ticket)
+            tickets.append((key, ticket))
+        return tickets
+
+    def release(self, tickets):
+        """آزاد کردن نوبت‌ها (گرفته شده یا در انتظار) و سپردن قفل به نوبت بعدی"""
+        for key, ticket in tickets:
+            queue = self.locks[key]
+            was_head = queue[0] is ticket
+            queue.remove(ticket)
+            if not ticket.done():
+                ticket.cancel()
+            if not queue:
+                del self.locks[key]
+                self.evictions += 1
+            elif was_head and not queue[0].done():
+                queue[0].set_result(None)
+
+    @asynccontextmanager
+    async def claim(self, tickets):
+        """انتظار برای نوبت‌های رزرو شده و نگه داشتن قفل‌ها تا پایان بلوک"""
+        token = None
+        try:
+            for _, ticket in tickets:
+                if not ticket.done():
+                    self.waits += 1
+                    lock_waits.inc()
+                    await ticket
+            if tickets:
+                token = held_locks.set(held_locks.get() | {key for key, _ in tickets})
+            yield
+        finally:
+            if token is not None:
+                held_locks.reset(token)
+            self.release(tickets)
+
+    def hold(self, chat_id, *user_ids):
+        """گرفتن قفل یک یا چند بازیکن یک گروه (قفل‌های نگه داشته شده تسک فعلی نادیده گرفته می‌شوند)"""
+        return self.claim(self.reserve(chat_id, *user_ids))
+
+    def is_locked(self, chat_id, user_id):
+        queue = self.locks.get(self._key(chat_id, user_id))
+        return queue is not None and queue[0].done()
+
+    def stats(self):
+        """آمار قفل‌ها برای مانیتورینگ"""
+        return {"active": len(self.locks), "waits": self.waits, "evictions": self.evictions}
+
+player_locks = LockManager()
+
+# ==================== OUTBOUND QUEUE ====================
+# اولویت پاسخ‌ها (عدد کمتر زودتر ارسال می‌شود)
+PRIORITY_BATTLE = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+PRIORITY_NAMES = {PRIORITY_BATTLE: "battle", PRIORITY_NORMAL: "normal", PRIORITY_LOW: "low"}
+
+class TokenBucket:
+    """سطل توکن: rate توکن در ثانیه با حداکثر capacity"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """زمان لازم (ثانیه) تا در دسترس بودن یک توکن"""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        """برداشتن یک توکن؛ در صورت نبود توکن زمان انتظار برگردانده می‌شود"""
+        wait = self.delay(now)
+        if wait == 0.0:
+            self.tokens -= 1
+        return wait
+
+    def full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+def split_text(text, limit):
+    """تقسیم متن طولانی در مرز خطوط به بخش‌های حداکثر limit کاراکتری"""
+    if len(text) <= limit:
+        return [text]
+    chunks = []
+    current = ""
+    for line in text.splitlines(keepends=True):
+        while len(line) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(line[:limit])
+            line = line[limit:]
+        if len(current) + len(line) > limit:
+            chunks.append(current)
+            current = ""
+        current += line
+    if current:
+        chunks.append(current)
+    return chunks
+
+class OutboundJob:
+    __slots__ = ("message", "text", "kwargs", "priority", "chat_id", "enqueued_at", "attempts", "future", "sequence",
+                 "trace")
+
+    def __init__(self, message, text, kwargs, priority, future, trace=None):
+        self.message = message
+        self.text = text
+        self.kwargs = kwargs
+        self.priority = priority
+        self.chat_id = message.chat.id
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+        self.future = future
+        self.sequence = 0
+        self.trace = trace
+        if trace is not None:
+            trace.hold()
+
+    def finish(self):
+        """آزاد کردن trace دستور پس از ارسال یا شکست نهایی"""
+        if self.trace is not None:
+            self.trace.release()
+            self.trace = None
+
+class OutboundQueue:
+    """
+    صف ارسال پاسخ‌ها با محدودیت نرخ
+
+    هندلرها پاسخ را در صف قرار می‌دهند و بلافاصله ادامه می‌دهند. پاسخ‌های هر گروه در
+    یک صف FIFO و یکی پس از دیگری ارسال می‌شوند (بخش‌های پاسخ تقسیم شده پشت سر هم و
+    ارسال ناموفق تا تلاش دوباره صف همان گروه را نگه می‌دارد)؛ اولویت (نتایج نبرد پیش
+    از متن راهنما) فقط در انتخاب بین گروه‌ها بر اساس پاسخ سر صف هر گروه اعمال می‌شود.
+    سطل توکن سراسری و سطل توکن هر گروه نرخ ارسال را محدود می‌کنند. پاسخ‌های طولانی‌تر
+    از max_length در مرز خطوط تقسیم می‌شوند و ارسال ناموفق با تاخیر نمایی تصادفی
+    دوباره تلاش می‌شود.
+    """
+
+    def __init__(self, global_rate=OUTBOUND_GLOBAL_RATE, chat_rate=OUTBOUND_CHAT_RATE, chat_burst=OUTBOUND_CHAT_BURST,
+                 max_length=OUTBOUND_MAX_LENGTH, max_retries=OUTBOUND_MAX_RETRIES, retry_base=OUTBOUND_RETRY_BASE,
+                 concurrency=OUTBOUND_CONCURRENCY, enabled=OUTBOUND_ENABLED):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_length = max_length
+        self.max_retries = max_retries
+        self.retry_base = retry_base
+        self.concurrency = concurrency
+        self.enabled = enabled
+        self.buckets = {}
+        self.chats = {}  # chat_id -> deque[OutboundJob] به ترتیب ورود
+        self.queued = 0
+        self.ready = []  # heap: (اولویت سر صف، ترتیب سر صف، chat_id) گروه‌های آماده ارسال
+        self.deferred = []  # heap: (زمان آماده شدن، chat_id) گروه‌های منتظر سطل توکن یا تلاش دوباره
+        self.sending = set()
+        self.sequence = 0
+        self._wakeup = None
+        self._task = None
+        self._semaphore = None
+
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def depth(self):
+        return self.queued
+
+    def set_global_rate(self, rate):
+        """تغییر نرخ سراسری (سهم هر فرآیند شارد از نرخ کل ربات)"""
+        self.global_bucket = TokenBucket(rate, rate)
+
+    def _schedule(self, chat_id):
+        job = self.chats[chat_id][0]
+        heapq.heappush(self.ready, (job.priority, job.sequence, chat_id))
+
+    def _advance(self, chat_id):
+        """حذف پاسخ ارسال شده (یا ناموفق) از سر صف گروه و زمان‌بندی پاسخ بعدی"""
+        lane = self.chats.get(chat_id)
+        if lane is None:  # صف پس از close پاک شده است
+            return
+        lane.popleft()
+        self.queued -= 1
+        if lane:
+            self._schedule(chat_id)
+            self._wakeup.set()
+        else:
+            del self.chats[chat_id]
+
+    def enqueue(self, message, text, priority=PRIORITY_NORMAL, trace=None, **kwargs):
+        """قرار دادن پاسخ در صف؛ خروجی future پیام ارسال شده (آخرین بخش)؛ زمان ارسال به trace اضافه می‌شود"""
+        loop = asyncio.get_running_loop()
+        chunks = split_text(str(text), self.max_length)
+        chat_id = message.chat.id
+        lane = self.chats.get(chat_id)
+        idle = lane is None
+        if idle:
+            lane = self.chats[chat_id] = deque()
+        future = None
+        for index, chunk in enumerate(chunks):
+            # کیبورد و سایر گزینه‌ها فقط همراه بخش آخر ارسال می‌شوند
+            last = index == len(chunks) - 1
+            future = loop.create_future()
+            job = OutboundJob(message, chunk, kwargs if last else {}, priority, future, trace)
+            self.sequence += 1
+            job.sequence = self.sequence
+            lane.append(job)
+        self.queued += len(chunks)
+        if idle:
+            # صف گروه در حال ارسال یا انتظار، پس از پایان پاسخ فعلی ادامه می‌یابد
+            self._schedule(chat_id)
+        if len(chunks) > 1:
+            outbound_split.inc()
+        self._wakeup.set()
+        return future
+
+    def _bucket(self, chat_id):
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            if len(self.buckets) > 10000:
+                # حذف سطل گروه‌هایی که مدتی پیامی نداشته‌اند
+                now = time.monotonic()
+                for idle in [key for key, value in self.buckets.items() if value.full(now) and key not in self.chats]:
+                    del self.buckets[idle]
+            bucket = self.buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def run(self):
+        """حلقه ارسال پس‌زمینه"""
+        while True:
+            now = time.monotonic()
+            while self.deferred and self.deferred[0][0] <= now:
+                _, chat_id = heapq.heappop(self.deferred)
+                self._schedule(chat_id)
+            if not self.ready:
+                timeout = self.deferred[0][0] - now if self.deferred else None
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            wait = self.global_bucket.delay(now)
+            if wait > 0:
+                outbound_throttled.inc(1, "global")
+                await asyncio.sleep(wait)
+                continue
+            _, _, chat_id = heapq.heappop(self.ready)
+            wait = self._bucket(chat_id).take(now)
+            if wait > 0:
+                outbound_throttled.inc(1, "chat")
+                heapq.heappush(self.deferred, (now + wait, chat_id))
+                continue
+            self.global_bucket.take(now)
+            await self._semaphore.acquire()
+            task = asyncio.ensure_future(self._send(self.chats[chat_id][0]))
+            self.sending.add(task)
+            task.add_done_callback(self.sending.discard)
+
+    async def _send(self, job):
+        started = time.perf_counter()
+        try:
+            sent = await job.message.reply(job.text, **job.kwargs)
+        except Exception as e:
+            if job.trace is not None:
+                job.trace.network += time.perf_counter() - started
+            job.attempts += 1
+            if job.attempts > self.max_retries:
+                outbound_failed.inc()
+                print(f"خطا در ارسال پاسخ به گروه {job.chat_id}: {e}")
+                if not job.future.done():
+                    job.future.set_exception(e)
+                job.finish()
+                self._advance(job.chat_id)
+                return
+            outbound_retries.inc()
+            backoff = self.retry_base * (2 ** (job.attempts - 1)) * random.uniform(0.5, 1.5)
+            # job در سر صف گروه می‌ماند تا پاسخ‌های بعدی از آن جلو نزنند
+            heapq.heappush(self.deferred, (time.monotonic() + backoff, job.chat_id))
+            self._wakeup.set()
+        else:
+            if job.trace is not None:
+                job.trace.network += time.perf_counter() - started
+            outbound_latency.observe(time.monotonic() - job.enqueued_at, PRIORITY_NAMES.get(job.priority, job.priority))
+            if not job.future.done():
+                job.future.set_result(sent)
+            job.finish()
+            self._advance(job.chat_id)
+        finally:
+            self._semaphore.release()
+
+    async def drain(self):
+        """انتظار برای ارسال تمام پاسخ‌های در صف"""
+        while self.depth() or self.sending:
+            if self.sending:
+                await asyncio.gather(*list(self.sending), return_exceptions=True)
+            else:
+                await asyncio.sleep(0.01)
+
+    def start(self):
+        """شروع حلقه ارسال (داخل event loop ربات)"""
+        if not self.enabled or self.running():
+            return
+        self._wakeup = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._task = asyncio.ensure_future(self.run())
+
+    def close(self):
+        cancel_task(self._task)
+        self._task = None
+        if self.depth():
+            print(f"⚠️ {self.depth()} پاسخ ارسال نشده باقی ماند")
+        self.chats.clear()
+        self.queued = 0
+        self.ready.clear()
+        self.deferred.clear()
+
+outbox = OutboundQueue()
+
+# ==================== COMMAND ROUTER ====================
+REQUIRED = object()
+
+class ArgumentError(ValueError):
+    """خطای تجزیه آرگومان‌های دستور"""
+
+class Arg:
+    """تعریف یک آرگومان دستور؛ rest باقیمانده پیام را به عنوان یک مقدار می‌گیرد"""
+
+    __slots__ = ("name", "convert", "default", "lower", "rest", "choices")
+
+    def __init__(self, name, convert=str, default=REQUIRED, lower=False, rest=False, choices=None):
+        self.name = name
+        self.convert = convert
+        self.default = default
+        self.lower = lower
+        self.rest = rest
+        self.choices = choices
+
+    def parse(self, token):
+        if self.lower:
+            token = token.lower()
+        if self.choices is not None and token not in self.choices:
+            raise ArgumentError(self.name)
+        try:
+            return self.convert(token)
+        except (ValueError, KeyError):
+            raise ArgumentError(self.name)
+
+class ArgSchema:
+    """تجزیه آرگومان‌ها بر اساس لیست Arg؛ strict آرگومان اضافه را نمی‌پذیرد"""
+
+    def __init__(self, args=(), strict=False):
+        self.args = tuple(args)
+        self.strict = strict
+
+    def parse(self, tokens):
+        values = []
+        for index, arg in enumerate(self.args):
+            if index < len(tokens):
+                values.append(arg.parse(" ".join(tokens[index:]) if arg.rest else tokens[index]))
+            elif arg.default is REQUIRED:
+                raise ArgumentError(arg.name)
+            else:
+                values.append(arg.default)
+        if self.strict and len(tokens) > len(self.args):
+            raise ArgumentError(tokens[len(self.args)])
+        return values
+
+class Route:
+    """هندلر ثبت شده برای یک دستور یا زیردستور"""
+
+    __slots__ = ("label", "handler", "schema", "usage", "lock_reply")
+
+    def __init__(self, label, handler, schema, usage, lock_reply=False):
+        self.label = label
+        self.handler = handler
+        self.schema = schema
+        self.usage = usage
+        self.lock_reply = lock_reply
+
+    def lock_targets(self, message, user_id):
+        """بازیکنانی که قفلشان در طول اجرای هندلر نگه داشته می‌شود"""
+        return reply_lock_targets(message, user_id, self.lock_reply)
+
+def reply_lock_targets(message, user_id, lock_reply):
+    """بازیکن دستور و در صورت lock_reply بازیکن ریپلای شده"""
+    targets = [user_id]
+    reply_to = getattr(message, "reply_to_message", None) if lock_reply else None
+    if reply_to is not None and reply_to.author is not None:
+        targets.append(reply_to.author.user_id)
+    return targets
+
+class CommandRouter:
+    """
+    توزیع دستورات و دکمه‌های منو با جستجوی دیکشنری
+
+    هر دستور با (نام، زیردستور) ثبت می‌شود و آرگومان‌هایش یکبار بر اساس
+    ArgSchema تجزیه و به هندلر داده می‌شوند: handler(message, chat_id, user_id, *args)
+    هندلر با قفل بازیکن (و در صورت lock_reply بازیکن ریپلای شده) اجرا می‌شود؛
+    دکمه‌ای که هندلرش با lock_reply ثبت شده (مثل جاسوسی) هم همین قفل‌ها را می‌گیرد.
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.groups = set()
+        self.buttons = {}
+        self.priorities = {}
+        self.reply_locked = set()  # هندلرهای ثبت شده با lock_reply
+
+    def command(self, name, *args, sub=None, usage=None, strict=False, lock_reply=False, priority=PRIORITY_NORMAL):
+        """دکوریتور ثبت دستور"""
+        def decorator(handler):
+            label = name if sub is None else f"{name} {sub}"
+            self.priorities[label] = self.priorities[handler] = priority
+            self.routes[(name, sub)] = Route(label, handler, ArgSchema(args, strict), usage or label, lock_reply)
+            if lock_reply:
+                self.reply_locked.add(handler)
+            if sub is not None:
+                self.groups.add(name)
+            return handler
+        return decorator
+
+    def button(self, text):
+        """دکوریتور ثبت دکمه منو"""
+        def decorator(handler):
+            self.buttons[text] = handler
+            return handler
+        return decorator
+
+    def priority_for(self, label):
+        """اولویت ارسال پاسخ دستور یا دکمه (بر اساس برچسب متریک)"""
+        if label.startswith("menu:"):
+            label = self.buttons.get(label[len("menu:"):])
+        return self.priorities.get(label, PRIORITY_NORMAL)
+
+    def resolve(self, text):
+        """یافتن مسیر دستور؛ خروجی (Route یا None، توکن‌های آرگومان)"""
+        tokens = text.split()
+        if not tokens:
+            return None, ()
+        name = tokens[0].split("@", 1)[0].lower()
+        if name in self.groups and len(tokens) > 1:
+            route = self.routes.get((name, tokens[1].lower()))
+            if route is not None:
+                return route, tokens[2:]
+        return self.routes.get((name, None)), tokens[1:]
+
+    def lock_targets(self, message, text, user_id):
+        """بازیکنانی که دستور یا دکمه متن روی آن‌ها کار می‌کند"""
+        handler = self.buttons.get(text)
+        if handler is not None:
+            return reply_lock_targets(message, user_id, handler in self.reply_locked)
+        route, _ = self.resolve(text)
+        return [user_id] if route is None else route.lock_targets(message, user_id)
+
+    async def dispatch(self, message, text, chat_id, user_id):
+        """اجرای دستور؛ در صورت نبود دستور False برمی‌گرداند"""
+        route, tokens = self.resolve(text)
+        if route is None:
+            return False
+        try:
+            args = route.schema.parse(tokens)
+        except ArgumentError:
+            await message.reply(f"❌ فرمت صحیح: `{route.usage}`")
+            return True
+        async with player_locks.hold(chat_id, *route.lock_targets(message, user_id)):
+            await route.handler(message, chat_id, user_id, *args)
+        return True
+
+router = CommandRouter()
+
+# ==================== UPDATE DISPATCHER ====================
+class UpdateDispatcher:
+    """
+    توزیع پیام‌ها با صف جداگانه برای هر بازیکن در هر گروه
+
+    ترتیب پیام‌های هر بازیکن در هر گروه حفظ می‌شود (یک worker برای هر (گروه، بازیکن)
+    دارای پیام) و بازیکنان مختلف یک گروه همزمان پردازش می‌شوند. نوبت قفل بازیکنانی
+    که هر دستور روی آن‌ها کار می‌کند (lock_targets، مثلاً هدف حمله) هنگام ورود پیام در
+    player_locks رزرو می‌شود، پس دستوراتی که بازیکن مشترکی دارند (حمله به بازیکن و
+    خرید خود او) به ترتیب ورود در گروه اجرا می‌شوند. یک semaphore سراسری تعداد هندلرهای در حال اجرا و semaphore هر گروه
+    (CHAT_CONCURRENCY) سهم هر گروه را محدود می‌کند تا یک گروه پرپیام بقیه گروه‌ها را
+    گرسنه نگذارد. صف هر گروه محدود است: پیام‌های غیر دستوری (chatter) در صورت پر بودن
+    صف حذف یا با پیام قبلی همان کاربر ادغام (coalesce) می‌شوند و دستورات فقط در صورت
+    نبود chatter رد می‌شوند.
+    """
+
+    def __init__(self, handler, max_concurrency=DISPATCH_CONCURRENCY, queue_size=DISPATCH_QUEUE_SIZE,
+                 chatter_policy=DISPATCH_CHATTER_POLICY, chat_concurrency=DISPATCH_CHAT_CONCURRENCY,
+                 lock_targets=None, locks=None):
+        self.handler = handler
+        self.lock_targets = lock_targets  # message -> بازیکنان درگیر دستور (None: بدون رزرو قفل)
+        self.locks = locks if locks is not None else player_locks
+        self.max_concurrency = max_concurrency
+        self.chat_concurrency = chat_concurrency
+        self.queue_size = queue_size
+        self.chatter_policy = chatter_policy
+        self.queues = {}  # chat_id -> {user_id: deque[[kind, message, enqueued_at, tickets]]}
+        self.depths = {}  # chat_id -> تعداد پیام‌های در صف گروه
+        self.workers = {}  # (chat_id, user_id) -> task
+        self.chat_slots = {}  # chat_id -> Semaphore
+        self.in_flight = 0
+        self._semaphore = None
+
+    @staticmethod
+    def classify(text):
+        """نوع پیام: command برای دستورات و دکمه‌ها، chatter برای بقیه"""
+        return "command" if text.startswith("/") or text in router.buttons else "chatter"
+
+    def depth(self):
+        return sum(self.depths.values())
+
+    def max_depth(self):
+        return max(self.depths.values(), default=0)
+
+    def _coalesce(self, lane, message):
+        """جایگزینی chatter در انتظار همان کاربر با پیام جدید"""
+        for job in lane:
+            if job[0] == "chatter":
+                job[1] = message
+                return True
+        return False
+
+    def _drop_chatter(self, chat_id, lanes):
+        """حذف قدیمی‌ترین chatter گروه برای باز کردن جا"""
+        oldest = None
+        for lane in lanes.values():
+            for job in lane:
+                if job[0] == "chatter":
+                    if oldest is None or job[2] < oldest[1][2]:
+                        oldest = (lane, job)
+                    break
+        if oldest is None:
+            return False
+        oldest[0].remove(oldest[1])
+        self.depths[chat_id] -= 1
+        return True
+
+    def submit(self, message):
+        """قرار دادن پیام در صف بازیکن در گروه؛ در صورت رد شدن False برمی‌گرداند"""
+        chat_id = message.chat.id
+        user_id = message.author.user_id
+        kind = self.classify(message.content or "")
+        lanes = self.queues.get(chat_id)
+        if lanes is None:
+            lanes = self.queues[chat_id] = {}
+            self.depths[chat_id] = 0
+        lane = lanes.get(user_id)
+
+        if kind == "chatter" and self.chatter_policy == "coalesce" and lane and self._coalesce(lane, message):
+            dispatch_coalesced.inc()
+            return True
+        if self.depths[chat_id] >= self.queue_size:
+            if kind == "chatter" or not self._drop_chatter(chat_id, lanes):
+                dispatch_dropped.inc(1, kind)
+                if not lanes:
+                    self._forget(chat_id)
+                return False
+            dispatch_dropped.inc(1, "chatter")
+
+        tickets = ()
+        if kind == "command" and self.lock_targets is not None:
+            tickets = self.locks.reserve(chat_id, *self.lock_targets(message))
+        if lane is None:
+            lane = lanes[user_id] = deque()
+        lane.append([kind, message, time.monotonic(), tickets])
+        self.depths[chat_id] += 1
+        key = (chat_id, user_id)
+        worker = self.workers.get(key)
+        if worker is None or worker.done():
+            self.workers[key] = asyncio.ensure_future(self._drain(chat_id, user_id))
+        return True
+
+    def _forget(self, chat_id):
+        self.queues.pop(chat_id, None)
+        self.depths.pop(chat_id, None)
+        self.chat_slots.pop(chat_id, None)
+
+    async def _drain(self, chat_id, user_id):
+        """worker بازیکن: اجرای پیام‌های او در گروه به ترتیب تا خالی شدن صف"""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        slots = self.chat_slots.get(chat_id)
+        if slots is None:
+            slots = self.chat_slots[chat_id] = asyncio.Semaphore(self.chat_concurrency)
+        lanes = self.queues[chat_id]
+        lane = lanes[user_id]
+        try:
+            while lane:
+                kind, message, enqueued_at, tickets = lane.popleft()
+                self.depths[chat_id] -= 1
+                # نوبت قفل‌ها پیش از جای گروه گرفته می‌شود تا منتظران قفل جای دیگران را اشغال نکنند
+                async with self.locks.claim(tickets), slots, self._semaphore:
+                    dispatch_wait.observe(time.monotonic() - enqueued_at, kind)
+                    self.in_flight += 1
+                    try:
+                        await self.handler(message)
+                    except Exception as e:
+                        print(f"خطا در پردازش پیام گروه {chat_id}: {e}")
+                    finally:
+                        self.in_flight -= 1
+        finally:
+            # حذف صف و worker بازیکنان و گروه‌های بیکار
+            if not lane:
+                lanes.pop(user_id, None)
+            self.workers.pop((chat_id, user_id), None)
+            if not lanes and self.queues.get(chat_id) is lanes:
+                self._forget(chat_id)
+
+    async def drain(self):
+        """انتظار برای پردازش تمام پیام‌های در صف"""
+        while self.workers:
+            await asyncio.gather(*list(self.workers.values()), return_exceptions=True)
+
+    def close(self):
+        for worker in list(self.workers.values()):
+            cancel_task(worker)
+        for lanes in self.queues.values():
+            for lane in lanes.values():
+                for job in lane:
+                    self.locks.release(job[3])
+        self.workers.clear()
+        self.queues.clear()
+        self.depths.clear()
+        self.chat_slots.clear()
+
+    def stats(self):
+        """آمار صف‌ها برای مانیتورینگ"""
+        return {"chats": len(self.queues), "depth": self.depth(), "max_depth": self.max_depth(), "in_flight": self.in_flight}
+
+# ==================== BOT COMMANDS ====================
+@bot.event
+async def on_ready():
+    """راه‌اندازی ربات"""
+    print(f"🤖 {bot.user.username} آماده است!")
+    if shards.enabled:
+        # داده‌ها و ذخیره‌سازی در فرآیندهای شارد هستند؛ فراخوانی‌های API آن‌ها اینجا اجرا می‌شوند
+        shards.serve()
+        await monitoring.start()
+        monitoring.ready = True
+        return
+    io_executor.start()
+    # داده‌ها در main بارگذاری شده‌اند؛ بارگذاری مجدد تغییرات ذخیره نشده را از بین می‌برد
+    if not persistence.pending():
+        await load_data_async()
+    persistence.start()
+    log_sink.start()
+    battle_ledger.start()
+    outbox.start()
+    if ECONOMY_TICK:
+        economy.start()
+    await monitoring.start()
+    monitoring.ready = True
+    log_message("system", "bot", "startup", "Bot started successfully")
+
+@bot.event
+async def on_message(message: Message):
+    """دریافت پیام‌ها و قرار دادن در صف گروه"""
+    try:
+        if message.author.is_bot:
+            return
+        
+        messages_total.inc()
+        
+        if shards.enabled:
+            await shards.route(message)
+            return
+        
+        # در صورت عقب ماندن نوشتن روی دیسک، پذیرش پیام جدید منتظر می‌ماند
+        await wait_for_io_capacity()
+        
+        dispatcher.submit(message)
+        
+    except Exception as e:
+        print(f"خطا در on_message: {e}")
+        traceback.print_exc()
+
+async def process_message(message):
+    """پردازش یک پیام (توسط worker گروه)"""
+    try:
+        chat_id = message.chat.id
+        user_id = message.author.user_id
+        text = message.content or ""
+        
+        # ثبت لاگ (هدف ریپلای در خط جداگانه تا replay بتواند /attack و /spy را بازسازی کند)
+        log_message(chat_id, user_id, "message", text)
+        reply_to = getattr(message, "reply_to_message", None)
+        if reply_to is not None and reply_to.author is not None:
+            log_message(chat_id, user_id, "reply_to", reply_to.author.user_id)
+        
+        # ثبت نام نویسنده و فرد ریپلای شده در کش نام‌ها
+        name_resolver.remember_user(chat_id, message.author)
+        if reply_to is not None:
+            name_resolver.remember_user(chat_id, reply_to.author)
+        
+        # پردازش دستورات
+        if text.startswith("/"):
+            await handle_command(message, text, chat_id, user_id)
+        elif text in router.buttons:
+            await handle_menu_button(message, text, chat_id, user_id)
+            
+    except Exception as e:
+        print(f"خطا در process_message: {e}")
+        traceback.print_exc()
+
+def message_lock_targets(message):
+    """بازیکنانی که دستور یا دکمه پیام روی آن‌ها کار می‌کند (برای رزرو نوبت قفل)"""
+    return router.lock_targets(message, message.content or "", message.author.user_id)
+
+dispatcher = UpdateDispatcher(process_message, lock_targets=message_lock_targets)
+
+@instrumented(command_label)
+async def handle_command(message, text, chat_id, user_id):
+    """پردازش دستورات"""
+    try:
+        if not await router.dispatch(message, text, chat_id, user_id):
+            await message.reply("❌ دستور نامعتبر! از /help برای راهنمایی استفاده کنید.")
+            
+    except Exception as e:
+        print(f"خطا در handle_command: {e}")
+        traceback.print_exc()
+        await message.reply("⚠️ خطایی رخ داد!")
+
+# ==================== COMMAND IMPLEMENTATIONS ====================
+@templates.template("main_menu")
+def main_menu_keyboard():
+    """کیبورد منوی اصلی"""
     keyboard = MenuKeyboardMarkup()
     keyboard.add(MenuKeyboardButton("💰 وضعیت"))
     keyboard.add(MenuKeyboardButton("⚔️ نیروی نظامی"))
@@ -856,13 +4118,110 @@ async def help_command(message):
     keyboard.add(MenuKeyboardButton("🕵️ جاسوسی"))
     keyboard.add(MenuKeyboardButton("🔬 تحقیقات"))
     keyboard.add(MenuKeyboardButton("🤝 دیپلماسی"))
-    
-    await message.reply(help_text, components=keyboard)
+    return keyboard
+
+@templates.template("start")
+def start_template():
+    """متن خوش‌آمدگویی"""
+    return """
+🎮 **ربات شبیه‌سازی جنگ پیشرفته** 🎮
+
+خوش آمدید به دنیای جنگ و استراتژی!
+
+**قابلیت‌های اصلی:**
+🏰 **پایتخت**: سیستم اپگرید پیشرفته
+⚔️ **120+ واحد نظامی**: از سرباز تا سلاح‌های هسته‌ای
+💰 **منابع متنوع**: پول، نفت، اورانیوم، فناوری و...
+🌍 **فتح کشورها**: حمله و فتح کشورهای دیگر
+🤝 **اتحاد و دیپلماسی**: تشکیل اتحاد و مذاکره
+🔬 **تحقیقات**: توسعه فناوری‌های جدید
+🕵️ **جاسوسی**: جمع‌آوری اطلاعات دشمن
+
+**دستورات اصلی:**
+/status - وضعیت کشور شما
+/military - نیروی نظامی
+/shop - فروشگاه
+/capital - پایتخت
+/attack - حمله
+/alliance - اتحادها
+/leaderboard - رتبه‌بندی
+
+برای شروع از دکمه‌های زیر استفاده کنید!
+    """
+
+@router.command("/start", priority=PRIORITY_LOW)
+async def start_command(message, chat_id, user_id):
+    """دستور شروع"""
+    await message.reply(templates.render("start"), components=templates.render("main_menu"))
+
+@templates.template("help")
+def help_template():
+    """متن راهنما"""
+    return """
+📖 **راهنمای کامل ربات جنگ** 📖
+
+**دستورات اصلی:**
+/status - وضعیت کامل کشور
+/military - نمایش نیروی نظامی
+/shop - فروشگاه واحدها
+/capital - مدیریت پایتخت
+/attack - حمله به کشور دیگر
+/attack preview - پیش‌بینی احتمال پیروزی و غنیمت
+/battles - تاریخچه و آمار نبردهای شما
+/battles chat - آخرین نبردهای گروه
+/alliance - مدیریت اتحادها
+/leaderboard [power|level|wins] - جدول رتبه‌بندی
+/spy - عملیات جاسوسی
+/research - تحقیقات
+/diplomacy - دیپلماسی
+/collect - جمع‌آوری منابع
+/collectors - کالکتورها
+/buy_collector [نوع] [تعداد] - خرید کالکتور
+/government - سیستم مدیریت
+/change_government [نوع] - تغییر سیستم مدیریت
+/clean - پاکسازی پیام‌ها
+
+**دستورات اتحاد:**
+/alliance create [نام] - ایجاد اتحاد
+/alliance join [نام] - پیوستن به اتحاد
+/alliance leave - ترک اتحاد
+/alliance list - لیست اتحادها
+/alliance info [نام] - اطلاعات اتحاد
+/alliance invite [ریپلای] - دعوت عضو
+/alliance kick [ریپلای] - اخراج عضو
+
+**منابع:**
+💰 پول - برای خرید واحدها
+🛢️ نفت - برای سوخت
+☢️ اورانیوم - برای سلاح‌های هسته‌ای
+⭐ اعتبار اجتماعی - برای دیپلماسی
+🔬 فناوری - برای تحقیقات
+👥 جمعیت - برای نیروی کار
+⚙️ فولاد - برای ساخت تجهیزات
+🔧 آلومینیوم - برای هواپیماها
+💎 تیتانیوم - برای فضاپیماها
+💠 فلزات نادر - برای فناوری پیشرفته
+
+**نکات مهم:**
+• هر 5 دقیقه منابع تولید می‌شود
+• از /collect برای جمع‌آوری استفاده کنید
+• سطح کشور بر اساس قدرت و منابع محاسبه می‌شود
+• نمی‌توان به کشورهای خیلی قوی‌تر حمله کرد
+• اتحادها از حمله متقابل جلوگیری می‌کنند
+• 120+ واحد نظامی مختلف در دسترس است
+    """
 
+@router.command("/help", priority=PRIORITY_LOW)
+async def help_command(message, chat_id, user_id):
+    """دستور راهنما"""
+    await message.reply(templates.render("help"), components=templates.render("main_menu"))
+
+@router.command("/status")
+@router.button("💰 وضعیت")
 async def status_command(message, chat_id, user_id):
     """دستور وضعیت"""
     try:
-        user_data = get_user_data(chat_id, user_id)
+        user_data = settle_user(chat_id, user_id)
         country_data = get_country_data(chat_id, user_id)
         
         # محاسبه آمار
@@ -872,7 +4231,7 @@ async def status_command(message, chat_id, user_id):
         # به‌روزرسانی سطح
         if country_level > user_data["level"]:
             user_data["level"] = country_level
-            save_data()
+            mark_user_dirty(chat_id, user_id)
         
         status_text = f"""
 🏰 **وضعیت کشور {country_data['name']}** 🏰
@@ -892,7 +4251,7 @@ async def status_command(message, chat_id, user_id):
             name = RESOURCES[resource]["name"]
             status_text += f"{emoji} {name}: {amount:,}\n"
         
-        status_text += f"""
+        status_text += """
 **🏛️ پایتخت:**
 """
         
@@ -910,6 +4269,8 @@ async def status_command(message, chat_id, user_id):
         print(f"خطا در status_command: {e}")
         await message.reply("⚠️ خطا در نمایش وضعیت!")
 
+@router.command("/military")
+@router.button("⚔️ نیروی نظامی")
 async def military_command(message, chat_id, user_id):
     """دستور نیروی نظامی"""
     try:
@@ -917,35 +4278,8 @@ async def military_command(message, chat_id, user_id):
         
         military_text = "⚔️ **نیروی نظامی شما** ⚔️\n\n"
         
-        # دسته‌بندی واحدها
-        categories = {}
-        for unit_type, count in user_data["military"].items():
-            if count > 0 and unit_type in MILITARY_UNITS:
-                unit = MILITARY_UNITS[unit_type]
-                category = unit["category"]
-                if category not in categories:
-                    categories[category] = []
-                categories[category].append((unit_type, count, unit))
-        
-        # نمایش هر دسته
-        category_names = {
-            "infantry": "پیاده نظام",
-            "light_vehicle": "خودروهای سبک",
-            "tank": "تانک‌ها",
-            "artillery": "توپخانه",
-            "anti_air": "ضدهوایی",
-            "fighter": "جنگنده‌ها",
-            "bomber": "بمب‌افکن‌ها",
-            "helicopter": "هلیکوپترها",
-            "drone": "پهپادها",
-            "naval": "نیروی دریایی",
-            "missile": "موشک‌ها",
-            "special": "سلاح‌های ویژه",
-            "defense": "سیستم‌های دفاعی"
-        }
-        
-        for category, units in categories.items():
-            category_name = category_names.get(category, category)
+        for category, units in UNIT_CATALOG.group_by_category(user_data["military"]):
+            category_name = UNIT_CATEGORIES.get(category, category)
             military_text += f"**{category_name}:**\n"
             for unit_type, count, unit in units:
                 power = unit["power"] * count
@@ -961,43 +4295,49 @@ async def military_command(message, chat_id, user_id):
         print(f"خطا در military_command: {e}")
         await message.reply("⚠️ خطا در نمایش نیروی نظامی!")
 
+@templates.template("shop")
+def shop_template(unlocked):
+    """لیست فروشگاه برای unlocked واحد باز شده (سطح و پول کاربر به صورت فیلد)"""
+    available_ids = UNIT_CATALOG.by_level[:unlocked]
+    locked_ids = UNIT_CATALOG.by_level[unlocked:]
+    
+    shop_text = "🛒 **فروشگاه واحدهای نظامی** 🛒\n\n"
+    shop_text += "سطح شما: {level}\n"
+    shop_text += "💰 پول: {money}\n\n"
+    
+    # نمایش واحدهای در دسترس
+    shop_text += "**✅ واحدهای در دسترس:**\n"
+    for unit_id in available_ids[:20]:  # نمایش 20 واحد اول
+        unit = MILITARY_UNITS[UNIT_CATALOG.keys[unit_id]]
+        shop_text += f"• {unit['emoji']} {unit['name']} - {unit['cost']:,} 💰 (سطح {unit['level_req']})\n"
+    
+    if len(available_ids) > 20:
+        shop_text += f"... و {len(available_ids) - 20} واحد دیگر\n"
+    
+    # نمایش واحدهای قفل شده
+    if locked_ids:
+        shop_text += "\n**🔒 واحدهای قفل شده:**\n"
+        for unit_id in locked_ids[:10]:
+            unit = MILITARY_UNITS[UNIT_CATALOG.keys[unit_id]]
+            shop_text += f"• {unit['emoji']} {unit['name']} - سطح {unit['level_req']} مورد نیاز\n"
+    
+    shop_text += "\n**برای خرید از دستور زیر استفاده کنید:**\n"
+    shop_text += "`/buy [نوع_واحد] [تعداد]`\n"
+    shop_text += "مثال: `/buy soldier 10`"
+    return shop_text
+
+@router.command("/shop", priority=PRIORITY_LOW)
+@router.button("🛒 فروشگاه")
 async def shop_command(message, chat_id, user_id):
     """دستور فروشگاه"""
     try:
         user_data = get_user_data(chat_id, user_id)
         user_level = user_data["level"]
         
-        shop_text = "🛒 **فروشگاه واحدهای نظامی** 🛒\n\n"
-        shop_text += f"سطح شما: {user_level}\n"
-        shop_text += f"💰 پول: {user_data['resources']['money']:,}\n\n"
-        
-        # دسته‌بندی واحدها بر اساس دسترسی
-        available_units = []
-        locked_units = []
-        
-        for unit_type, unit in MILITARY_UNITS.items():
-            if user_level >= unit["level_req"]:
-                available_units.append((unit_type, unit))
-            else:
-                locked_units.append((unit_type, unit))
-        
-        # نمایش واحدهای در دسترس
-        shop_text += "**✅ واحدهای در دسترس:**\n"
-        for unit_type, unit in available_units[:20]:  # نمایش 20 واحد اول
-            shop_text += f"• {unit['emoji']} {unit['name']} - {unit['cost']:,} 💰 (سطح {unit['level_req']})\n"
-        
-        if len(available_units) > 20:
-            shop_text += f"... و {len(available_units) - 20} واحد دیگر\n"
-        
-        # نمایش واحدهای قفل شده
-        if locked_units:
-            shop_text += f"\n**🔒 واحدهای قفل شده:**\n"
-            for unit_type, unit in locked_units[:10]:
-                shop_text += f"• {unit['emoji']} {unit['name']} - سطح {unit['level_req']} مورد نیاز\n"
-        
-        shop_text += "\n**برای خرید از دستور زیر استفاده کنید:**\n"
-        shop_text += "`/buy [نوع_واحد] [تعداد]`\n"
-        shop_text += "مثال: `/buy soldier 10`"
+        # کاربران با تعداد واحد باز شده یکسان لیست مشترک دارند
+        unlocked = len(UNIT_CATALOG.available(user_level))
+        shop_text = templates.fill(templates.render("shop", unlocked),
+                                   level=user_level, money=f"{user_data['resources']['money']:,}")
         
         await message.reply(shop_text)
         
@@ -1005,22 +4345,16 @@ async def shop_command(message, chat_id, user_id):
         print(f"خطا در shop_command: {e}")
         await message.reply("⚠️ خطا در نمایش فروشگاه!")
 
-async def buy_command(message, chat_id, user_id):
+@router.command("/buy", Arg("unit_type", lower=True), Arg("quantity", int, default=1),
+                usage="/buy [نوع_واحد] [تعداد]")
+async def buy_command(message, chat_id, user_id, unit_type, quantity=1):
     """دستور خرید"""
     try:
-        parts = message.content.split()
-        if len(parts) < 2:
-            await message.reply("❌ فرمت صحیح: `/buy [نوع_واحد] [تعداد]`")
-            return
-        
-        unit_type = parts[1].lower()
-        quantity = int(parts[2]) if len(parts) > 2 else 1
-        
         if quantity <= 0:
             await message.reply("❌ تعداد باید بیشتر از صفر باشد!")
             return
         
-        user_data = get_user_data(chat_id, user_id)
+        user_data = settle_user(chat_id, user_id)
         
         # بررسی امکان خرید
         can_buy, reason = can_afford_unit(user_data, unit_type, quantity)
@@ -1034,9 +4368,10 @@ async def buy_command(message, chat_id, user_id):
         
         user_data["resources"]["money"] -= total_cost
         user_data["military"][unit_type] = user_data["military"].get(unit_type, 0) + quantity
+        invalidate_power(user_data)
         user_data["experience"] += total_cost // 10
         
-        save_data()
+        mark_user_dirty(chat_id, user_id)
         
         success_text = f"""
 ✅ **خرید موفق!**
@@ -1056,44 +4391,55 @@ async def buy_command(message, chat_id, user_id):
         print(f"خطا در buy_command: {e}")
         await message.reply("⚠️ خطا در خرید!")
 
+def attack_sides(message, chat_id, user_id):
+    """بررسی‌های مشترک حمله و پیش‌بینی؛ خروجی (پیام خطا، None) یا (None، طرفین نبرد)"""
+    if not message.reply_to_message:
+        return "❌ لطفاً به پیام کاربر مورد نظر ریپلای کنید!", None
+    
+    target_user = message.reply_to_message.author
+    if target_user.user_id == user_id:
+        return "❌ نمی‌توانید به خودتان حمله کنید!", None
+    
+    attacker_data = settle_user(chat_id, user_id)
+    defender_data = settle_user(chat_id, target_user.user_id)
+    attacker_country = get_country_data(chat_id, user_id)
+    defender_country = get_country_data(chat_id, target_user.user_id)
+    
+    # بررسی امکان حمله
+    can_attack_result, reason = can_attack(attacker_data, defender_data, attacker_country, defender_country)
+    if not can_attack_result:
+        return f"❌ {reason}", None
+    
+    # محاسبه قدرت
+    attacker_power = calculate_total_power(attacker_data)
+    defender_power = calculate_total_power(defender_data)
+    
+    if attacker_power < 100:
+        return "❌ برای حمله حداقل 100 قدرت نظامی نیاز دارید!", None
+    
+    return None, (target_user, attacker_data, defender_data, defender_country, attacker_power, defender_power)
+
+@router.command("/attack", lock_reply=True, priority=PRIORITY_BATTLE)
 async def attack_command(message, chat_id, user_id):
     """دستور حمله"""
     try:
-        if not message.reply_to_message:
-            await message.reply("❌ لطفاً به پیام کاربر مورد نظر ریپلای کنید!")
-            return
-        
-        target_user = message.reply_to_message.author
-        if target_user.user_id == user_id:
-            await message.reply("❌ نمی‌توانید به خودتان حمله کنید!")
-            return
-        
-        attacker_data = get_user_data(chat_id, user_id)
-        defender_data = get_user_data(chat_id, target_user.user_id)
-        attacker_country = get_country_data(chat_id, user_id)
-        defender_country = get_country_data(chat_id, target_user.user_id)
-        
-        # بررسی امکان حمله
-        can_attack_result, reason = can_attack(attacker_data, defender_data, attacker_country, defender_country)
-        if not can_attack_result:
-            await message.reply(f"❌ {reason}")
+        error, sides = attack_sides(message, chat_id, user_id)
+        if error:
+            await message.reply(error)
             return
+        target_user, attacker_data, defender_data, defender_country, attacker_power, defender_power = sides
         
-        # محاسبه قدرت
-        attacker_power = calculate_total_power(attacker_data)
-        defender_power = calculate_total_power(defender_data)
-        
-        if attacker_power < 100:
-            await message.reply("❌ برای حمله حداقل 100 قدرت نظامی نیاز دارید!")
-            return
-        
-        # محاسبه نتیجه نبرد
-        attack_strength = attacker_power * random.uniform(0.8, 1.2)
-        defense_strength = defender_power * random.uniform(0.8, 1.2)
+        # نبرد چند مرحله‌ای بین دسته‌های واحدها و اعمال تلفات هر نوع واحد
+        attacker_forces = combat_engine.forces(attacker_data)
+        defender_forces = combat_engine.forces(defender_data, defending=True)
+        attack_strength, defense_strength, attacker_left, defender_left = combat_engine.resolve(attacker_forces, defender_forces)
+        attacker_lost = apply_casualties(attacker_data, combat_engine.casualties(attacker_data["military"], attacker_forces, attacker_left))
+        defender_lost = apply_casualties(defender_data, combat_engine.casualties(defender_data["military"], defender_forces, defender_left))
+        casualty_text = f"💀 تلفات: {attacker_lost:,} واحد مهاجم، {defender_lost:,} واحد مدافع"
         
         if attack_strength > defense_strength:
             # حمله کننده برنده شد
-            damage_ratio = min(0.3, (attack_strength - defense_strength) / attack_strength * 0.5)
+            damage_ratio, conquest_chance = victory_ratios(attack_strength, defense_strength)
             stolen_money = int(defender_data["resources"]["money"] * damage_ratio)
             stolen_oil = int(defender_data["resources"]["oil"] * damage_ratio)
             
@@ -1110,8 +4456,8 @@ async def attack_command(message, chat_id, user_id):
             defender_data["experience"] += 50
             
             # بررسی فتح کشور
-            conquest_chance = min(0.1, (attack_strength - defense_strength) / attack_strength * 0.2)
-            if random.random() < conquest_chance:
+            conquered = random.random() < conquest_chance
+            if conquered:
                 defender_country["conquered_by"] = user_id
                 defender_country["conquest_time"] = datetime.now().isoformat()
                 attacker_data["territory_conquered"] += defender_country["territory"]
@@ -1119,6 +4465,9 @@ async def attack_command(message, chat_id, user_id):
             else:
                 conquest_text = ""
             
+            battle_ledger.record(chat_id, user_id, target_user.user_id, attack_strength, defense_strength,
+                                 stolen_money, stolen_oil, attacker_lost, defender_lost, won=True, conquest=conquered)
+            
             result_text = f"""
 ⚔️ **حمله موفق!** ⚔️
 
@@ -1127,11 +4476,12 @@ async def attack_command(message, chat_id, user_id):
 💰 غنیمت: {stolen_money:,} پول + {stolen_oil:,} نفت
 💪 قدرت حمله: {int(attack_strength):,}
 🛡️ قدرت دفاع: {int(defense_strength):,}
+{casualty_text}
 {conquest_text}
             """
         else:
             # مدافع برنده شد
-            damage_ratio = min(0.2, (defense_strength - attack_strength) / defense_strength * 0.3)
+            damage_ratio = defeat_ratio(attack_strength, defense_strength)
             lost_money = int(attacker_data["resources"]["money"] * damage_ratio)
             
             # جریمه حمله کننده
@@ -1143,6 +4493,9 @@ async def attack_command(message, chat_id, user_id):
             attacker_data["experience"] += 25
             defender_data["experience"] += 75
             
+            battle_ledger.record(chat_id, user_id, target_user.user_id, attack_strength, defense_strength,
+                                 lost_money, 0, attacker_lost, defender_lost)
+            
             result_text = f"""
 🛡️ **دفاع موفق!** 🛡️
 
@@ -1151,15 +4504,129 @@ async def attack_command(message, chat_id, user_id):
 💸 جریمه: {lost_money:,} پول
 💪 قدرت حمله: {int(attack_strength):,}
 🛡️ قدرت دفاع: {int(defense_strength):,}
+{casualty_text}
             """
         
-        save_data()
+        mark_user_dirty(chat_id, user_id)
+        mark_user_dirty(chat_id, target_user.user_id)
+        mark_country_dirty(chat_id, target_user.user_id)
         await message.reply(result_text)
         
     except Exception as e:
         print(f"خطا در attack_command: {e}")
         await message.reply("⚠️ خطا در انجام حمله!")
 
+@router.command("/attack", sub="preview", lock_reply=True)
+async def attack_preview_command(message, chat_id, user_id):
+    """پیش‌بینی نتیجه حمله با شبیه‌سازی بدون انجام آن"""
+    try:
+        error, sides = attack_sides(message, chat_id, user_id)
+        if error:
+            await message.reply(error)
+            return
+        target_user, attacker_data, defender_data, _, attacker_power, defender_power = sides
+        
+        # شبیه‌سازی روی نخ جداگانه اجرا می‌شود تا پیام‌های گروه‌های دیگر منتظر نمانند
+        odds = await asyncio.get_running_loop().run_in_executor(
+            None, simulate_battle_odds, combat_engine.forces(attacker_data),
+            combat_engine.forces(defender_data, defending=True), defender_data["resources"]["money"],
+            defender_data["resources"]["oil"], attacker_data["resources"]["money"])
+        
+        preview_text = f"""
+🎲 **پیش‌بینی حمله** 🎲
+
+{message.author.first_name} در برابر {target_user.first_name}
+
+🏆 احتمال پیروزی: {odds['win_probability']:.1%}
+💰 غنیمت مورد انتظار: {int(odds['expected_money']):,} پول + {int(odds['expected_oil']):,} نفت
+🏰 شانس فتح کشور: {odds['conquest_chance']:.2%}
+💸 جریمه مورد انتظار: {int(odds['expected_penalty']):,} پول
+💪 قدرت شما: {attacker_power:,} | 🛡️ قدرت هدف: {defender_power:,}
+
+📊 بر اساس {odds['samples']:,} نبرد شبیه‌سازی شده
+        """
+        await message.reply(preview_text)
+        
+    except Exception as e:
+        print(f"خطا در attack_preview_command: {e}")
+        await message.reply("⚠️ خطا در پیش‌بینی حمله!")
+
+def battle_line(battle, names, viewer=None):
+    """یک خط از تاریخچه نبردها"""
+    when = datetime.fromtimestamp(battle.timestamp).strftime("%m/%d %H:%M")
+    attacker, defender = names[str(battle.attacker)], names[str(battle.defender)]
+    if battle.won:
+        outcome = f"✅ {attacker} پیروز شد — غنیمت {battle.money:,} پول + {battle.oil:,} نفت"
+        if battle.conquest:
+            outcome += " 🏰"
+    else:
+        outcome = f"🛡️ {defender} دفاع کرد — جریمه {battle.money:,} پول"
+    if viewer is None:
+        header = f"{attacker} ⚔️ {defender}"
+    elif battle.attacker == viewer:
+        header = f"⚔️ حمله به {defender}"
+    else:
+        header = f"🛡️ دفاع در برابر {attacker}"
+    return f"{header} ({when})\n   {outcome} | 💀 {battle.attacker_lost:,}/{battle.defender_lost:,}\n"
+
+@router.command("/battles")
+async def battles_command(message, chat_id, user_id):
+    """تاریخچه و آمار نبردهای بازیکن"""
+    try:
+        battles = battle_ledger.player(chat_id, user_id, 10)
+        if not battles:
+            await message.reply("📜 هنوز در نبردی شرکت نکرده‌اید!")
+            return
+        stats = battle_ledger.stats(chat_id, user_id)
+        revenge = battle_ledger.revenge_target(chat_id, user_id)
+        player_ids = {battle.attacker for battle in battles} | {battle.defender for battle in battles}
+        if revenge is not None:
+            player_ids.add(revenge.attacker)
+        names = await name_resolver.resolve_many(chat_id, player_ids)
+        
+        battles_text = "📜 **تاریخچه نبردهای شما** 📜\n\n"
+        battles_text += f"⚔️ حمله: {stats['attacks']} (پیروزی {stats['attack_wins']}) | "
+        battles_text += f"🛡️ دفاع: {stats['defenses']} (پیروزی {stats['defense_wins']})\n"
+        battles_text += f"💰 غنیمت: {stats['loot_money']:,} پول + {stats['loot_oil']:,} نفت\n"
+        battles_text += f"💸 از دست رفته: {stats['lost_money']:,} پول + {stats['lost_oil']:,} نفت\n"
+        battles_text += f"💀 تلفات: {stats['units_lost']:,} واحد\n\n"
+        
+        for i, battle in enumerate(battles, 1):
+            battles_text += f"{i}. {battle_line(battle, names, viewer=user_id)}"
+        
+        if revenge is not None:
+            battles_text += f"\n🎯 هدف انتقام: **{names[str(revenge.attacker)]}** (آخرین حمله موفق به شما)\n"
+        battles_text += f"\n📊 بر اساس آخرین {BATTLE_HISTORY_PER_CHAT:,} نبرد گروه"
+        
+        await message.reply(battles_text)
+        
+    except Exception as e:
+        print(f"خطا در battles_command: {e}")
+        await message.reply("⚠️ خطا در نمایش تاریخچه نبردها!")
+
+@router.command("/battles", sub="chat")
+async def chat_battles_command(message, chat_id, user_id):
+    """آخرین نبردهای گروه"""
+    try:
+        battles = battle_ledger.recent(chat_id, 10)
+        if not battles:
+            await message.reply("📜 هنوز نبردی در این گروه ثبت نشده است!")
+            return
+        player_ids = {battle.attacker for battle in battles} | {battle.defender for battle in battles}
+        names = await name_resolver.resolve_many(chat_id, player_ids)
+        
+        battles_text = "📜 **آخرین نبردهای گروه** 📜\n\n"
+        for i, battle in enumerate(battles, 1):
+            battles_text += f"{i}. {battle_line(battle, names)}"
+        
+        await message.reply(battles_text)
+        
+    except Exception as e:
+        print(f"خطا در chat_battles_command: {e}")
+        await message.reply("⚠️ خطا در نمایش نبردهای گروه!")
+
+@router.command("/capital")
+@router.button("🏰 پایتخت")
 async def capital_command(message, chat_id, user_id):
     """دستور پایتخت"""
     try:
@@ -1185,20 +4652,16 @@ async def capital_command(message, chat_id, user_id):
         print(f"خطا در capital_command: {e}")
         await message.reply("⚠️ خطا در نمایش پایتخت!")
 
-async def upgrade_command(message, chat_id, user_id):
+@router.command("/upgrade", Arg("upgrade_name", lower=True), usage="/upgrade [نام_اپگرید]")
+async def upgrade_command(message, chat_id, user_id, upgrade_name):
     """دستور اپگرید"""
     try:
-        parts = message.content.split()
-        if len(parts) < 2:
-            await message.reply("❌ فرمت صحیح: `/upgrade [نام_اپگرید]`")
-            return
-        
-        upgrade_name = parts[1].lower()
         if upgrade_name not in CAPITAL_UPGRADES:
             await message.reply("❌ اپگرید نامعتبر!")
             return
         
-        user_data = get_user_data(chat_id, user_id)
+        # درآمد انباشته با نرخ پیش از اپگرید تسویه می‌شود
+        user_data = settle_user(chat_id, user_id)
         current_level = user_data["capital"][upgrade_name]
         upgrade_info = CAPITAL_UPGRADES[upgrade_name]
         
@@ -1218,9 +4681,12 @@ async def upgrade_command(message, chat_id, user_id):
         # انجام اپگرید
         user_data["resources"]["money"] -= cost
         user_data["capital"][upgrade_name] += 1
+        if upgrade_name == "military_academy":
+            invalidate_power(user_data)
+        invalidate_production(user_data)
         user_data["experience"] += cost // 100
         
-        save_data()
+        mark_user_dirty(chat_id, user_id)
         
         success_text = f"""
 ✅ **اپگرید موفق!**
@@ -1238,6 +4704,8 @@ async def upgrade_command(message, chat_id, user_id):
         print(f"خطا در upgrade_command: {e}")
         await message.reply("⚠️ خطا در اپگرید!")
 
+@router.command("/alliance", strict=True, usage="/alliance [create|join|leave|info|list|invite|kick]")
+@router.button("🤝 اتحاد")
 async def alliance_command(message, chat_id, user_id):
     """دستور اتحاد"""
     try:
@@ -1246,7 +4714,7 @@ async def alliance_command(message, chat_id, user_id):
         if user_data["alliance"]:
             # نمایش اطلاعات اتحاد فعلی
             alliance_name = user_data["alliance"]
-            alliance_data = game_data["alliances"].get(alliance_name, {})
+            alliance_data = get_alliance(alliance_name) or {}
             
             alliance_text = f"""
 🤝 **اتحاد شما: {alliance_name}** 🤝
@@ -1260,16 +4728,13 @@ async def alliance_command(message, chat_id, user_id):
 **اعضا:**
 """
             
+            member_names = await name_resolver.resolve_many(chat_id, alliance_data.get('members', []))
             for member_id in alliance_data.get('members', []):
-                try:
-                    member = await bot.get_chat_member(chat_id, int(member_id))
-                    member_name = member.user.first_name
-                    if member_id == alliance_data.get('leader'):
-                        alliance_text += f"👑 {member_name} (رهبر)\n"
-                    else:
-                        alliance_text += f"• {member_name}\n"
-                except:
-                    alliance_text += f"• User {member_id}\n"
+                member_name = member_names[str(member_id)]
+                if member_id == alliance_data.get('leader'):
+                    alliance_text += f"👑 {member_name} (رهبر)\n"
+                else:
+                    alliance_text += f"• {member_name}\n"
             
             alliance_text += "\n**دستورات:**\n"
             alliance_text += "/alliance leave - ترک اتحاد\n"
@@ -1284,7 +4749,7 @@ async def alliance_command(message, chat_id, user_id):
 **اتحادهای موجود:**
 """
             
-            for alliance_name, alliance_data in game_data["alliances"].items():
+            for alliance_name, alliance_data in list_alliances():
                 member_count = len(alliance_data.get('members', []))
                 total_power = alliance_data.get('total_power', 0)
                 alliance_text += f"• **{alliance_name}** ({member_count} عضو, قدرت: {total_power:,})\n"
@@ -1308,36 +4773,27 @@ async def alliance_command(message, chat_id, user_id):
         print(f"خطا در alliance_command: {e}")
         await message.reply("⚠️ خطا در نمایش اتحادها!")
 
-async def leaderboard_command(message, chat_id):
+@router.command("/leaderboard", Arg("metric", LEADERBOARD_ALIASES.__getitem__, default="power", lower=True),
+                usage="/leaderboard [power|level|wins]")
+@router.button("🏆 رتبه‌بندی")
+async def leaderboard_command(message, chat_id, user_id, metric="power"):
     """دستور رتبه‌بندی"""
     try:
-        # جمع‌آوری آمار کاربران
-        leaderboard = []
-        for user_key, user_data in game_data["users"].items():
-            if user_key.startswith(f"{chat_id}:"):
-                user_id = user_key.split(":")[1]
-                power = calculate_total_power(user_data)
-                leaderboard.append({
-                    "user_id": user_id,
-                    "power": power,
-                    "level": user_data["level"],
-                    "battles_won": user_data["battles_won"]
-                })
-        
-        # مرتب‌سازی بر اساس قدرت
-        leaderboard.sort(key=lambda x: x["power"], reverse=True)
-        
-        leaderboard_text = "🏆 **جدول رتبه‌بندی** 🏆\n\n"
-        
-        for i, player in enumerate(leaderboard[:10], 1):
-            try:
-                user = await bot.get_chat_member(chat_id, int(player["user_id"]))
-                username = user.user.first_name
-            except:
-                username = f"User {player['user_id']}"
+        board = leaderboard_index.chat(chat_id)
+        
+        leaderboard_text = f"🏆 **جدول رتبه‌بندی ({LEADERBOARD_TITLES[metric]})** 🏆\n\n"
+        
+        top_players = board.top(metric, 10)
+        usernames = await name_resolver.resolve_many(chat_id, [player_id for player_id, _ in top_players])
+        for i, (player_id, (power, level, battles_won)) in enumerate(top_players, 1):
+            username = usernames[player_id]
             
             leaderboard_text += f"{i}. **{username}**\n"
-            leaderboard_text += f"   💪 قدرت: {player['power']:,} | 🎖️ سطح: {player['level']} | 🏆 برد: {player['battles_won']}\n\n"
+            leaderboard_text += f"   💪 قدرت: {power:,} | 🎖️ سطح: {level} | 🏆 برد: {battles_won}\n\n"
+        
+        rank = board.rank(str(user_id), metric)
+        if rank is not None:
+            leaderboard_text += f"📍 رتبه شما: {rank} از {len(board)}"
         
         await message.reply(leaderboard_text)
         
@@ -1345,12 +4801,24 @@ async def leaderboard_command(message, chat_id):
         print(f"خطا در leaderboard_command: {e}")
         await message.reply("⚠️ خطا در نمایش رتبه‌بندی!")
 
+async def delete_later(sent, delay):
+    """حذف پیام ارسال شده پس از delay ثانیه (sent می‌تواند future صف ارسال باشد)"""
+    try:
+        if asyncio.isfuture(sent):
+            sent = await sent
+        await asyncio.sleep(delay)
+        await sent.delete()
+    except Exception:
+        pass
+
+@router.command("/clean")
 async def clean_command(message, chat_id, user_id):
     """دستور پاکسازی"""
     try:
         # بررسی دسترسی ادمین
         try:
-            member = await bot.get_chat_member(chat_id, user_id)
+            with trace_span("network"):
+                member = await bot.get_chat_member(chat_id, user_id)
             if member.status not in ["administrator", "creator"]:
                 await message.reply("❌ فقط ادمین‌ها می‌توانند از این دستور استفاده کنند!")
                 return
@@ -1378,17 +4846,15 @@ async def clean_command(message, chat_id, user_id):
         # ارسال پیام تأیید (که خودش هم حذف خواهد شد)
         confirm_msg = await message.reply(f"✅ {deleted_count} پیام حذف شد!")
         
-        # حذف پیام تأیید پس از 3 ثانیه
-        await asyncio.sleep(3)
-        try:
-            await confirm_msg.delete()
-        except:
-            pass
+        # حذف پیام تأیید پس از 3 ثانیه بدون نگه داشتن صف گروه
+        asyncio.ensure_future(delete_later(confirm_msg, 3))
         
     except Exception as e:
         print(f"خطا در clean_command: {e}")
         await message.reply("⚠️ خطا در پاکسازی!")
 
+@router.command("/spy", lock_reply=True, priority=PRIORITY_BATTLE)
+@router.button("🕵️ جاسوسی")
 async def spy_command(message, chat_id, user_id):
     """دستور جاسوسی"""
     try:
@@ -1440,7 +4906,7 @@ async def spy_command(message, chat_id, user_id):
                     spy_text += f"• {unit['emoji']} {unit['name']}: {count}\n"
             
             user_data["intelligence"] += 10
-            save_data()
+            mark_user_dirty(chat_id, user_id)
             
         else:
             # جاسوسی ناموفق
@@ -1452,7 +4918,7 @@ async def spy_command(message, chat_id, user_id):
             """
             
             user_data["intelligence"] += 1
-            save_data()
+            mark_user_dirty(chat_id, user_id)
         
         await message.reply(spy_text)
         
@@ -1460,12 +4926,10 @@ async def spy_command(message, chat_id, user_id):
         print(f"خطا در spy_command: {e}")
         await message.reply("⚠️ خطا در جاسوسی!")
 
-async def research_command(message, chat_id, user_id):
-    """دستور تحقیقات"""
-    try:
-        user_data = get_user_data(chat_id, user_id)
-        
-        research_text = """
+@templates.template("research")
+def research_template():
+    """متن مرکز تحقیقات"""
+    return """
 🔬 **مرکز تحقیقات** 🔬
 
 **تحقیقات در دسترس:**
@@ -1476,21 +4940,25 @@ async def research_command(message, chat_id, user_id):
 • فناوری فضایی - دسترسی به واحدهای فضایی
 
 **برای شروع تحقیق از دستور زیر استفاده کنید:**
-`/research start [نوع_تحقیق]`
-        """
-        
-        await message.reply(research_text)
+`/research start [military|defense|economy|intelligence|space]`
+    """
+
+@router.command("/research", priority=PRIORITY_LOW)
+@router.button("🔬 تحقیقات")
+async def research_command(message, chat_id, user_id):
+    """دستور تحقیقات"""
+    try:
+        get_user_data(chat_id, user_id)
+        await message.reply(templates.render("research"))
         
     except Exception as e:
         print(f"خطا در research_command: {e}")
         await message.reply("⚠️ خطا در نمایش تحقیقات!")
 
-async def diplomacy_command(message, chat_id, user_id):
-    """دستور دیپلماسی"""
-    try:
-        user_data = get_user_data(chat_id, user_id)
-        
-        diplomacy_text = """
+@templates.template("diplomacy")
+def diplomacy_template():
+    """متن وزارت امور خارجه"""
+    return """
 🤝 **وزارت امور خارجه** 🤝
 
 **گزینه‌های دیپلماسی:**
@@ -1501,81 +4969,63 @@ async def diplomacy_command(message, chat_id, user_id):
 • مذاکره صلح - پایان جنگ
 
 **برای شروع مذاکره از دستور زیر استفاده کنید:**
-`/diplomacy negotiate [کاربر] [نوع]`
-        """
-        
-        await message.reply(diplomacy_text)
+`/diplomacy negotiate [کاربر] [trade|non_aggression|military_pact|sanction|peace]`
+    """
+
+@router.command("/diplomacy", priority=PRIORITY_LOW)
+@router.button("🤝 دیپلماسی")
+async def diplomacy_command(message, chat_id, user_id):
+    """دستور دیپلماسی"""
+    try:
+        get_user_data(chat_id, user_id)
+        await message.reply(templates.render("diplomacy"))
         
     except Exception as e:
         print(f"خطا در diplomacy_command: {e}")
         await message.reply("⚠️ خطا در نمایش دیپلماسی!")
 
+@router.command("/research", Arg("research_type", lower=True, choices=RESEARCH_TYPES), sub="start",
+                usage=f"/research start [{'|'.join(RESEARCH_TYPES)}]")
+async def research_start(message, chat_id, user_id, research_type):
+    """شروع تحقیق (هنوز پیاده‌سازی نشده)"""
+    await message.reply(f"🚧 تحقیق {RESEARCH_TYPES[research_type]} به زودی فعال می‌شود!")
+
+@router.command("/diplomacy", Arg("target"), Arg("deal_type", lower=True, choices=DIPLOMACY_TYPES), sub="negotiate",
+                usage=f"/diplomacy negotiate [کاربر] [{'|'.join(DIPLOMACY_TYPES)}]")
+async def diplomacy_negotiate(message, chat_id, user_id, target, deal_type):
+    """شروع مذاکره (هنوز پیاده‌سازی نشده)"""
+    await message.reply(f"🚧 {DIPLOMACY_TYPES[deal_type]} با {target} به زودی فعال می‌شود!")
+
+@router.command("/collect")
 async def collect_command(message, chat_id, user_id):
     """دستور جمع‌آوری منابع"""
     try:
         user_data = get_user_data(chat_id, user_id)
-        current_time = datetime.now()
-        last_active = datetime.fromisoformat(user_data["last_active"])
+        cycles, income = accrue_resources(user_data)
         
-        # محاسبه منابع قابل جمع‌آوری
-        time_diff = (current_time - last_active).total_seconds() / 60  # دقیقه
-        
-        if time_diff < 5:
-            await message.reply("⏳ هنوز منابع جدید تولید نشده! 5 دقیقه صبر کنید.")
+        if not cycles:
+            await message.reply(f"⏳ هنوز منابع جدید تولید نشده! {PRODUCTION_INTERVAL // 60} دقیقه صبر کنید.")
             return
         
-        # محاسبه منابع بر اساس زمان
-        cycles = int(time_diff // 5)
-        
-        # محاسبه درآمد
-        government_level = user_data["capital"].get("government", 0)
-        economy_level = user_data["capital"].get("economy", 0)
-        infrastructure_level = user_data["capital"].get("infrastructure", 0)
-        
-        money_income = (10 + (government_level * 5) + (economy_level * 3)) * cycles
-        oil_income = (5 + (government_level * 2) + (infrastructure_level * 1)) * cycles
-        uranium_income = (1 + (government_level // 2)) * cycles
-        social_credit_income = (2 + (government_level // 3)) * cycles
-        technology_income = (1 + (user_data["capital"].get("research_lab", 0) * 2)) * cycles
-        steel_income = (3 + (infrastructure_level * 2)) * cycles
-        aluminum_income = (2 + (infrastructure_level * 1)) * cycles
-        titanium_income = (1 + (infrastructure_level // 2)) * cycles
-        rare_earth_income = (1 + (infrastructure_level // 3)) * cycles
-        population_income = (20 + (government_level * 10)) * cycles
-        
-        # اعطای منابع
-        user_data["resources"]["money"] += money_income
-        user_data["resources"]["oil"] += oil_income
-        user_data["resources"]["uranium"] += uranium_income
-        user_data["resources"]["social_credit"] += social_credit_income
-        user_data["resources"]["technology"] += technology_income
-        user_data["resources"]["steel"] += steel_income
-        user_data["resources"]["aluminum"] += aluminum_income
-        user_data["resources"]["titanium"] += titanium_income
-        user_data["resources"]["rare_earth"] += rare_earth_income
-        user_data["resources"]["population"] += population_income
-        user_data["experience"] += money_income // 10
-        user_data["last_active"] = current_time.isoformat()
-        
-        save_data()
+        mark_user_dirty(chat_id, user_id)
         
         collect_text = f"""
 💰 **جمع‌آوری منابع موفق!**
 
 **منابع جمع‌آوری شده:**
-💰 پول: +{money_income:,}
-🛢️ نفت: +{oil_income:,}
-☢️ اورانیوم: +{uranium_income:,}
-⭐ اعتبار اجتماعی: +{social_credit_income:,}
-🔬 فناوری: +{technology_income:,}
-⚙️ فولاد: +{steel_income:,}
-🔧 آلومینیوم: +{aluminum_income:,}
-💎 تیتانیوم: +{titanium_income:,}
-💠 فلزات نادر: +{rare_earth_income:,}
-👥 جمعیت: +{population_income:,}
+💰 پول: +{income["money"]:,}
+🛢️ نفت: +{income["oil"]:,}
+☢️ اورانیوم: +{income["uranium"]:,}
+⭐ اعتبار اجتماعی: +{income["social_credit"]:,}
+🔬 فناوری: +{income["technology"]:,}
+⚙️ فولاد: +{income["steel"]:,}
+🔧 آلومینیوم: +{income["aluminum"]:,}
+💎 تیتانیوم: +{income["titanium"]:,}
+💠 فلزات نادر: +{income["rare_earth"]:,}
+👥 جمعیت: +{income["population"]:,}
 
 **مجموع چرخه‌ها:** {cycles}
-**تجربه کسب شده:** +{money_income // 10:,}
+**تجربه کسب شده:** +{income["money"] // 10:,}
         """
         
         await message.reply(collect_text)
@@ -1584,37 +5034,142 @@ async def collect_command(message, chat_id, user_id):
         print(f"خطا در collect_command: {e}")
         await message.reply("⚠️ خطا در جمع‌آوری منابع!")
 
-async def handle_alliance_command(message, chat_id, user_id):
-    """مدیریت دستورات اتحاد"""
+@router.command("/collectors")
+async def collectors_command(message, chat_id, user_id):
+    """دستور نمایش کالکتورها"""
+    try:
+        user_data = get_user_data(chat_id, user_id)
+        collectors = user_data.get("collectors", {})
+        rates = dict(zip(RESOURCE_ORDER, production_vector(user_data)))
+        
+        collectors_text = "🏭 **کالکتورهای شما** 🏭\n\n"
+        for collector, info in RESOURCE_COLLECTORS.items():
+            count = collectors.get(collector, 0)
+            resource_name = RESOURCES[info["resource"]]["name"]
+            if count > 0:
+                collectors_text += f"{info['emoji']} **{info['name']}** x{count} - {info['base_production'] * count:,} {resource_name}/ساعت\n"
+            elif user_data["level"] >= info["level_req"]:
+                collectors_text += f"• {info['name']} (`{collector}`) - 💰 {info['cost']:,} - {info['base_production']:,} {resource_name}/ساعت\n"
+            else:
+                collectors_text += f"🔒 {info['name']} - سطح {info['level_req']}\n"
+        
+        collectors_text += f"\n**تولید هر {PRODUCTION_INTERVAL // 60} دقیقه:**\n"
+        for resource, rate in rates.items():
+            collectors_text += f"{RESOURCES[resource]['emoji']} {RESOURCES[resource]['name']}: {rate:,.1f}\n"
+        collectors_text += "\nخرید: `/buy_collector [نوع] [تعداد]`"
+        
+        await message.reply(collectors_text)
+        
+    except Exception as e:
+        print(f"خطا در collectors_command: {e}")
+        await message.reply("⚠️ خطا در نمایش کالکتورها!")
+
+@router.command("/buy_collector", Arg("collector", lower=True), Arg("quantity", int, default=1),
+                usage="/buy_collector [نوع] [تعداد]")
+@router.command("/build", Arg("collector", lower=True), Arg("quantity", int, default=1),
+                usage="/build [نوع] [تعداد]")
+async def buy_collector_command(message, chat_id, user_id, collector, quantity=1):
+    """دستور خرید کالکتور"""
     try:
-        parts = message.content.split()
-        if len(parts) < 2:
-            await alliance_command(message, chat_id, user_id)
+        info = RESOURCE_COLLECTORS.get(collector)
+        if info is None:
+            await message.reply("❌ کالکتور نامعتبر! از /collectors برای دیدن لیست استفاده کنید.")
+            return
+        if quantity <= 0:
+            await message.reply("❌ تعداد باید بیشتر از صفر باشد!")
             return
         
-        subcommand = parts[1].lower()
-        
-        if subcommand == "create" and len(parts) >= 3:
-            await alliance_create(message, chat_id, user_id, " ".join(parts[2:]))
-        elif subcommand == "join" and len(parts) >= 3:
-            await alliance_join(message, chat_id, user_id, " ".join(parts[2:]))
-        elif subcommand == "leave":
-            await alliance_leave(message, chat_id, user_id)
-        elif subcommand == "info" and len(parts) >= 3:
-            await alliance_info(message, chat_id, " ".join(parts[2:]))
-        elif subcommand == "list":
-            await alliance_list(message, chat_id)
-        elif subcommand == "invite":
-            await alliance_invite(message, chat_id, user_id)
-        elif subcommand == "kick":
-            await alliance_kick(message, chat_id, user_id)
-        else:
-            await message.reply("❌ دستور اتحاد نامعتبر!")
-            
+        # درآمد انباشته با نرخ پیش از خرید تسویه می‌شود
+        user_data = settle_user(chat_id, user_id)
+        if user_data["level"] < info["level_req"]:
+            await message.reply(f"❌ سطح کافی ندارید! نیاز به سطح {info['level_req']}")
+            return
+        
+        total_cost = info["cost"] * quantity
+        if user_data["resources"]["money"] < total_cost:
+            await message.reply(f"❌ پول کافی ندارید! نیاز: {total_cost:,}")
+            return
+        
+        user_data["resources"]["money"] -= total_cost
+        user_data["collectors"][collector] = user_data["collectors"].get(collector, 0) + quantity
+        invalidate_production(user_data)
+        mark_user_dirty(chat_id, user_id)
+        
+        count = user_data["collectors"][collector]
+        resource_name = RESOURCES[info["resource"]]["name"]
+        await message.reply(f"""
+✅ **کالکتور خریداری شد!**
+
+{info['emoji']} {info['name']} x{quantity} (مجموع: {count})
+💰 هزینه: {total_cost:,}
+📈 تولید: {info['base_production'] * count:,} {resource_name}/ساعت
+
+💰 پول باقیمانده: {user_data['resources']['money']:,}
+        """)
+        
+    except Exception as e:
+        print(f"خطا در buy_collector_command: {e}")
+        await message.reply("⚠️ خطا در خرید کالکتور!")
+
+def describe_government(system):
+    """متن مزایا و معایب یک سیستم مدیریت"""
+    info = GOVERNMENT_SYSTEMS[system]
+    text = f"{info['emoji']} **{info['name']}**\n{info['description']}\n"
+    for title, effects in (("مزایا", info["benefits"]), ("معایب", info["penalties"])):
+        text += f"\n**{title}:**\n"
+        for effect, multiplier in effects.items():
+            text += f"• {effect}: {round((multiplier - 1) * 100):+d}%\n"
+    return text
+
+@router.command("/government")
+async def government_command(message, chat_id, user_id):
+    """دستور نمایش سیستم مدیریت"""
+    try:
+        user_data = get_user_data(chat_id, user_id)
+        current = user_data.get("government", "democracy")
+        
+        government_text = f"🏛️ **سیستم مدیریت فعلی** 🏛️\n\n{describe_government(current)}\n**سیستم‌های دیگر:**\n"
+        for system, info in GOVERNMENT_SYSTEMS.items():
+            if system == current:
+                continue
+            lock = "" if user_data["level"] >= info["unlock_level"] else f" 🔒 سطح {info['unlock_level']}"
+            government_text += f"{info['emoji']} {info['name']} (`{system}`){lock}\n"
+        government_text += "\nتغییر: `/change_government [نوع]`"
+        
+        await message.reply(government_text)
+        
     except Exception as e:
-        print(f"خطا در handle_alliance_command: {e}")
-        await message.reply("⚠️ خطا در پردازش دستور اتحاد!")
+        print(f"خطا در government_command: {e}")
+        await message.reply("⚠️ خطا در نمایش سیستم مدیریت!")
 
+@router.command("/change_government", Arg("system", lower=True, choices=GOVERNMENT_SYSTEMS),
+                usage=f"/change_government [{'|'.join(GOVERNMENT_SYSTEMS)}]")
+async def change_government_command(message, chat_id, user_id, system):
+    """دستور تغییر سیستم مدیریت"""
+    try:
+        # درآمد انباشته با ضرایب حکومت قبلی تسویه می‌شود
+        user_data = settle_user(chat_id, user_id)
+        if user_data.get("government") == system:
+            await message.reply("❌ این سیستم مدیریت در حال حاضر فعال است!")
+            return
+        
+        unlock_level = GOVERNMENT_SYSTEMS[system]["unlock_level"]
+        if user_data["level"] < unlock_level:
+            await message.reply(f"❌ سطح کافی ندارید! نیاز به سطح {unlock_level}")
+            return
+        
+        user_data["government"] = system
+        user_data["government_changes"] = user_data.get("government_changes", 0) + 1
+        invalidate_production(user_data)
+        mark_user_dirty(chat_id, user_id)
+        
+        await message.reply(f"✅ **سیستم مدیریت تغییر کرد!**\n\n{describe_government(system)}")
+        
+    except Exception as e:
+        print(f"خطا در change_government_command: {e}")
+        await message.reply("⚠️ خطا در تغییر سیستم مدیریت!")
+
+@router.command("/alliance", Arg("alliance_name", rest=True), sub="create", usage="/alliance create [نام]")
 async def alliance_create(message, chat_id, user_id, alliance_name):
     """ایجاد اتحاد جدید"""
     try:
@@ -1624,20 +5179,29 @@ async def alliance_create(message, chat_id, user_id, alliance_name):
             await message.reply("❌ شما قبلاً در یک اتحاد عضو هستید!")
             return
         
-        if alliance_name in game_data["alliances"]:
+        if get_alliance(alliance_name) is not None:
+            await message.reply("❌ اتحادی با این نام از قبل وجود دارد!")
+            return
+        
+        # در حالت شارد نام پس از گذشتن بررسی‌ها در فهرست فرآیند اصلی ثبت می‌شود
+        if not await claim_alliance_name(alliance_name) or get_alliance(alliance_name) is not None:
             await message.reply("❌ اتحادی با این نام از قبل وجود دارد!")
             return
         
         # ایجاد اتحاد
-        game_data["alliances"][alliance_name] = {
-            "leader": user_id,
-            "members": [user_id],
-            "created_at": datetime.now().isoformat(),
-            "total_power": calculate_total_power(user_data)
-        }
+        try:
+            create_alliance(alliance_name, {
+                "leader": user_id,
+                "members": [user_id],
+                "created_at": datetime.now().isoformat(),
+                "total_power": calculate_total_power(user_data)
+            })
+        except Exception:
+            await release_alliance_name(alliance_name)
+            raise
         
         user_data["alliance"] = alliance_name
-        save_data()
+        mark_user_dirty(chat_id, user_id)
         
         await message.reply(f"✅ اتحاد '{alliance_name}' با موفقیت ایجاد شد!")
         
@@ -1645,6 +5209,7 @@ async def alliance_create(message, chat_id, user_id, alliance_name):
         print(f"خطا در alliance_create: {e}")
         await message.reply("⚠️ خطا در ایجاد اتحاد!")
 
+@router.command("/alliance", Arg("alliance_name", rest=True), sub="join", usage="/alliance join [نام]")
 async def alliance_join(message, chat_id, user_id, alliance_name):
     """پیوستن به اتحاد"""
     try:
@@ -1654,16 +5219,18 @@ async def alliance_join(message, chat_id, user_id, alliance_name):
             await message.reply("❌ شما قبلاً در یک اتحاد عضو هستید!")
             return
         
-        if alliance_name not in game_data["alliances"]:
+        alliance_data = get_alliance(alliance_name)
+        if alliance_data is None:
             await message.reply("❌ اتحادی با این نام وجود ندارد!")
             return
         
         # پیوستن به اتحاد
-        game_data["alliances"][alliance_name]["members"].append(user_id)
-        game_data["alliances"][alliance_name]["total_power"] += calculate_total_power(user_data)
+        alliance_data["members"].append(user_id)
+        alliance_data["total_power"] += calculate_total_power(user_data)
         
         user_data["alliance"] = alliance_name
-        save_data()
+        mark_user_dirty(chat_id, user_id)
+        mark_alliance_dirty(alliance_name)
         
         await message.reply(f"✅ شما با موفقیت به اتحاد '{alliance_name}' پیوستید!")
         
@@ -1671,6 +5238,7 @@ async def alliance_join(message, chat_id, user_id, alliance_name):
         print(f"خطا در alliance_join: {e}")
         await message.reply("⚠️ خطا در پیوستن به اتحاد!")
 
+@router.command("/alliance", sub="leave")
 async def alliance_leave(message, chat_id, user_id):
     """ترک اتحاد"""
     try:
@@ -1681,7 +5249,7 @@ async def alliance_leave(message, chat_id, user_id):
             return
         
         alliance_name = user_data["alliance"]
-        alliance_data = game_data["alliances"][alliance_name]
+        alliance_data = get_alliance(alliance_name)
         
         # حذف از اتحاد
         if user_id in alliance_data["members"]:
@@ -1693,10 +5261,11 @@ async def alliance_leave(message, chat_id, user_id):
             alliance_data["leader"] = alliance_data["members"][0]
         elif not alliance_data["members"]:
             # اگر اتحاد خالی شد، حذف کن
-            del game_data["alliances"][alliance_name]
+            delete_alliance(alliance_name)
         
         user_data["alliance"] = None
-        save_data()
+        mark_user_dirty(chat_id, user_id)
+        mark_alliance_dirty(alliance_name)
         
         await message.reply(f"✅ شما با موفقیت از اتحاد '{alliance_name}' خارج شدید!")
         
@@ -1704,15 +5273,15 @@ async def alliance_leave(message, chat_id, user_id):
         print(f"خطا در alliance_leave: {e}")
         await message.reply("⚠️ خطا در ترک اتحاد!")
 
-async def alliance_info(message, chat_id, alliance_name):
+@router.command("/alliance", Arg("alliance_name", rest=True), sub="info", usage="/alliance info [نام]")
+async def alliance_info(message, chat_id, user_id, alliance_name):
     """اطلاعات اتحاد"""
     try:
-        if alliance_name not in game_data["alliances"]:
+        alliance_data = get_alliance(alliance_name)
+        if alliance_data is None:
             await message.reply("❌ اتحادی با این نام وجود ندارد!")
             return
         
-        alliance_data = game_data["alliances"][alliance_name]
-        
         info_text = f"""
 🤝 **اطلاعات اتحاد: {alliance_name}** 🤝
 
@@ -1724,16 +5293,13 @@ async def alliance_info(message, chat_id, alliance_name):
 **اعضا:**
 """
         
+        member_names = await name_resolver.resolve_many(chat_id, alliance_data.get('members', []))
         for member_id in alliance_data.get('members', []):
-            try:
-                member = await bot.get_chat_member(chat_id, int(member_id))
-                member_name = member.user.first_name
-                if member_id == alliance_data.get('leader'):
-                    info_text += f"👑 {member_name} (رهبر)\n"
-                else:
-                    info_text += f"• {member_name}\n"
-            except:
-                info_text += f"• User {member_id}\n"
+            member_name = member_names[str(member_id)]
+            if member_id == alliance_data.get('leader'):
+                info_text += f"👑 {member_name} (رهبر)\n"
+            else:
+                info_text += f"• {member_name}\n"
         
         await message.reply(info_text)
         
@@ -1741,16 +5307,18 @@ async def alliance_info(message, chat_id, alliance_name):
         print(f"خطا در alliance_info: {e}")
         await message.reply("⚠️ خطا در دریافت اطلاعات اتحاد!")
 
-async def alliance_list(message, chat_id):
+@router.command("/alliance", sub="list")
+async def alliance_list(message, chat_id, user_id):
     """لیست اتحادها"""
     try:
-        if not game_data["alliances"]:
+        alliances = list_alliances()
+        if not alliances:
             await message.reply("❌ هیچ اتحادی وجود ندارد!")
             return
         
         list_text = "🤝 **لیست اتحادها** 🤝\n\n"
         
-        for alliance_name, alliance_data in game_data["alliances"].items():
+        for alliance_name, alliance_data in alliances:
             member_count = len(alliance_data.get('members', []))
             total_power = alliance_data.get('total_power', 0)
             list_text += f"• **{alliance_name}**\n"
@@ -1762,6 +5330,7 @@ async def alliance_list(message, chat_id):
         print(f"خطا در alliance_list: {e}")
         await message.reply("⚠️ خطا در دریافت لیست اتحادها!")
 
+@router.command("/alliance", sub="invite", lock_reply=True)
 async def alliance_invite(message, chat_id, user_id):
     """دعوت به اتحاد"""
     try:
@@ -1784,7 +5353,7 @@ async def alliance_invite(message, chat_id, user_id):
             return
         
         alliance_name = user_data["alliance"]
-        alliance_data = game_data["alliances"][alliance_name]
+        alliance_data = get_alliance(alliance_name)
         
         if alliance_data["leader"] != user_id:
             await message.reply("❌ فقط رهبر اتحاد می‌تواند دعوت کند!")
@@ -1797,6 +5366,7 @@ async def alliance_invite(message, chat_id, user_id):
         print(f"خطا در alliance_invite: {e}")
         await message.reply("⚠️ خطا در ارسال دعوت!")
 
+@router.command("/alliance", sub="kick", lock_reply=True)
 async def alliance_kick(message, chat_id, user_id):
     """اخراج از اتحاد"""
     try:
@@ -1819,7 +5389,7 @@ async def alliance_kick(message, chat_id, user_id):
             return
         
         alliance_name = user_data["alliance"]
-        alliance_data = game_data["alliances"][alliance_name]
+        alliance_data = get_alliance(alliance_name)
         
         if alliance_data["leader"] != user_id:
             await message.reply("❌ فقط رهبر اتحاد می‌تواند اخراج کند!")
@@ -1835,7 +5405,8 @@ async def alliance_kick(message, chat_id, user_id):
             alliance_data["total_power"] -= calculate_total_power(target_data)
         
         target_data["alliance"] = None
-        save_data()
+        mark_user_dirty(chat_id, target_user_id)
+        mark_alliance_dirty(alliance_name)
         
         await message.reply(f"✅ کاربر {target_user.first_name} از اتحاد اخراج شد!")
         
@@ -1843,31 +5414,523 @@ async def alliance_kick(message, chat_id, user_id):
         print(f"خطا در alliance_kick: {e}")
         await message.reply("⚠️ خطا در اخراج کاربر!")
 
+@instrumented(menu_label)
 async def handle_menu_button(message, button_text, chat_id, user_id):
     """مدیریت دکمه‌های منو"""
     try:
-        if button_text == "💰 وضعیت":
-            await status_command(message, chat_id, user_id)
-        elif button_text == "⚔️ نیروی نظامی":
-            await military_command(message, chat_id, user_id)
-        elif button_text == "🛒 فروشگاه":
-            await shop_command(message, chat_id, user_id)
-        elif button_text == "🏰 پایتخت":
-            await capital_command(message, chat_id, user_id)
-        elif button_text == "🏆 رتبه‌بندی":
-            await leaderboard_command(message, chat_id)
-        elif button_text == "🤝 اتحاد":
-            await alliance_command(message, chat_id, user_id)
-        elif button_text == "🕵️ جاسوسی":
-            await spy_command(message, chat_id, user_id)
-        elif button_text == "🔬 تحقیقات":
-            await research_command(message, chat_id, user_id)
-        elif button_text == "🤝 دیپلماسی":
-            await diplomacy_command(message, chat_id, user_id)
+        handler = router.buttons.get(button_text)
+        if handler is not None:
+            async with player_locks.hold(chat_id, *router.lock_targets(message, button_text, user_id)):
+                await handler(message, chat_id, user_id)
     except Exception as e:
         print(f"خطا در handle_menu_button: {e}")
         await message.reply("⚠️ خطا در پردازش دکمه!")
 
+# ==================== SHARDING ====================
+class HashRing:
+    """حلقه هش سازگار (md5) برای نگاشت chat_id به شارد با گره‌های مجازی"""
+
+    def __init__(self, shards, replicas=SHARD_REPLICAS):
+        points = sorted((self.hash(f"shard-{shard}#{replica}"), shard)
+                        for shard in range(shards) for replica in range(replicas))
+        self.hashes = [point for point, _ in points]
+        self.shards = [shard for _, shard in points]
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.md5(str(key).encode("utf-8")).digest()[:8], "big")
+
+    def shard_for(self, chat_id):
+        index = bisect_right(self.hashes, self.hash(chat_id)) % len(self.hashes)
+        return self.shards[index]
+
+def shard_path(path, index):
+    """مسیر فایل مخصوص شارد: war_data.txt -> war_data.shard0.txt"""
+    base, ext = os.path.splitext(path)
+    return f"{base}.shard{index}{ext}"
+
+def encode_user(user):
+    """تبدیل کاربر به دیکشنری قابل ارسال بین فرآیندها"""
+    if user is None:
+        return None
+    return {"user_id": user.user_id, "first_name": user.first_name, "is_bot": getattr(user, "is_bot", False)}
+
+def encode_update(message):
+    """تبدیل پیام به دیکشنری قابل ارسال به فرآیند شارد"""
+    reply_to = getattr(message, "reply_to_message", None)
+    return {
+        "chat_id": message.chat.id,
+        "message_id": getattr(message, "message_id", None),
+        "content": message.content,
+        "author": encode_user(message.author),
+        "reply_to": None if reply_to is None else {
+            "message_id": getattr(reply_to, "message_id", None),
+            "author": encode_user(reply_to.author),
+        },
+    }
+
+class RemoteUser:
+    __slots__ = ("user_id", "first_name", "is_bot")
+
+    def __init__(self, user_id, first_name, is_bot=False):
+        self.user_id = user_id
+        self.first_name = first_name
+        self.is_bot = is_bot
+
+class RemoteChat:
+    __slots__ = ("id",)
+
+    def __init__(self, chat_id):
+        self.id = chat_id
+
+class RemoteChatMember:
+    __slots__ = ("status", "user")
+
+    def __init__(self, status, user):
+        self.status = status
+        self.user = user
+
+class RemoteMessage:
+    """پیام بازسازی شده در فرآیند شارد؛ پاسخ‌ها از طریق bot شارد (ParentBot) ارسال می‌شوند"""
+
+    def __init__(self, payload):
+        self.chat = RemoteChat(payload["chat_id"])
+        self.message_id = payload["message_id"]
+        self.content = payload["content"]
+        self.author = RemoteUser(**payload["author"]) if payload["author"] else None
+        reply_to = payload.get("reply_to")
+        self.reply_to_message = None
+        if reply_to is not None:
+            self.reply_to_message = RemoteMessage({
+                "chat_id": payload["chat_id"], "message_id": reply_to["message_id"],
+                "content": None, "author": reply_to["author"],
+            })
+
+    async def reply(self, text, components=None):
+        return await bot.send_message(self.chat.id, text, components=components,
+                                      reply_to_message_id=self.message_id)
+
+    async def delete(self):
+        return await bot.delete_message(self.chat.id, self.message_id)
+
+SHARD_CLOSED = "closed"  # علامت توقف فرآیند اصلی در صف نتایج شارد
+SHARD_POLL_INTERVAL = 0.5  # ثانیه؛ نخ منتظر صف پس از لغو حلقه حداکثر این مدت باقی می‌ماند
+
+class ParentBot:
+    """
+    جایگزین bot در فرآیند شارد
+
+    کلاینت بله فقط در فرآیند اصلی اجرا و متصل است؛ شارد هر فراخوانی API را به صورت
+    (شارد، شناسه، متد، آرگومان‌ها) در صف calls قرار می‌دهد و فرآیند اصلی نتیجه را در
+    صف results همین شارد برمی‌گرداند. نتایج به اشیای Remote* تبدیل می‌شوند.
+    """
+
+    def __init__(self, index, calls, results, timeout=SHARD_CALL_TIMEOUT):
+        self.index = index
+        self.calls = calls
+        self.results = results
+        self.timeout = timeout
+        self.pending = {}
+        self.ids = itertools.count()
+        self.closed = False
+        self._task = None
+
+    def start(self):
+        """شروع دریافت نتایج (داخل event loop شارد)"""
+        if self._task is None:
+            self._task = asyncio.ensure_future(self.listen())
+
+    async def listen(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                result = await loop.run_in_executor(None, self.results.get, True, SHARD_POLL_INTERVAL)
+            except QueueEmpty:
+                continue
+            if result is None:
+                break
+            if result == SHARD_CLOSED:
+                # فرآیند اصلی متوقف شده؛ فراخوانی‌های باقیمانده بلافاصله شکست می‌خورند
+                self.closed = True
+                for future in self.pending.values():
+                    if not future.done():
+                        future.set_exception(ConnectionError("فرآیند اصلی متوقف شده است"))
+                continue
+            request_id, ok, value = result
+            future = self.pending.get(request_id)
+            if future is not None and not future.done():
+                future.set_result((ok, value))
+
+    async def call(self, method, *args, **kwargs):
+        """اجرای متد bot در فرآیند اصلی و انتظار برای نتیجه"""
+        if self.closed:
+            raise ConnectionError("فرآیند اصلی متوقف شده است")
+        self.start()
+        request_id = next(self.ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        try:
+            self.calls.put((self.index, request_id, method, args, kwargs))
+            ok, value = await asyncio.wait_for(future, self.timeout)
+        finally:
+            self.pending.pop(request_id, None)
+        if not ok:
+            raise ConnectionError(value)
+        return value
+
+    async def send_message(self, chat_id, text, components=None, reply_to_message_id=None):
+        message_id = await self.call("send_message", chat_id, text, components=components,
+                                     reply_to_message_id=reply_to_message_id)
+        return RemoteMessage({"chat_id": chat_id, "message_id": message_id, "content": text, "author": None})
+
+    async def delete_message(self, chat_id, message_id):
+        return await self.call("delete_message", chat_id, message_id)
+
+    async def get_chat_member(self, chat_id, user_id):
+        member = await self.call("get_chat_member", chat_id, user_id)
+        return RemoteChatMember(member["status"], RemoteUser(**member["user"]))
+
+    async def claim_alliance(self, name):
+        """ثبت نام اتحاد برای این شارد؛ False اگر متعلق به شارد دیگری باشد"""
+        return await self.call("claim_alliance", name)
+
+    async def release_alliance(self, name):
+        return await self.call("release_alliance", name)
+
+    def close(self):
+        """توقف دریافت نتایج (نخ منتظر صف آزاد می‌شود)"""
+        if self._task is not None:
+            self.results.put(None)
+            self._task = None
+
+# متدهای bot قابل فراخوانی از شاردها و تبدیل نتیجه به مقدار قابل ارسال بین فرآیندها
+SHARD_CALLS = {
+    "send_message": lambda sent: getattr(sent, "message_id", None),
+    "delete_message": lambda result: None,
+    "get_chat_member": lambda member: {"status": member.status, "user": encode_user(member.user)},
+}
+# فراخوانی‌های شارد که با فهرست نام اتحادهای فرآیند اصلی اجرا می‌شوند: {متد: متد AllianceDirectory}
+SHARD_DIRECTORY_CALLS = {"claim_alliance": "claim", "release_alliance": "release"}
+
+class AllianceDirectory:
+    """
+    شارد مالک هر نام اتحاد در حالت چندفرآیندی
+
+    هر اتحاد فقط در یک شارد نگهداری می‌شود (شارد گروه سازنده، یا برای داده‌های
+    تک‌فرآیندی شارد بازیکنانش). شارد پس از بررسی‌های /alliance create و پیش از ساخت
+    اتحاد نام را از طریق ParentBot ثبت می‌کند تا نام در تمام شاردها یکتا بماند (و در
+    صورت شکست ساخت آزاد می‌کند)؛ فرآیند اصلی /alliance join اتحاد شارد دیگر را رد
+    می‌کند. نام ثبت شده پس از حذف اتحاد هم در اختیار همان شارد می‌ماند.
+    """
+
+    def __init__(self, path=SHARD_ALLIANCE_FILE):
+        self.path = path
+        self.owners = {}
+
+    def load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.owners = json.load(f)
+        except FileNotFoundError:
+            self.owners = {}
+
+    def save(self):
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(self.owners, f, ensure_ascii=False)
+        os.replace(temp_path, self.path)
+
+    def owner(self, name):
+        return self.owners.get(name)
+
+    def claim(self, name, shard):
+        """ثبت نام برای shard؛ False اگر نام متعلق به شارد دیگری باشد"""
+        owner = self.owners.get(name)
+        if owner is None:
+            self.owners[name] = owner = shard
+            # فایل کوچک است و ایجاد اتحاد نادر؛ نوشتن مستقیم کافی است
+            self.save()
+        return owner == shard
+
+    def release(self, name, shard):
+        """آزاد کردن نام ثبت شده shard (پس از شکست ساخت اتحاد)"""
+        if self.owners.get(name) == shard:
+            del self.owners[name]
+            self.save()
+
+async def claim_alliance_name(name):
+    """ثبت سراسری نام اتحاد جدید؛ فقط در فرآیند شارد نیاز به فرآیند اصلی دارد"""
+    if isinstance(bot, ParentBot):
+        return await bot.claim_alliance(name)
+    return True
+
+async def release_alliance_name(name):
+    if isinstance(bot, ParentBot):
+        await bot.release_alliance(name)
+
+def alliance_shards(state, ring):
+    """شاردهای بازیکنان هر اتحاد در داده‌های تک‌فرآیندی: {نام: مجموعه شاردها}"""
+    found = {name: set() for name in state["alliances"]}
+    for user_key, user_data in state["users"].items():
+        name = user_data.get("alliance")
+        if name in found:
+            found[name].add(ring.shard_for(user_key.split(":", 1)[0]))
+    return found
+
+class ShardManager:
+    """
+    حالت چندفرآیندی: فرآیند اصلی پیام‌ها را دریافت و هر chat_id را با حلقه هش
+    سازگار به یکی از count فرآیند شارد می‌فرستد. هر شارد فایل یا دیتابیس
+    ذخیره‌سازی خود را دارد و همان هندلرها را اجرا می‌کند؛ پاسخ‌ها و سایر
+    فراخوانی‌های API بله از طریق صف calls با کلاینت متصل فرآیند اصلی اجرا می‌شوند.
+    """
+
+    def __init__(self, count=SHARD_COUNT, queue_size=SHARD_QUEUE_SIZE):
+        self.count = count
+        self.queue_size = queue_size
+        self.ring = HashRing(max(count, 1))
+        self.alliances = AllianceDirectory()
+        self.queues = []
+        self.results = []
+        self.processes = []
+        self.calls = None
+        self.serving = set()
+        self._task = None
+
+    @property
+    def enabled(self):
+        return self.count > 1
+
+    @property
+    def is_parent(self):
+        """فرآیند اصلی حالت شارد (فرآیندهای شارد bot را با ParentBot جایگزین می‌کنند)"""
+        return self.enabled and not isinstance(bot, ParentBot)
+
+    def check_alliances(self):
+        """
+        بررسی اتحادهای داده‌های تک‌فرآیندی پیش از انتقال به شاردها
+
+        اتحادی که بازیکنانش در گروه‌های شاردهای مختلف هستند قابل تقسیم نیست؛ در این
+        صورت False برمی‌گردد. مالک سایر اتحادها در AllianceDirectory ثبت می‌شود.
+        """
+        self.alliances.load()
+        if all(shard_storage_exists(index) for index in range(self.count)):
+            return True
+        found = alliance_shards(read_state(), self.ring)
+        spanning = sorted(name for name, owners in found.items() if len(owners) > 1)
+        if spanning:
+            print(f"❌ اعضای اتحادهای {', '.join(spanning)} در گروه‌های شاردهای مختلف هستند؛ "
+                  f"حالت چندفرآیندی راه‌اندازی نمی‌شود")
+            return False
+        for name, owners in found.items():
+            self.alliances.owners.setdefault(name, min(owners, default=0))
+        self.alliances.save()
+        return True
+
+    def start(self):
+        """راه‌اندازی فرآیندهای شارد؛ False اگر داده‌ها قابل تقسیم نباشند"""
+        if not self.check_alliances():
+            return False
+        context = multiprocessing.get_context("spawn")
+        self.calls = context.Queue()
+        for index in range(self.count):
+            updates = context.Queue(self.queue_size)
+            results = context.Queue()
+            process = context.Process(target=run_shard, args=(index, self.count, updates, self.calls, results),
+                                      name=f"war-shard-{index}", daemon=True)
+            process.start()
+            self.queues.append(updates)
+            self.results.append(results)
+            self.processes.append(process)
+        print(f"🧩 {self.count} شارد راه‌اندازی شد")
+        return True
+
+    def serve(self):
+        """شروع اجرای فراخوانی‌های شاردها (داخل event loop ربات)"""
+        if self._task is None and self.calls is not None:
+            self._task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                request = await loop.run_in_executor(None, self.calls.get, True, SHARD_POLL_INTERVAL)
+            except QueueEmpty:
+                continue
+            if request is None:
+                break
+            task = asyncio.ensure_future(self.handle_call(*request))
+            self.serving.add(task)
+            task.add_done_callback(self.serving.discard)
+
+    async def handle_call(self, shard, request_id, method, args, kwargs):
+        """اجرای فراخوانی شارد با bot فرآیند اصلی و ارسال نتیجه به صف results آن شارد"""
+        try:
+            if method in SHARD_DIRECTORY_CALLS:
+                value = getattr(self.alliances, SHARD_DIRECTORY_CALLS[method])(*args, shard, **kwargs)
+            else:
+                encode = SHARD_CALLS[method]
+                value = encode(await getattr(bot, method)(*args, **kwargs))
+            result = (request_id, True, value)
+        except Exception as e:
+            result = (request_id, False, f"{type(e).__name__}: {e}")
+        self.results[shard].put(result)
+
+    async def check_alliance(self, message, shard):
+        """بررسی شارد مالک نام در /alliance join؛ False یعنی پیام همینجا پاسخ داده شد"""
+        route, tokens = router.resolve(message.content or "")
+        if route is None or not tokens or route.label != "/alliance join":
+            return True
+        if self.alliances.owner(" ".join(tokens)) in (None, shard):
+            return True
+        await message.reply("❌ این اتحاد متعلق به گروه‌هایی است که در فرآیند دیگری پردازش می‌شوند و از این گروه نمی‌توان به آن پیوست!")
+        return False
+
+    async def route(self, message):
+        """ارسال پیام به شارد مالک گروه"""
+        shard = self.ring.shard_for(message.chat.id)
+        if not await self.check_alliance(message, shard):
+            return
+        payload = encode_update(message)
+        try:
+            self.queues[shard].put_nowait(payload)
+        except QueueFull:
+            # صف شارد پر است؛ منتظر می‌مانیم بدون مسدود کردن event loop
+            await asyncio.get_running_loop().run_in_executor(None, self.queues[shard].put, payload)
+        shard_updates.inc(1, shard)
+
+    def depth(self, shard):
+        try:
+            return self.queues[shard].qsize()
+        except NotImplementedError:  # macOS
+            return 0
+
+    def alive(self):
+        return bool(self.processes) and all(process.is_alive() for process in self.processes)
+
+    def close(self, timeout=30):
+        """توقف شاردها پس از پردازش پیام‌های در صف و ذخیره نهایی"""
+        cancel_task(self._task)
+        self._task = None
+        for updates, results in zip(self.queues, self.results):
+            updates.put(None)
+            # event loop فرآیند اصلی متوقف شده و پاسخ‌های باقیمانده قابل ارسال نیستند
+            results.put(SHARD_CLOSED)
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.terminate()
+        if self.calls is not None:
+            self.calls.put(None)
+            self.calls = None
+        self.queues.clear()
+        self.results.clear()
+        self.processes.clear()
+
+shards = ShardManager()
+
+def shard_storage_exists(index):
+    """وجود داده ذخیره شده برای شارد index"""
+    if STORAGE_BACKEND == "sqlite":
+        return os.path.exists(shard_path(SQLITE_FILE, index))
+    data_file = shard_path(DATA_FILE, index)
+    wal_file = shard_path(DATABASE_CONFIG["WAL_FILE"], index) if DATABASE_CONFIG.get("WAL_FILE") else f"{data_file}.wal"
+    return os.path.exists(data_file) or os.path.exists(wal_file)
+
+def configure_shard(index, count, calls, results):
+    """تنظیم مسیر ذخیره‌سازی، لاگ، پورت مانیتورینگ، کلاینت بله (ParentBot) و سهم نرخ ارسال شارد"""
+    global DATA_FILE, SQLITE_FILE, repository, bot
+    bot = ParentBot(index, calls, results)
+    # محدودیت نرخ سراسری برای کل ربات است؛ هر شارد سهم برابری از آن دارد
+    outbox.set_global_rate(OUTBOUND_GLOBAL_RATE / count)
+    repository.close()
+    DATA_FILE = shard_path(DATA_FILE, index)
+    SQLITE_FILE = shard_path(SQLITE_FILE, index)
+    if DATABASE_CONFIG.get("WAL_FILE"):
+        DATABASE_CONFIG["WAL_FILE"] = shard_path(DATABASE_CONFIG["WAL_FILE"], index)
+    repository = create_repository(STORAGE_BACKEND)
+    log_sink.path = shard_path(log_sink.path, index)
+    log_sink.file_lines = None
+    battle_ledger.path = shard_path(battle_ledger.path, index)
+    if monitoring.port:
+        monitoring.port = METRICS_PORT + 1 + index
+
+def split_state(state, index, ring):
+    """بخشی از داده‌ها که گروه‌هایش متعلق به شارد index است"""
+    part = empty_game_data()
+    for table in ("users", "countries"):
+        for key, record in state[table].items():
+            if ring.shard_for(key.split(":", 1)[0]) == index:
+                part[table][key] = record
+    # اتحادها کلید گروه ندارند؛ هر اتحاد فقط به شارد بازیکنانش می‌رود (ShardManager.check_alliances
+    # اتحادهای پخش در چند شارد را پیش از انتقال رد می‌کند) و اتحاد بدون بازیکن به شارد 0
+    for name, owners in alliance_shards(state, ring).items():
+        if min(owners, default=0) == index:
+            part["alliances"][name] = state["alliances"][name]
+    return part
+
+def import_shard_state(state):
+    """نصب داده‌های منتقل شده و علامت‌گذاری تمام رکوردها برای ذخیره در مخزن شارد"""
+    install_state(state)
+    for user_key in game_data["users"]:
+        persistence.mark_user(user_key)
+    for country_key in game_data["countries"]:
+        persistence.mark_country(country_key)
+    for alliance_name in game_data["alliances"]:
+        persistence.mark_alliance(alliance_name)
+
+async def shard_main(index, count, updates, legacy_state=None):
+    """حلقه اصلی فرآیند شارد: دریافت پیام‌ها از فرآیند اصلی و توزیع در صف گروه‌ها"""
+    io_executor.start()
+    bot.start()
+    await load_data_async()
+    if legacy_state is not None and not game_data["users"]:
+        # اولین اجرای حالت شارد: انتقال گروه‌های این شارد از داده‌های تک‌فرآیندی
+        import_shard_state(split_state(legacy_state, index, HashRing(count)))
+        await persistence.flush_async()
+        print(f"📦 {len(game_data['users'])} بازیکن به شارد {index} منتقل شد")
+        if not battle_ledger.chats:
+            ring = HashRing(count)
+            battle_ledger.load(BATTLES_FILE, keep=lambda chat_id: ring.shard_for(chat_id) == index)
+    persistence.start()
+    log_sink.start()
+    battle_ledger.start()
+    outbox.start()
+    if ECONOMY_TICK:
+        economy.start()
+    await monitoring.start()
+    monitoring.ready = True
+    print(f"🧩 شارد {index} آماده است ({len(game_data['users'])} بازیکن)")
+
+    loop = asyncio.get_running_loop()
+    while True:
+        payload = await loop.run_in_executor(None, updates.get)
+        if payload is None:
+            break
+        await wait_for_io_capacity()
+        dispatcher.submit(RemoteMessage(payload))
+    await dispatcher.drain()
+    await outbox.drain()
+    bot.close()
+
+def run_shard(index, count, updates, calls, results):
+    """نقطه ورود فرآیند شارد"""
+    legacy_state = None
+    if not shard_storage_exists(index):
+        # داده‌های حالت تک‌فرآیندی (در صورت وجود) پیش از تغییر مسیرها خوانده می‌شوند
+        legacy_state = read_state()
+    configure_shard(index, count, calls, results)
+    try:
+        asyncio.run(shard_main(index, count, updates, legacy_state))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        monitoring.close()
+        economy.close()
+        dispatcher.close()
+        outbox.close()
+        shutdown_storage()
+
 # ==================== RUN BOT ====================
 def main():
     """تابع اصلی اجرای ربات"""
@@ -1880,9 +5943,14 @@ def main():
         print("💡 فایل config_example.py را کپی کرده و نام آن را به config.py تغییر دهید")
         return
     
-    # بارگذاری داده‌ها
-    load_data()
-    print("✅ داده‌ها بارگذاری شد")
+    if shards.enabled:
+        if not shards.start():
+            print("💡 اعضای هر اتحاد را در گروه‌های یک شارد نگه دارید یا SHARD_CONFIG[\"SHARDS\"] را 1 قرار دهید")
+            return
+    else:
+        # بارگذاری داده‌ها
+        load_data()
+        print("✅ داده‌ها بارگذاری شد")
     
     # شروع ربات
     print("🤖 ربات در حال راه‌اندازی...")
@@ -1894,6 +5962,14 @@ def main():
         print(f"\n❌ خطا در اجرای ربات: {e}")
         import traceback
         traceback.print_exc()
+    finally:
+        monitoring.close()
+        economy.close()
+        dispatcher.close()
+        outbox.close()
+        shards.close()
+        # ذخیره نهایی رکوردها و لاگ‌های باقیمانده
+        shutdown_storage()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file